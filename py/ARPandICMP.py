@@ -42,6 +42,8 @@ class ARPandICMP(Table):
     def add_switch_mac_and_ip(self, switch_mac, switch_ip):
         self.switch_mac = switch_mac
         self.switch_ip = switch_ip
+        if self.adopting:
+            return
         
         # add entry to reply to arp requests
         self.table.entry_add(
@@ -8,21 +8,21 @@ import bfrt_grpc.client as gc
 import grpc
 
 
-from Table import Table
+from Table import Table, TableHandle
 
 
 class CountWorkers(Table):
 
+    # looked up when first used
+    table    = TableHandle("pipe.Ingress.count_workers.count_workers")
+    register = TableHandle("pipe.Ingress.count_workers.worker_count")
+
     def __init__(self, client, bfrt_info):
         # set up base class
         super(CountWorkers, self).__init__(client, bfrt_info)
 
         self.logger = logging.getLogger('CountWorkers')
         self.logger.info("Setting up count_workers table...")
-        
-        # get this table
-        self.table    = self.bfrt_info.table_get("pipe.Ingress.count_workers.count_workers")
-        self.register = self.bfrt_info.table_get("pipe.Ingress.count_workers.worker_count")
 
         # clear and add defaults
         self.clear()
@@ -30,15 +30,12 @@ class CountWorkers(Table):
 
     def clear(self):
         # override base class method so we don't clear entries set by p4 code
-        # just clear registers
-        self.clear_registers()
-
-    def clear_registers(self):
-        # target all pipes on device 0
-        target = gc.Target(device_id=0, pipe_id=0xffff)
+        # just clear registers, in the background during startup
+        self.clear_later(self.clear_registers)
 
-        # clear all register entries
-        self.register.entry_del(target)
+    def clear_registers(self, pool_size=None, pool_base=0):
+        # clear register entries for pool slots in use, or all of them
+        self.clear_register(self.register, pool_size, pool_base)
         
         
     def add_default_entries(self):
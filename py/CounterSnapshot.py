@@ -0,0 +1,143 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import time
+
+import numpy as np
+
+
+class CounterSnapshot(object):
+    """Values of all the job's counters read at one time.
+
+    Counters are stored in NumPy arrays indexed by worker ID, queue
+    pair and pool index. Subtracting an earlier snapshot from a later
+    one gives deltas and per-second rates, so throughput can be
+    measured without clearing counters on the switch.
+    """
+
+    # per-worker counter rows
+    RX_PACKETS = 0
+    RX_BYTES   = 1
+    TX_PACKETS = 2
+    TX_BYTES   = 3
+
+    # per-queue-pair counter rows, in RDMAReceiver.get_queue_pair_counter_array order
+    QP_PACKETS             = 0
+    QP_MESSAGES            = 1
+    QP_SEQUENCE_VIOLATIONS = 2
+    QP_SIMULATED_DROPS     = 3
+
+    # per-pool-index counter rows, in NextStep.get_counter_values order
+    POOL_RECIRCULATED  = 0
+    POOL_BROADCAST     = 1
+    POOL_RETRANSMITTED = 2
+    POOL_DROPPED       = 3
+
+    def __init__(self, job, pool_size=None, max_num_workers=32, queue_pairs_per_worker=None):
+        if pool_size is None:
+            pool_size = job.pool_size_in_use
+        if queue_pairs_per_worker is None:
+            queue_pairs_per_worker = job.rdma_receiver.worker_counter_offset
+
+        self.timestamp = time.time()
+
+        # per-worker counters; UDP and RoCE workers use different tables
+        rx = job.get_worker_bitmap.get_counters()
+        rx.update(job.rdma_receiver.get_counters())
+        tx = job.set_dst_addr.get_counters()
+        tx.update(job.rdma_sender.get_counters())
+
+        self.worker_counters = np.zeros((4, max_num_workers), dtype=np.int64)
+        for worker_id, (ip, p, b) in rx.items():
+            if worker_id < max_num_workers:
+                self.worker_counters[self.RX_PACKETS, worker_id] = p
+                self.worker_counters[self.RX_BYTES, worker_id] = b
+        for worker_id, (ip, p, b) in tx.items():
+            if worker_id < max_num_workers:
+                self.worker_counters[self.TX_PACKETS, worker_id] = p
+                self.worker_counters[self.TX_BYTES, worker_id] = b
+
+        # per-queue-pair counters for RoCE workers. snapshots are
+        # taken by the telemetry thread while other threads change
+        # workers, so work from a copy
+        workers = {}
+        for worker_id, config in dict(job.rdma_sender.workers).items():
+            if worker_id < max_num_workers:
+                workers[worker_id] = min(len(config[5]), queue_pairs_per_worker)
+
+        self.queue_pair_counters = np.zeros((4, max_num_workers, queue_pairs_per_worker), dtype=np.int64)
+        offset = job.rdma_receiver.worker_counter_offset
+        ids = [worker_id * offset + qp
+               for worker_id, count in sorted(workers.items())
+               for qp in range(count)]
+        if ids:
+            ids = np.array(ids)
+            self.queue_pair_counters[:, ids // offset, ids % offset] = job.rdma_receiver.get_queue_pair_counter_array(ids)
+
+        # per-pool-index counters for the slots in use
+        self.pool_counters = np.zeros((4, pool_size), dtype=np.int64)
+        if pool_size > 0:
+            self.pool_counters[:] = job.next_step.get_counter_values(0, pool_size)
+
+        # workers present and their queue pair count
+        self.workers = dict((w, 0) for w in rx if w < max_num_workers)
+        self.workers.update(workers)
+
+    def __sub__(self, previous):
+        return self.diff(previous)
+
+    def diff(self, previous):
+        """Deltas and per-second rates from an earlier snapshot to this
+        one. Returns a dict with timestamp, interval, the workers in
+        this snapshot, and arrays of worker, queue pair and pool index
+        deltas and rates shaped like the counter arrays. Pool arrays
+        cover the pool indices both snapshots read."""
+        interval = self.timestamp - previous.timestamp
+        if interval <= 0:
+            raise ValueError("Snapshot must be taken after the one it is compared with")
+
+        # counters may be cleared between snapshots, so don't report negative deltas
+        pool_size = min(self.pool_counters.shape[1], previous.pool_counters.shape[1])
+        worker_deltas = np.maximum(self.worker_counters - previous.worker_counters, 0)
+        queue_pair_deltas = np.maximum(self.queue_pair_counters - previous.queue_pair_counters, 0)
+        pool_deltas = np.maximum(self.pool_counters[:, :pool_size] - previous.pool_counters[:, :pool_size], 0)
+
+        return {'timestamp':          self.timestamp,
+                'interval':           interval,
+                'workers':            dict(self.workers),
+                'worker_deltas':      worker_deltas,
+                'queue_pair_deltas':  queue_pair_deltas,
+                'pool_deltas':        pool_deltas,
+                'worker_rates':       worker_deltas / interval,
+                'queue_pair_rates':   queue_pair_deltas / interval,
+                'pool_rates':         pool_deltas / interval}
+
+    @classmethod
+    def print_diff(cls, diff, count=8):
+        'Print worker and queue pair rates, and pool rates for the busiest count pool indices.'
+        print("Rates over {:.3f} seconds:".format(diff['interval']))
+        w = diff['worker_rates']
+        q = diff['queue_pair_rates']
+        for worker_id, queue_pairs in sorted(diff['workers'].items()):
+            print("Worker {:2}: received {:12.1f} packets/s {:14.1f} bytes/s, sent {:12.1f} packets/s {:14.1f} bytes/s".format(
+                worker_id,
+                w[cls.RX_PACKETS, worker_id], w[cls.RX_BYTES, worker_id],
+                w[cls.TX_PACKETS, worker_id], w[cls.TX_BYTES, worker_id]))
+            for qp in range(queue_pairs):
+                print("    Queue pair {:2}: {:12.1f} packets/s {:12.1f} messages/s {:10.1f} sequence violations/s {:10.1f} simulated drops/s".format(
+                    qp,
+                    q[cls.QP_PACKETS, worker_id, qp], q[cls.QP_MESSAGES, worker_id, qp],
+                    q[cls.QP_SEQUENCE_VIOLATIONS, worker_id, qp], q[cls.QP_SIMULATED_DROPS, worker_id, qp]))
+
+        p = diff['pool_rates']
+        total = p.sum(axis=1)
+        print("Pool: {:12.1f} recirculated/s {:12.1f} broadcast/s {:12.1f} retransmitted/s {:12.1f} dropped/s".format(
+            total[cls.POOL_RECIRCULATED], total[cls.POOL_BROADCAST], total[cls.POOL_RETRANSMITTED], total[cls.POOL_DROPPED]))
+
+        busiest = np.argsort(-p.sum(axis=0), kind='mergesort')[:count]
+        for pool_index in busiest:
+            if p[:, pool_index].any():
+                print("    Pool index 0x{:04x}: {:12.1f} recirculated/s {:12.1f} broadcast/s {:12.1f} retransmitted/s {:12.1f} dropped/s".format(
+                    pool_index,
+                    p[cls.POOL_RECIRCULATED, pool_index], p[cls.POOL_BROADCAST, pool_index],
+                    p[cls.POOL_RETRANSMITTED, pool_index], p[cls.POOL_DROPPED, pool_index]))
@@ -12,9 +12,14 @@ import os
 import yaml
 import ctypes
 from itertools import chain
+import numpy as np
+import threading
+import time
 
 from Table import Table
 from Worker import Worker
+import log_decode
+import log_analyze
 
 class PacketType(IntEnum):
     MIRROR     = 0x0
@@ -55,6 +60,26 @@ class DebugLog(Table):
         self.log        = self.bfrt_info.table_get("pipe.Ingress.debug_log.log")
         self.egress_log = self.bfrt_info.table_get("pipe.Egress.debug_log.log")
 
+        # copy of the logs as of the last read, the index each pipe
+        # will write next, and the packet ID
+        # counter values at that time. this lets repeated reads fetch
+        # only new entries.
+        self.log_cache = None
+        self.log_next_index = None
+        self.log_packet_ids = None
+
+        # minimum number of entries to fetch per incremental read
+        self.log_read_chunk = 1024
+
+        # number of times a log wrapped between reads
+        self.log_overruns = 0
+
+        # the cache is shared with the capture thread
+        self.log_lock = threading.RLock()
+        self.capture_thread = None
+        self.capture_stop = threading.Event()
+        self.capture_writer = None
+
         # clear and add defaults
         self.clear()
         self.add_default_entries()
@@ -65,7 +90,7 @@ class DebugLog(Table):
         #self.clear_registers()
         pass
 
-    def clear_registers(self):
+    def clear_registers(self, pool_size=None, pool_base=0):
         #self.log.entry_del(self.target)
         pass
         
@@ -92,6 +117,14 @@ class DebugLog(Table):
         self.egress_log.operations_execute(self.target, 'Sync')
         self.egress_log.entry_del(self.target)
         self.egress_log.operations_execute(self.target, 'Sync')
+
+        # the logs are now empty, but the switch keeps writing where
+        # it left off, so keep the write indices
+        with self.log_lock:
+            if self.log_cache is not None:
+                for name in self.log_cache:
+                    self.log_cache[name][:] = 0
+                self.log_packet_ids = self.get_packet_ids()
         
     def add_default_entries(self):
         # no defaults for now
@@ -142,72 +175,223 @@ class DebugLog(Table):
 
     def get_log(self):
         print("Getting packet log entries....")
-        
-        # get all log entries
-        resp = self.log.entry_get(
-            self.target,
-            flags={"from_hw": True})
 
+        # keep only indices with a nonzero entry in some pipe
         values = {}
-        
-        for v, k in resp:
-            v = v.to_dict()
-            k = k.to_dict()
+        for name, words in self.get_log_words().items():
+            values[name] = dict((int(i), tuple(int(w) for w in words[i]))
+                                for i in np.flatnonzero(words.any(axis=1)))
+
+        return values
 
-            ##pprint((k,v))
-            # format looks like this:
-            # ({u'$REGISTER_INDEX': {'value': 22521}},
-            #  {u'Ingress.debug_log.log.addr': [0, 0, 0, 0],
-            #   u'Ingress.debug_log.log.data': [0, 0, 0, 0],
-            #   'action_name': None,
-            #   'is_default_entry': False})
-            index = k['$REGISTER_INDEX']['value']
-            addr0, addr1, addr2, addr3 = tuple(v['Ingress.debug_log.log.addr'])
-            pipe0, pipe1, pipe2, pipe3 = tuple(v['Ingress.debug_log.log.data'])
-            value0 = addr0 << 32 | pipe0
-            value1 = addr1 << 32 | pipe1
-            value2 = addr2 << 32 | pipe2
-            value3 = addr3 << 32 | pipe3
-            if value0 != 0 or value1 != 0 or value2 != 0 or value3 != 0:
-                values[index] = value0, value1, value2, value3
-
-        # get all log entries
-        egress_resp = self.egress_log.entry_get(
+    def log_tables(self):
+        return [('Ingress', self.log), ('Egress', self.egress_log)]
+
+    def get_packet_ids(self):
+        'Read the per-pipe packet ID counters.'
+        resp = self.packet_id.entry_get(
             self.target,
+            [self.packet_id.make_key([gc.KeyTuple('$REGISTER_INDEX', 0)])],
             flags={"from_hw": True})
+        for v, k in resp:
+            return np.array(v.to_dict()['Ingress.debug_packet_id.counter.f1'], dtype=np.uint32)
 
-        egress_values = {}
-        
-        for v, k in egress_resp:
+    def read_log_entries(self, name, table, indices=None):
+        """Read log entries at the given indices, or all of them if
+        indices is None. Returns the indices read and an array of log
+        words with one row per index and one column per pipe."""
+        if indices is None:
+            resp = table.entry_get(
+                self.target,
+                flags={"from_hw": True})
+        else:
+            resp = table.entry_get(
+                self.target,
+                [table.make_key([gc.KeyTuple('$REGISTER_INDEX', int(i))]) for i in indices],
+                flags={"from_hw": True})
+
+        # each entry has an address and data word for each pipe
+        read = []
+        addrs = []
+        datas = []
+        for v, k in resp:
             v = v.to_dict()
             k = k.to_dict()
+            read.append(k['$REGISTER_INDEX']['value'])
+            addrs.append(v[name + '.debug_log.log.addr'])
+            datas.append(v[name + '.debug_log.log.data'])
 
-            ##pprint((k,v))
-            # format looks like this:
-            # ({u'$REGISTER_INDEX': {'value': 22521}},
-            #  {u'Ingress.debug_log.log.addr': [0, 0, 0, 0],
-            #   u'Ingress.debug_log.log.data': [0, 0, 0, 0],
-            #   'action_name': None,
-            #   'is_default_entry': False})
-            index = k['$REGISTER_INDEX']['value']
-            addr0, addr1, addr2, addr3 = tuple(v['Egress.debug_log.log.addr'])
-            pipe0, pipe1, pipe2, pipe3 = tuple(v['Egress.debug_log.log.data'])
-            value0 = addr0 << 32 | pipe0
-            value1 = addr1 << 32 | pipe1
-            value2 = addr2 << 32 | pipe2
-            value3 = addr3 << 32 | pipe3
-            if value0 != 0 or value1 != 0 or value2 != 0 or value3 != 0:
-                egress_values[index] = value0, value1, value2, value3
-                
-        return {"Ingress": values, "Egress": egress_values}
-    
-    def save_log(self, filename='log.yaml'):
+        if not read:
+            return np.zeros(0, dtype=np.int64), np.zeros((0, log_decode.num_pipes), dtype=np.uint64)
+        return np.array(read, dtype=np.int64), log_decode.combine_words(addrs, datas)
+
+    def read_new_log_entries(self, name, table, chunk):
+        """Read entries written since the last read into the cache.
+
+        Each pipe writes its log sequentially, wrapping at the end, so
+        new entries start at the pipe's next write index. Fetch a
+        window from there, extending it until an entry matches the
+        cached copy. Returns the new entries, decoded in capture order."""
+        words = self.log_cache[name]
+        next_index = self.log_next_index[name]
+        size, pipes = words.shape
+
+        staged = np.zeros_like(words)
+        scanned = np.zeros(pipes, dtype=np.int64)
+        new = np.zeros(pipes, dtype=np.int64)
+        done = np.zeros(pipes, dtype=bool)
+        fetched = 0
+
+        while not done.all():
+            # fetch the next window for each pipe still being scanned
+            windows = {}
+            for pipe in np.flatnonzero(~done):
+                count = min(chunk, size - scanned[pipe])
+                windows[pipe] = (next_index[pipe] + scanned[pipe] + np.arange(count)) % size
+            indices = np.unique(np.concatenate(list(windows.values())))
+            read, values = self.read_log_entries(name, table, indices)
+            staged[read] = values
+            fetched = fetched + len(read)
+
+            # new entries end at the first one matching the cache
+            for pipe, window in windows.items():
+                unchanged = np.flatnonzero(staged[window, pipe] == words[window, pipe])
+                if len(unchanged):
+                    new[pipe] = scanned[pipe] + unchanged[0]
+                    done[pipe] = True
+                else:
+                    scanned[pipe] = scanned[pipe] + len(window)
+                    new[pipe] = scanned[pipe]
+                    done[pipe] = scanned[pipe] >= size
+
+        # if a whole log is new, it may have wrapped since the last read
+        if (new >= size).any():
+            self.log_overruns = self.log_overruns + 1
+            self.logger.warning("{} log wrapped between reads; entries may have been lost.".format(name))
+
+        self.logger.debug("Fetched {} indices for {} new {} log entries.".format(fetched, new.sum(), name))
+
+        records = []
+        for pipe in range(pipes):
+            window = (next_index[pipe] + np.arange(new[pipe])) % size
+            words[window, pipe] = staged[window, pipe]
+            next_index[pipe] = (next_index[pipe] + new[pipe]) % size
+
+            # zero words are entries cleared by log_clear, not new entries
+            window = window[words[window, pipe] != 0]
+            records.append(log_decode.decode_entries(words[window, pipe], window,
+                                                     np.full(len(window), pipe), log_decode.log_names.index(name)))
+
+        return np.concatenate(records)
+
+    def update_log(self, incremental=True):
+        """Bring the cached copy of both logs up to date, returning the
+        entries that are new since the last read, decoded in capture
+        order. The first read, or one with incremental unset, reads
+        and returns everything."""
+        with self.log_lock:
+            packet_ids = self.get_packet_ids()
+            records = []
+
+            if not incremental or self.log_cache is None:
+                # read everything and find where each pipe will write next
+                self.log_cache = {}
+                self.log_next_index = {}
+                for name, table in self.log_tables():
+                    read, values = self.read_log_entries(name, table)
+                    words = np.zeros((table.info.size, values.shape[1]), dtype=np.uint64)
+                    words[read] = values
+                    self.log_cache[name] = words
+                    self.log_next_index[name] = log_decode.next_write_indices(words)
+                    records.append(log_decode.decode_words(words, log_decode.log_names.index(name)))
+
+            else:
+                # no packets since the last read means no new entries
+                new_packets = packet_ids - self.log_packet_ids
+                if new_packets.any():
+                    chunk = max(self.log_read_chunk, int(new_packets.max()))
+                    for name, table in self.log_tables():
+                        records.append(self.read_new_log_entries(name, table, chunk))
+
+            self.log_packet_ids = packet_ids
+            if not records:
+                return np.zeros(0, dtype=log_decode.log_entry_dtype)
+            return np.concatenate(records)
+
+    def get_log_words(self, incremental=True):
+        """Read both logs as (size, pipes) arrays of log words.
+
+        If incremental is set and the logs have been read before, only
+        entries written since then are fetched from the switch."""
+        self.update_log(incremental)
+        with self.log_lock:
+            return dict((name, words.copy()) for name, words in self.log_cache.items())
+
+    def decode_log(self, rotate=True):
+        'Read both logs and decode them into a NumPy structured array.'
+        return log_decode.decode_log(self.get_log_words(), rotate)
+
+    def print_analysis(self):
+        'Check the current log for sequence violations and print a summary.'
+        print(log_analyze.format_report(log_analyze.analyze(self.decode_log())))
+
+    def save_log(self, filename=None):
+        # save in binary format unless a YAML file is requested
+        if not filename:
+            filename = 'debug_log.bin'
         print("Saving packet log to {}".format(filename))
-        values = self.get_log()
-        print(len(values['Ingress']) + len(values['Egress']))
-        with open(filename, 'w') as f:
-            yaml.dump(values, f)
-        
+        if os.path.splitext(filename)[1] in ['.yaml', '.yml']:
+            values = self.get_log()
+            print(len(values['Ingress']) + len(values['Egress']))
+            with open(filename, 'w') as f:
+                yaml.dump(values, f)
+        else:
+            words = self.get_log_words()
+            print(sum(int(np.count_nonzero(w.any(axis=1))) for w in words.values()))
+            log_decode.write_log_file(filename, words)
+
+    def start_capture(self, directory='.', interval=1.0, max_file_size=64 << 20, max_files=16):
+        """Poll the logs every interval seconds in the background,
+        appending new entries to rolling record files in directory."""
+        if self.capture_thread is not None:
+            self.stop_capture()
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.capture_writer = log_decode.RecordFileWriter(directory, 'debug_log', max_file_size, max_files)
+        self.capture_interval = interval
+        self.capture_stop.clear()
+        self.capture_thread = threading.Thread(target=self.capture, name='DebugLog capture')
+        self.capture_thread.daemon = True
+        self.capture_thread.start()
+        self.logger.info("Capturing debug log to {} every {} seconds.".format(directory, interval))
+
+    def stop_capture(self):
+        if self.capture_thread is not None:
+            self.capture_stop.set()
+            self.capture_thread.join()
+            self.capture_thread = None
+            self.capture_writer.close()
+            self.logger.info("Captured {} debug log entries to {} files.".format(
+                self.capture_writer.records, len(self.capture_writer.files)))
+
+    def capture(self):
+        while not self.capture_stop.is_set():
+            start = time.time()
+            try:
+                self.capture_writer.write(self.update_log())
+            except Exception:
+                self.logger.exception("Debug log capture failed")
+            self.capture_stop.wait(max(0, self.capture_interval - (time.time() - start)))
+
+    def print_capture_status(self):
+        if self.capture_thread is None:
+            print("Debug log capture is not running.")
+        else:
+            print("Captured {} entries to {} files in {}; logs wrapped between reads {} times.".format(
+                self.capture_writer.records, len(self.capture_writer.files),
+                self.capture_writer.directory, self.log_overruns))
+
     def print_log(self, start=0, end=0):
         values = self.get_log()
         
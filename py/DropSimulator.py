@@ -37,6 +37,8 @@ class DropSimulator(Table):
     def set_drop_probabilities(self, ingress_drop_probability, egress_drop_probability):
         self.ingress_drop_probability = ingress_drop_probability
         self.egress_drop_probability  = egress_drop_probability
+        if self.adopting:
+            return
         
         ingress_drop_value = int(0xffff * self.ingress_drop_probability)
         ingress_drop_actual_value = float(ingress_drop_value) / 0xffff
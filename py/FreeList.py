@@ -0,0 +1,71 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+
+class FreeList(object):
+    """Allocator for ranges of integers, like pool indices, worker IDs
+    or multicast group IDs. Free ranges are kept sorted by base and
+    merged with their neighbors when freed."""
+
+    def __init__(self, start, size):
+        self.start = start
+        self.size = size
+
+        # list of (base, size) ranges not in use, sorted by base
+        self.free_ranges = [(start, size)] if size > 0 else []
+
+        # base -> size of each range handed out
+        self.allocated = {}
+
+    def allocate(self, size, alignment=1):
+        'Return the base of the first free range of size, with base a multiple of alignment.'
+        if size <= 0:
+            raise Exception("Error: can't allocate range of size {}.".format(size))
+
+        for i, (base, free_size) in enumerate(self.free_ranges):
+            aligned = -(-base // alignment) * alignment
+            if aligned + size <= base + free_size:
+                self.take(i, aligned, size)
+                return aligned
+
+        raise Exception("Error: no free range of size {} in {}-{}; {} of {} free.".format(
+            size, self.start, self.start + self.size - 1, self.free_count(), self.size))
+
+    def reserve(self, base, size):
+        'Mark a specific range as allocated.'
+        for i, (free_base, free_size) in enumerate(self.free_ranges):
+            if free_base <= base and base + size <= free_base + free_size:
+                self.take(i, base, size)
+                return base
+
+        raise Exception("Error: range {}-{} is not free.".format(base, base + size - 1))
+
+    def take(self, i, base, size):
+        # split free range i around the allocated range
+        free_base, free_size = self.free_ranges[i]
+        pieces = [(free_base, base - free_base),
+                  (base + size, free_base + free_size - base - size)]
+        self.free_ranges[i:i+1] = [p for p in pieces if p[1] > 0]
+        self.allocated[base] = size
+
+    def free(self, base):
+        'Return the range starting at base to the free list.'
+        if base not in self.allocated:
+            raise Exception("Error: range at {} is not allocated.".format(base))
+        size = self.allocated.pop(base)
+
+        # insert in order, then merge with neighbors
+        ranges = sorted(self.free_ranges + [(base, size)])
+        merged = []
+        for b, s in ranges:
+            if merged and merged[-1][0] + merged[-1][1] == b:
+                merged[-1] = (merged[-1][0], merged[-1][1] + s)
+            else:
+                merged.append((b, s))
+        self.free_ranges = merged
+
+    def free_count(self):
+        return sum(s for b, s in self.free_ranges)
+
+    def used_count(self):
+        return sum(self.allocated.values())
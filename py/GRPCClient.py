@@ -2,22 +2,24 @@
 # Licensed under the MIT License.
 
 import logging
+import argparse
 from pprint import pprint, pformat
+from concurrent import futures
 
 import grpc
 
 import SwitchML_pb2
 import SwitchML_pb2_grpc
 
-def run_test():
+def run_test(job_size=1, bulk=False):
     #with grpc.insecure_channel('127.0.0.1:50099') as channel:
     with grpc.insecure_channel('localhost:50099') as channel:
         stub = SwitchML_pb2_grpc.RDMAServerStub(channel)
         print("Sending request")
 
-        job_size = 1
+        requests = []
         for rank in range(job_size):
-            response = stub.RDMAConnect(SwitchML_pb2.RDMAConnectRequest(
+            requests.append(SwitchML_pb2.RDMAConnectRequest(
                 job_id = 12345,
                 my_rank = rank,
                 job_size = job_size,
@@ -28,10 +30,23 @@ def run_test():
                 qpns = [1, 2, 3, 4, 5],
                 psns = [6, 7, 8, 9, 0]
             ))
+
+        if bulk:
+            # register all ranks with one call
+            response = stub.RDMAConnectBulk(SwitchML_pb2.RDMAConnectBulkRequest(
+                requests = requests))
             print("GRPC client received:\n{}".format(pformat(response)))
+        else:
+            # the server replies once all ranks have connected, so
+            # send each rank's request from its own thread
+            with futures.ThreadPoolExecutor(max_workers=job_size) as executor:
+                for response in executor.map(stub.RDMAConnect, requests):
+                    print("GRPC client received:\n{}".format(pformat(response)))
 
 if __name__ == '__main__':
     logging.basicConfig()
-    run_test()
-            
-
+    argparser = argparse.ArgumentParser(description="SwitchML RDMA server test client.")
+    argparser.add_argument('--job_size', type=int, default=1, help='Number of ranks to connect')
+    argparser.add_argument('--bulk', default=False, action='store_true', help='Connect all ranks with one RDMAConnectBulk call')
+    args = argparser.parse_args()
+    run_test(args.job_size, args.bulk)
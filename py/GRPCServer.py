@@ -4,6 +4,8 @@
 import logging
 from pprint import pprint, pformat
 from concurrent import futures
+import threading
+import Queue
 import grpc
 import ipaddress
 
@@ -13,24 +15,163 @@ import SwitchML_pb2_grpc
 #from Worker import Worker
 
 
+class PendingJob(object):
+    """Connect requests received so far for one job_id."""
+
+    def __init__(self, job_id, job_size):
+        self.job_id = job_id
+        self.job_size = job_size
+
+        # requests indexed by rank
+        self.requests = {}
+
+        # filled in by the writer thread
+        self.responses = {}
+        self.error = None
+        self.done = threading.Event()
+
+
 class GRPCServer(SwitchML_pb2_grpc.RDMAServerServicer):
 
-    def __init__(self, ip = '[::]', port = 50099):
-        # limit concurrency to 1 to avoid synchronization problems in the BF-RT interface
-        self.server = grpc.server(futures.ThreadPoolExecutor(max_workers=1))
+    # largest job the switch supports
+    max_job_size = 32
+
+    def __init__(self, ip = '[::]', port = 50099, max_waiting_connects = 64, max_streams = 8, spare_threads = 8):
+        self.logger = logging.getLogger('GRPCServer')
+
+        # requests are accepted concurrently. each connect call holds
+        # a thread until its job is programmed, and each counter
+        # stream holds one while it runs, so both are limited and the
+        # pool has threads for all of them plus some to spare, so
+        # calls beyond the limits are always answered with an error
+        # instead of waiting for a thread. switch programming is done
+        # only by the writer thread below to avoid synchronization
+        # problems in the BF-RT interface.
+        self.connect_slots = threading.BoundedSemaphore(max_waiting_connects)
+        self.stream_slots = threading.BoundedSemaphore(max_streams)
+        self.server = grpc.server(futures.ThreadPoolExecutor(
+            max_workers=max_waiting_connects + max_streams + spare_threads))
         SwitchML_pb2_grpc.add_RDMAServerServicer_to_server(self, self.server)
         self.server.add_insecure_port('{}:{}'.format(ip, port))
 
-        #def 
+        # jobs still waiting for ranks, indexed by job_id
+        self.lock = threading.Lock()
+        self.pending = {}
+
+        # complete jobs waiting to be programmed
+        self.queue = Queue.Queue()
+        self.writer = threading.Thread(target=self.write_jobs, name='GRPCServer writer')
+        self.writer.daemon = True
+
+        self.job = None
 
     def serve(self, job):
-        self.server.start()
         self.job = job
-        
+
+        # standalone, requests are echoed back and nothing is programmed
+        if job is not None:
+            self.writer.start()
+        self.server.start()
+
     def wait(self):
         if self.server:
             self.server.wait_for_termination()
-        
+
+    def write_jobs(self):
+        # the server starts before the job has set up its tables, and
+        # registers are still cleared in the background after that;
+        # don't program jobs until that's done
+        self.job.ready.wait()
+
+        # program one complete job at a time
+        while True:
+            pending = self.queue.get()
+            try:
+                # take turns with the CLI changing the switch
+                with self.job.lock:
+                    self.program_job(pending)
+            except Exception as e:
+                self.logger.exception("Programming job {} failed".format(pending.job_id))
+                pending.error = e
+            pending.done.set()
+
+    def program_job(self, pending):
+        requests = [pending.requests[rank] for rank in sorted(pending.requests)]
+        if self.job.job_manager is not None:
+            # give this job its own part of the switch
+            logical_job = self.job.job_manager.job_connect_roce(
+                pending.job_id, [self.worker_args(r) for r in requests])
+            for r in requests:
+                pending.responses[r.my_rank] = self.connect_response(
+                    r, logical_job.worker_id(r.my_rank), logical_job.pool_base, logical_job.pool_size)
+        else:
+            self.job.worker_reconcile_roce([self.worker_args(r) for r in requests])
+            for r in requests:
+                pending.responses[r.my_rank] = self.connect_response(r)
+
+    def connect(self, requests, context):
+        # check the requests, then join their job if a slot is free
+        job_id = requests[0].job_id
+        job_size = requests[0].job_size
+        if not 0 < job_size <= self.max_job_size:
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT,
+                          "Job size must be between 1 and {}, not {}".format(self.max_job_size, job_size))
+        for request in requests:
+            if request.job_id != job_id or request.job_size != job_size:
+                context.abort(grpc.StatusCode.INVALID_ARGUMENT,
+                              "All requests must have the same job_id and job_size")
+            if not 0 <= request.my_rank < job_size:
+                context.abort(grpc.StatusCode.INVALID_ARGUMENT,
+                              "Rank {} is outside job of size {}".format(request.my_rank, job_size))
+
+        if not self.connect_slots.acquire(False):
+            context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED,
+                          "Too many connect requests waiting for their jobs; try again later")
+        try:
+            return self.join_job(requests, context)
+        finally:
+            self.connect_slots.release()
+
+    def join_job(self, requests, context):
+        # add these requests to their job, and queue the job for
+        # programming once all its ranks have arrived
+        job_id = requests[0].job_id
+        job_size = requests[0].job_size
+        with self.lock:
+            pending = self.pending.get(job_id)
+            if pending is None:
+                pending = PendingJob(job_id, job_size)
+                self.pending[job_id] = pending
+            elif pending.job_size != job_size:
+                context.abort(grpc.StatusCode.INVALID_ARGUMENT,
+                              "Job {} already has size {}".format(job_id, pending.job_size))
+
+            for request in requests:
+                if request.my_rank in pending.requests:
+                    self.logger.warning("Rank {} of job {} connected again; using latest request.".format(
+                        request.my_rank, job_id))
+                pending.requests[request.my_rank] = request
+
+            self.logger.info("Job {} has {} of {} ranks.".format(job_id, len(pending.requests), job_size))
+            if len(pending.requests) == job_size:
+                del self.pending[job_id]
+                self.queue.put(pending)
+
+        # wait for job to be programmed, giving up if the client does
+        while not pending.done.wait(1.0):
+            if not context.is_active():
+                with self.lock:
+                    if self.pending.get(job_id) is pending:
+                        for request in requests:
+                            pending.requests.pop(request.my_rank, None)
+                return None
+
+        if pending.error is not None:
+            context.abort(grpc.StatusCode.INTERNAL,
+                          "Switch programming failed: {}".format(pending.error))
+
+        return [pending.responses[request.my_rank] for request in requests]
+
     def RDMAConnect(self, request, context):
         print("Got request:\n{}\n from rank {} mac {} with context:\n{}".format(
             pformat(request),
@@ -38,79 +179,13 @@ class GRPCServer(SwitchML_pb2_grpc.RDMAServerServicer):
             hex(request.mac),
             pformat(context)))
 
-        # convert to mac string
-        mac_hex = "{:012x}".format(request.mac)
-        mac_str = ':'.join(mac_hex[i:i+2] for i in range(0, len(mac_hex), 2))
-        
-        # convert to IP string
-        ipv4_str = ipaddress.ip_address(request.ipv4).__str__()
-        pprint(ipv4_str)
-        
         if self.job:
-            if request.my_rank == 0:
-                # if this is the first message, clear out old worker state
-                # first. workers must synchronize to ensure this happens
-                # before remaining worker requests are sent.
-                self.job.worker_clear_all()
-                
-            # now add new worker.
-            self.job.worker_add_roce(request.my_rank,
-                                     request.job_size,
-                                     mac_str,
-                                     ipv4_str,
-                                     request.rkey,
-                                     request.packet_size,
-                                     request.message_size,
-                                     zip(request.qpns, request.psns))
-            
-            # form response
-            response = SwitchML_pb2.RDMAConnectResponse(
-                # switch address
-                macs  = [int(self.job.switch_mac.replace(':', ''), 16)],
-                ipv4s = [int(ipaddress.ip_address(unicode(self.job.switch_ip)))],
-                
-                # mirror this worker's rkey, since the switch doesn't care
-                rkeys = [request.rkey],
-                
-                # Switch QPNs are used for two purposes:
-                # 1. Indexing into the PSN registers
-                # 2. Differentiating between processes running on the same server
-                # 
-                # Additionally, there are two restrictions:
-                #
-                # 1. In order to make debugging easier, we should
-                # avoid QPN 0 (sometimes used for management) and QPN
-                # 0xffffff (sometimes used for multicast) because
-                # Wireshark decodes them improperly, even when the NIC
-                # treats them properly.
-                #
-                # 2. Due to the way the switch sends aggregated
-                # packets that are part of a message, only one message
-                # should be in flight at a time on a given QPN to
-                # avoid reordering packets. The clients will take care
-                # of this as long as we give them as many QPNs as they
-                # give us.
-                #
-                # Thus, we construct QPNs as follows.
-                # - Bit 23 is always 1. This ensures we avoid QPN 0.
-                # - Bits 22 through 16 are the rank of the
-                #   client. Since we only support 32 clients per
-                #   aggregation in the current design, we will never
-                #   use QPN 0xffffff.
-                # - Bits 15 through 0 are just the index of the queue;
-                #   if 4 queues are requested, these bits will
-                #   represent 0, 1, 2, and 3.
-                #
-                # So if a client with rank 3 sends us a request with 4
-                # QPNs, we will reply with QPNs 0x830000, 0x830001,
-                # 0x830002, and 0x830003.
-                qpns  = [0x800000 | (request.my_rank << 16) | i
-                         for i, qpn in enumerate(request.qpns)],
-                
-                # initial QPNs don't matter; they're overwritten by each _FIRST or _ONLY packet.
-                psns  = [i for i, qpn in enumerate(request.qpns)])
-            
-            return response
+            # wait until all ranks of this job have connected and
+            # the whole job has been programmed
+            responses = self.connect([request], context)
+            if responses is None:
+                return SwitchML_pb2.RDMAConnectResponse(job_id = request.job_id)
+            return responses[0]
 
         else:
             return SwitchML_pb2.RDMAConnectResponse(
@@ -118,13 +193,164 @@ class GRPCServer(SwitchML_pb2_grpc.RDMAServerServicer):
                 macs = [request.mac],
                 ipv4s = [request.ipv4],
                 rkeys = [request.rkey])
-                
-    
+
+    def RDMAConnectBulk(self, request, context):
+        print("Got bulk request for ranks {}".format(
+            [r.my_rank for r in request.requests]))
+
+        if not request.requests:
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT, "Bulk request has no ranks")
+
+        if self.job:
+            # these ranks join their job like individual requests,
+            # so the job is still programmed in one pass
+            responses = self.connect(list(request.requests), context)
+            if responses is None:
+                return SwitchML_pb2.RDMAConnectBulkResponse()
+            return SwitchML_pb2.RDMAConnectBulkResponse(responses = responses)
+
+        else:
+            return SwitchML_pb2.RDMAConnectBulkResponse(
+                responses = [SwitchML_pb2.RDMAConnectResponse(
+                    job_id = r.job_id,
+                    macs = [r.mac],
+                    ipv4s = [r.ipv4],
+                    rkeys = [r.rkey]) for r in request.requests])
+
+    def StreamCounters(self, request, context):
+        if not self.job:
+            context.abort(grpc.StatusCode.UNAVAILABLE, "No job is running")
+
+        if not self.stream_slots.acquire(False):
+            context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, "Too many counter streams")
+        try:
+            # start background sampling if it isn't already running
+            self.job.started.wait()
+            telemetry = self.job.telemetry_start()
+
+            sent = 0
+            seen = telemetry.samples
+            last_timestamp = 0
+            while context.is_active():
+                seen = telemetry.wait_for_sample(seen, 1.0)
+                rates = telemetry.rates()
+                if rates is None or rates['timestamp'] < last_timestamp + request.interval:
+                    continue
+                last_timestamp = rates['timestamp']
+
+                yield self.counter_sample(telemetry, rates)
+
+                sent = sent + 1
+                if request.count and sent >= request.count:
+                    break
+        finally:
+            self.stream_slots.release()
+
+    def counter_sample(self, telemetry, rates):
+        w = rates['worker_rates']
+        q = rates['queue_pair_rates']
+        p = rates['pool_rates']
+        return SwitchML_pb2.CounterSample(
+            timestamp = rates['timestamp'],
+            interval = rates['interval'],
+            workers = [SwitchML_pb2.WorkerRates(
+                worker_id = worker_id,
+                rx_packets = w[telemetry.RX_PACKETS, worker_id],
+                rx_bytes = w[telemetry.RX_BYTES, worker_id],
+                tx_packets = w[telemetry.TX_PACKETS, worker_id],
+                tx_bytes = w[telemetry.TX_BYTES, worker_id])
+                       for worker_id in sorted(rates['workers'])],
+            queue_pairs = [SwitchML_pb2.QueuePairRates(
+                worker_id = worker_id,
+                queue_pair = qp,
+                packets = q[telemetry.QP_PACKETS, worker_id, qp],
+                messages = q[telemetry.QP_MESSAGES, worker_id, qp],
+                sequence_violations = q[telemetry.QP_SEQUENCE_VIOLATIONS, worker_id, qp])
+                           for worker_id, count in sorted(rates['workers'].items())
+                           for qp in range(count)],
+            pool = SwitchML_pb2.PoolRates(
+                recirculated = p[telemetry.POOL_RECIRCULATED],
+                broadcast = p[telemetry.POOL_BROADCAST],
+                retransmitted = p[telemetry.POOL_RETRANSMITTED],
+                dropped = p[telemetry.POOL_DROPPED]))
+
+    def worker_args(self, request):
+        # convert to mac string
+        mac_hex = "{:012x}".format(request.mac)
+        mac_str = ':'.join(mac_hex[i:i+2] for i in range(0, len(mac_hex), 2))
+
+        # convert to IP string
+        ipv4_str = ipaddress.ip_address(request.ipv4).__str__()
+
+        return dict(worker_rank = request.my_rank,
+                    worker_count = request.job_size,
+                    worker_mac = mac_str,
+                    worker_ip = ipv4_str,
+                    worker_rkey = request.rkey,
+                    worker_packet_size = request.packet_size,
+                    worker_message_size = request.message_size,
+                    worker_qpns_and_psns = zip(request.qpns, request.psns))
+
+    def connect_response(self, request, worker_id=None, pool_base=0, pool_size=0):
+        if worker_id is None:
+            worker_id = request.my_rank
+
+        return SwitchML_pb2.RDMAConnectResponse(
+            job_id = request.job_id,
+
+            # pool slice for this job when the switch is shared; 0 size means the whole pool
+            pool_base = pool_base,
+            pool_size = pool_size,
+
+            # switch address
+            macs  = [int(self.job.switch_mac.replace(':', ''), 16)],
+            ipv4s = [int(ipaddress.ip_address(unicode(self.job.switch_ip)))],
+
+            # mirror this worker's rkey, since the switch doesn't care
+            rkeys = [request.rkey],
+
+            # Switch QPNs are used for two purposes:
+            # 1. Indexing into the PSN registers
+            # 2. Differentiating between processes running on the same server
+            #
+            # Additionally, there are two restrictions:
+            #
+            # 1. In order to make debugging easier, we should
+            # avoid QPN 0 (sometimes used for management) and QPN
+            # 0xffffff (sometimes used for multicast) because
+            # Wireshark decodes them improperly, even when the NIC
+            # treats them properly.
+            #
+            # 2. Due to the way the switch sends aggregated
+            # packets that are part of a message, only one message
+            # should be in flight at a time on a given QPN to
+            # avoid reordering packets. The clients will take care
+            # of this as long as we give them as many QPNs as they
+            # give us.
+            #
+            # Thus, we construct QPNs as follows.
+            # - Bit 23 is always 1. This ensures we avoid QPN 0.
+            # - Bits 22 through 16 are the worker ID of the
+            #   client, which is its rank unless several jobs share
+            #   the switch. Since we only support 32 clients in the
+            #   current design, we will never use QPN 0xffffff.
+            # - Bits 15 through 0 are just the index of the queue;
+            #   if 4 queues are requested, these bits will
+            #   represent 0, 1, 2, and 3.
+            #
+            # So if a client with rank 3 sends us a request with 4
+            # QPNs, we will reply with QPNs 0x830000, 0x830001,
+            # 0x830002, and 0x830003.
+            qpns  = [0x800000 | (worker_id << 16) | i
+                     for i, qpn in enumerate(request.qpns)],
+
+            # initial QPNs don't matter; they're overwritten by each _FIRST or _ONLY packet.
+            psns  = [i for i, qpn in enumerate(request.qpns)])
+
+
 
 if __name__ == '__main__':
     logging.basicConfig()
     grpc_server = GRPCServer()
     grpc_server.serve(None)
     grpc_server.wait()
-            
-
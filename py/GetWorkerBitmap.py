@@ -53,17 +53,14 @@ class GetWorkerBitmap(Table):
                       match_priority, switch_mgid, pool_base, pool_size):
         self.logger.info("Adding worker {} {}".format(worker_mac, worker_ip))
 
-        # target all pipes on device 0
-        target = gc.Target(device_id=0, pipe_id=0xffff)
-
         # if IP address is all zeros, don't use
         if worker_ip == '0.0.0.0':
             worker_ip_mask = self.all_zeros_ip_address
         else:
             worker_ip_mask = self.all_ones_ip_address
             
-        self.table.entry_add(
-            target,
+        self.add_entries(
+            self.table,
             [self.table.make_key([gc.KeyTuple('$MATCH_PRIORITY', match_priority),
                                   # match on Ethernet addrs, IPs and port
                                   gc.KeyTuple('hdr.ipv4.src_addr',
@@ -112,12 +109,23 @@ class GetWorkerBitmap(Table):
                              'Ingress.get_worker_bitmap.set_bitmap')])
 
 
-    def print_counters(self):
+    # Remove all UDP entries for a worker
+    def del_udp_entry(self, worker_id):
+        self.logger.info("Removing worker {}".format(worker_id))
+        keys = [key for key, data in self.shadow_entries(self.table).values()
+                if data.to_dict().get('worker_id') == worker_id]
+        if keys:
+            self.del_entries(self.table, keys)
+
+
+    # Returns a dict of worker id -> (worker ip, packets, bytes)
+    def get_counters(self):
         self.table.operations_execute(self.target, 'SyncCounters')
         resp = self.table.entry_get(
             self.target,
             flags={"from_hw": False})
 
+        counters = {}
         for v, k in resp:
             v = v.to_dict()
             k = k.to_dict()
@@ -126,33 +134,20 @@ class GetWorkerBitmap(Table):
             worker_id = v['worker_id']
             worker_packets = v['$COUNTER_SPEC_PKTS']
             worker_bytes = v['$COUNTER_SPEC_BYTES']
-
-            print("Received from worker {:2} at {:15}: {:10} packets, {:10} bytes".format(worker_id, worker_ip, worker_packets, worker_bytes))
             #print("key {}: value {}".format(pformat(k), pformat(v)))
 
-    def clear_counters(self):
-        self.logger.info("Clearing get_worker_bitmap counters...")
-        self.table.operations_execute(self.target, 'SyncCounters')
-        resp = self.table.entry_get(
-            self.target,
-            flags={"from_hw": False})
-
-        keys = []
-        values = []
-        
-        for v, k in resp:
-            keys.append(k)
+            if worker_id in counters:
+                ip, packets, bytes = counters[worker_id]
+                counters[worker_id] = ip, packets + worker_packets, bytes + worker_bytes
+            else:
+                counters[worker_id] = worker_ip, worker_packets, worker_bytes
 
-            v = v.to_dict()
-            k = k.to_dict()
+        return counters
 
-            values.append(
-                self.table.make_data(
-                    [gc.DataTuple('$COUNTER_SPEC_BYTES', 0),
-                     gc.DataTuple('$COUNTER_SPEC_PKTS', 0)],
-                    v['action_name']))
+    def print_counters(self):
+        for worker_id, (worker_ip, worker_packets, worker_bytes) in sorted(self.get_counters().items()):
+            print("Received from worker {:2} at {:15}: {:10} packets, {:10} bytes".format(worker_id, worker_ip, worker_packets, worker_bytes))
 
-        self.table.entry_mod(
-            self.target,
-            keys,
-            values)
+    def clear_counters(self):
+        self.logger.info("Clearing get_worker_bitmap counters...")
+        self.clear_direct_counters(self.table)
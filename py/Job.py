@@ -11,10 +11,13 @@ import os
 import signal
 import yaml
 import time
+import threading
 import traceback
 import readline
 from cmd import Cmd
 from concurrent import futures
+from contextlib import contextmanager
+from timeit import default_timer as timer
 import re
 
 # import table definitions
@@ -37,6 +40,9 @@ from NextStep import NextStep
 from Mirror import Mirror
 from DropSimulator import DropSimulator
 from DebugLog import DebugLog
+from Table import Table, WriteBatch
+from JobManager import JobManager
+from locking import locked
 
 # import RPC server
 from GRPCServer import GRPCServer
@@ -48,6 +54,9 @@ class Job(Cmd, object):
     mac_address_re = ':'.join([hex_digit_pair_re] * 6)
     ipv4_address_re = '[0-9]+\.[0-9]+\.[0-9]+\.[0-9]+'
 
+    # bump when the state file format changes
+    state_version = 1
+
     #
     # command interface helpers
     #
@@ -79,6 +88,11 @@ class Job(Cmd, object):
             executor.shutdown()
             
 
+    def onecmd(self, line):
+        # commands take turns with RPCs that change the switch
+        with self.lock:
+            return super(Job, self).onecmd(line)
+
     def emptyline(self):
         'Do nothing when empty line entered at command prompt.'
         pass
@@ -142,7 +156,7 @@ class Job(Cmd, object):
         self.debug_log.print_log()
 
     def do_log_save(self, arg):
-        'Save log of recent packets to file.'
+        'Save log of recent packets to file. Saves in binary format to debug_log.bin by default; use a .yaml filename for YAML.'
         
         self.debug_log.save_log(arg)
 
@@ -151,13 +165,55 @@ class Job(Cmd, object):
         
         self.debug_log.clear_log()
 
-            
+    def do_log_analyze(self, arg):
+        'Check log of recent packets for sequence violations and summarize retransmissions.'
+        try:
+            self.debug_log.print_analysis()
+        except Exception as e:
+            print "Oops: {}".format(traceback.format_exc())
+
+    def do_log_capture_start(self, arg):
+        'Continuously capture log of recent packets to rolling files. Optionally specify directory, polling interval in seconds, maximum file size in MB, and maximum number of files.'
+        try:
+            args = arg.split()
+            directory     = args[0] if len(args) > 0 else 'debug_log'
+            interval      = float(args[1]) if len(args) > 1 else 1.0
+            max_file_size = int(float(args[2]) * (1 << 20)) if len(args) > 2 else 64 << 20
+            max_files     = int(args[3]) if len(args) > 3 else 16
+            self.debug_log.start_capture(directory, interval, max_file_size, max_files)
+        except Exception as e:
+            print "Oops: {}".format(traceback.format_exc())
+
+    def do_log_capture_stop(self, arg):
+        'Stop capturing log of recent packets.'
+        self.debug_log.stop_capture()
+
+    def do_log_capture_status(self, arg):
+        'Show status of log capture.'
+        self.debug_log.print_capture_status()
+
+
     def do_bitmaps_weirdness_search(self, arg):
         'Show any bitmaps where both sets are nonzero.'
         
         if self.update_and_check_worker_bitmap is not None:
             self.update_and_check_worker_bitmap.show_weird_bitmaps()
 
+    def do_bitmaps_analyze(self, arg):
+        'Summarize slot occupancy and missing workers from the bitmaps, and find slots stuck across snapshots. Optionally specify number of snapshots (default 2) and seconds between them (default 1).'
+        try:
+            args = arg.split()
+            snapshots = int(args[0]) if len(args) > 0 else 2
+            interval  = float(args[1]) if len(args) > 1 else 1.0
+
+            complete_bitmap = self.complete_worker_bitmap()
+            if not complete_bitmap:
+                print "No workers configured."
+                return
+            self.update_and_check_worker_bitmap.show_analysis(complete_bitmap, snapshots, interval)
+        except Exception as e:
+            print "Oops: {}".format(traceback.format_exc())
+
     def do_get_counters(self, arg):
         'Show counters. For pool index counters, we show the first 16 slots by default. You can specify a count or a starting index and count.'
 
@@ -211,11 +267,66 @@ class Job(Cmd, object):
         self.rdma_receiver.get_queue_pair_counters(start, count)
                 
         
+    def do_telemetry_start(self, arg):
+        'Start sampling counters in the background. Optionally specify the interval in seconds.'
+        try:
+            interval = float(arg) if arg else None
+            if self.telemetry is not None and interval is not None:
+                self.telemetry_stop()
+            self.telemetry_start(interval)
+        except Exception as e:
+            print "Oops: {}".format(traceback.format_exc())
+
+    def do_telemetry_stop(self, arg):
+        'Stop sampling counters in the background.'
+        self.telemetry_stop()
+
+    def do_telemetry_show(self, arg):
+        'Show counter rates from the two most recent background samples.'
+        if self.telemetry is None:
+            print("Telemetry is not running; use telemetry_start.")
+        else:
+            self.telemetry.print_rates()
+
+    def do_counter_rates(self, arg):
+        'Show counter rates since the last counter_rates command without clearing counters. Optionally specify a number of seconds to measure over instead, and the number of busiest pool indices to show.'
+        try:
+            args = arg.split()
+            seconds = float(args[0]) if len(args) > 0 else 0
+            count   = int(args[1]) if len(args) > 1 else 8
+
+            previous = self.counter_snapshot
+            if seconds > 0:
+                previous = self.get_counter_snapshot()
+                time.sleep(seconds)
+            self.counter_snapshot = self.get_counter_snapshot()
+
+            if previous is None:
+                print("Saved counter snapshot; run counter_rates again to see rates.")
+            else:
+                self.counter_snapshot.print_diff(self.counter_snapshot - previous, count)
+        except Exception as e:
+            print "Oops: {}".format(traceback.format_exc())
+
+    def do_verify_shadow(self, arg):
+        'Compare the table entries the controller installed with the entries on the switch.'
+        try:
+            problems = self.verify_shadow()
+            for name, key, problem in problems:
+                print("{}: {}: {}".format(name, key, problem))
+            print("Found {} differences.".format(len(problems)))
+        except Exception as e:
+            print "Oops: {}".format(traceback.format_exc())
+
     def do_clear_counters(self, arg):
         'Clear counters.'
         self.clear_counters()
         self.port_clear_counters()
 
+    def do_startup_profile(self, arg):
+        'Show how long each stage of controller startup took, and whether the background clears are done.'
+        print(self.format_startup_profile())
+
     def do_timing_loop(self, arg):
         'Time table updates.'
         self.non_switchml_forward.timing_loop()
@@ -534,6 +645,59 @@ class Job(Cmd, object):
         'Remove worker. Usage: worker_del <worker id>'
         self.worker_del(int(arg, 0))
 
+    #
+    # logical jobs sharing the switch
+    #
+
+    def do_job_create(self, arg):
+        'Create a logical job with its own multicast group, worker IDs and pool slice. Usage: job_create <job id> <total number of workers> <pool size>'
+        try:
+            result = arg.split()
+            print(self.get_job_manager().job_create(int(result[0], 0), int(result[1], 0), int(result[2], 0)))
+        except Exception as e:
+            print("Error: {}".format(traceback.format_exc()))
+            print("Usage:\n   {}".format(self.do_job_create.__doc__))
+
+    def do_job_remove(self, arg):
+        'Remove a logical job and its workers, and free its resources. Usage: job_remove <job id>'
+        try:
+            self.get_job_manager().job_remove(int(arg, 0))
+        except Exception as e:
+            print("Error: {}".format(traceback.format_exc()))
+            print("Usage:\n   {}".format(self.do_job_remove.__doc__))
+
+    def do_job_list(self, arg):
+        'List logical jobs and free resources.'
+        try:
+            self.get_job_manager().print_jobs()
+        except Exception as e:
+            print "Oops: {}".format(traceback.format_exc())
+
+    def do_job_pool_stats(self, arg):
+        'Show how much of the pool logical jobs are using.'
+        try:
+            pprint(self.get_job_manager().pool.stats())
+        except Exception as e:
+            print "Oops: {}".format(traceback.format_exc())
+
+    def do_job_pool_compact(self, arg):
+        'Move pool slices of logical jobs without workers to merge free space.'
+        try:
+            moves = self.get_job_manager().compact()
+            print("Moved {} slices.".format(len(moves)))
+            print(self.get_job_manager().pool.format_stats())
+        except Exception as e:
+            print "Oops: {}".format(traceback.format_exc())
+
+    def do_job_worker_add_udp(self, arg):
+        'Add a UDP SwitchML worker to a logical job. Usage: job_worker_add_udp <job id> <worker rank> <MAC address> <IP address>'
+        try:
+            result = arg.split()
+            self.get_job_manager().worker_add_udp(int(result[0], 0), int(result[1], 0), result[2], result[3])
+        except Exception as e:
+            print("Error: {}".format(traceback.format_exc()))
+            print("Usage:\n   {}".format(self.do_job_worker_add_udp.__doc__))
+
     #
     # drop simulator
     #
@@ -555,6 +719,7 @@ class Job(Cmd, object):
 
             print("Setting drop probabilities. Ingress: {} Egress: {}".format(ingress_drop_probability, egress_drop_probability))
             self.drop_simulator.set_drop_probabilities(ingress_drop_probability, egress_drop_probability)
+            self.state_save()
 
         except Exception as e:
             print("Error: {}".format(traceback.format_exc()))
@@ -569,10 +734,57 @@ class Job(Cmd, object):
     # state management for job
     #
 
-    def clear_registers(self):
-        for x in self.registers_to_clear:
-            x.clear_registers()
-
+    @locked
+    def clear_registers(self, pool_size=None, pool_base=0):
+        # each register is cleared with its own RPC, so clear them
+        # concurrently; total time approaches that of the slowest one.
+        # if pool_size is given, clear only that many pool indices
+        # starting at pool_base.
+        def clear(x):
+            start = timer()
+            x.clear_registers(pool_size, pool_base)
+            return timer() - start
+
+        start = timer()
+        with futures.ThreadPoolExecutor(max_workers=self.register_clear_threads) as executor:
+            times = list(executor.map(clear, self.registers_to_clear))
+        end = timer()
+
+        self.register_clear_times = [(self.register_name(x), t) for x, t in zip(self.registers_to_clear, times)]
+        for name, t in self.register_clear_times:
+            self.logger.debug("Cleared {} in {} seconds.".format(name, t))
+
+        if self.register_clear_times:
+            slowest_name, slowest_time = max(self.register_clear_times, key=lambda x: x[1])
+            self.logger.info("Cleared {} registers in {} seconds with {} threads; slowest was {} at {} seconds.".format(
+                len(times), end - start, self.register_clear_threads, slowest_name, slowest_time))
+
+    @locked
+    def telemetry_start(self, interval=None):
+        # start background counter sampling if it isn't already running
+        if self.telemetry is None:
+            from Telemetry import Telemetry
+            self.telemetry = Telemetry(self, interval or self.telemetry_interval or 1.0)
+        self.telemetry.start()
+        return self.telemetry
+
+    def get_counter_snapshot(self, pool_size=None):
+        # read all counters at once, for rates without clearing them
+        from CounterSnapshot import CounterSnapshot
+        return CounterSnapshot(self, pool_size)
+
+    def telemetry_stop(self):
+        if self.telemetry is not None:
+            self.telemetry.stop()
+            self.telemetry = None
+
+    def register_name(self, x):
+        register = getattr(x, 'register', None)
+        if register is not None:
+            return register.info.name_get()
+        return type(x).__name__
+
+    @locked
     def clear_counters(self):
         for x in self.counters_to_clear:
             try:
@@ -580,51 +792,238 @@ class Job(Cmd, object):
             except Exception as e:
                 print("Oops: {}".format(traceback.format_exc()))
 
+    # Compare the entries each table object thinks it installed with
+    # the switch. Returns a list of (table name, key, problem) tuples.
+    def verify_shadow(self):
+        problems = []
+        for x in self.tables_to_verify:
+            problems.extend(x.verify_shadow())
+        return problems
+
+    @locked
     def clear_all(self):
         # clear_registers()
         # clear_counters()
         for x in self.tables_to_clear:
             x.clear()
 
+    # Collect worker table writes made inside a with block and send
+    # them as a few bulk RPCs when the block exits. Nested blocks
+    # join the outermost batch, so wrapping a loop of worker adds
+    # programs the whole job at once. The batch is shared by every
+    # table, so the job lock is held for the whole block; other
+    # threads can't add to it or see it.
+    @contextmanager
+    def write_batch(self):
+        with self.lock:
+            if self.batch is not None:
+                yield self.batch
+                return
+
+            self.batch = WriteBatch(gc.Target(device_id=0, pipe_id=0xffff))
+            for x in self.tables_to_batch:
+                x.batch = self.batch
+
+            try:
+                yield self.batch
+                self.batch.flush()
+            finally:
+                for x in self.tables_to_batch:
+                    x.batch = None
+                self.batch = None
+
+    #
+    # saved state, for warm restarts
+    #
+
+    def state(self):
+        'Return the configuration the controller has programmed, as a dict the state file can hold.'
+        return {'version':            self.state_version,
+                'switch_mac':         self.switch_mac,
+                'switch_ip':          self.switch_ip,
+                'ports':              [list(self.ports.port_settings[dev_port])
+                                       for dev_port in sorted(self.ports.port_settings)],
+                'macs':               dict((mac, list(port))
+                                           for mac, port in self.non_switchml_forward.mac_addresses.items()),
+                'drop_probabilities': [self.drop_simulator.ingress_drop_probability,
+                                       self.drop_simulator.egress_drop_probability],
+                'udp_workers':        self.udp_workers,
+                'roce_workers':       self.roce_workers,
+                'pool_size_in_use':   self.pool_size_in_use,
+                'jobs':               self.job_manager.state() if self.job_manager is not None else []}
+
+    @locked
+    def state_save(self):
+        # write the state file after every change, replacing it
+        # atomically so a crash never leaves half of one
+        if self.state_file is None or Table.adopting:
+            return
+
+        # inside a batch, save once its writes are sent
+        if self.batch is not None:
+            self.batch.defer(self.state_save)
+            return
+
+        try:
+            temp_filename = self.state_file + '.tmp'
+            with open(temp_filename, 'w') as f:
+                yaml.safe_dump(self.state(), f, default_flow_style=False)
+            os.rename(temp_filename, self.state_file)
+        except Exception as e:
+            self.logger.warning("Couldn't write state file {}: {}".format(self.state_file, e))
+
+    def state_load(self):
+        if self.state_file is None or not os.path.exists(self.state_file):
+            self.logger.info("No state file to restart from; starting from scratch.")
+            return None
+
+        try:
+            with open(self.state_file) as f:
+                state = yaml.safe_load(f)
+        except Exception as e:
+            self.logger.warning("Couldn't read state file {}: {}".format(self.state_file, e))
+            return None
+
+        if not state or state.get('version') != self.state_version:
+            self.logger.warning("State file {} is empty or from a different version; ignoring.".format(self.state_file))
+            return None
+        return state
+
+    @locked
+    def state_restore(self, state):
+        # ports and MAC addresses first, since workers are found by MAC
+        with self.write_batch():
+            for front_panel_port, lane, speed, fec in state['ports']:
+                self.port_add(front_panel_port, lane, speed, fec)
+            for mac, (front_panel_port, lane) in sorted(state['macs'].items()):
+                self.mac_address_add(mac, front_panel_port, lane)
+
+        self.drop_simulator.set_drop_probabilities(*state['drop_probabilities'])
+
+        # logical jobs' groups must exist before their workers are added
+        if state['jobs']:
+            self.get_job_manager().restore(state['jobs'])
+
+        with self.write_batch():
+            for worker_rid, args in sorted(state['udp_workers'].items()):
+                self.worker_add_udp(**args)
+            for worker_rid, args in sorted(state['roce_workers'].items()):
+                args = dict(args, worker_qpns_and_psns=[tuple(x) for x in args['worker_qpns_and_psns']])
+                self.worker_add_roce(**args)
+
+        self.pool_size_in_use = state['pool_size_in_use']
+
+    # Compare the switch with the controller's state: table shadows,
+    # multicast groups and nodes, and ports, with about one read per
+    # table. Returns a list of (table name, key, problem) tuples.
+    def state_check(self):
+        problems = self.verify_shadow()
+        problems.extend(self.pre.verify())
+        problems.extend(self.ports.verify())
+        return problems
+
+    # While adopting, table objects update their local state as usual
+    # but nothing is written to the switch.
+    @contextmanager
+    def adopting(self):
+        Table.adopting = True
+        Ports.adopting = True
+        try:
+            yield
+        finally:
+            Table.adopting = False
+            Ports.adopting = False
+
+    def adopt(self, state):
+        """Take over a running switch after a warm restart: create the
+        table objects and replay the saved state without writing
+        anything, then check that the switch matches. Returns False,
+        leaving the switch to be reprogrammed, if it doesn't."""
+        if (state['switch_mac'], state['switch_ip']) != (self.switch_mac, self.switch_ip):
+            self.logger.warning("State file is for switch address {} {}, not {} {}; reprogramming switch.".format(
+                state['switch_mac'], state['switch_ip'], self.switch_mac, self.switch_ip))
+            return False
+
+        start = timer()
+        try:
+            with self.adopting():
+                self.create_blocks()
+                self.state_restore(state)
+                if self.switch_mac and self.switch_ip:
+                    self.arp_and_icmp.add_switch_mac_and_ip(self.switch_mac, self.switch_ip)
+            problems = self.state_check()
+        except Exception as e:
+            problems = [('state', self.state_file, "couldn't restore: {}".format(e))]
+        end = timer()
+
+        if problems:
+            for name, key, problem in problems:
+                self.logger.warning("{}: {}: {}".format(name, key, problem))
+            self.logger.warning("Switch doesn't match state file in {} places; reprogramming switch.".format(len(problems)))
+
+            # the mirror session isn't cleared with the tables, so
+            # remove it before it's added again
+            if getattr(self, 'mirror', None) is not None:
+                self.mirror.clear()
+            return False
+
+        self.logger.info("Adopted switch state from {} in {} seconds.".format(self.state_file, end - start))
+        return True
+
 
                 
 
+    @locked
     def mac_address_add(self, mac, port, lane):
         self.non_switchml_forward.worker_add(mac, port, lane)
+        self.state_save()
     
+    @locked
     def mac_address_del(self, mac):
         self.non_switchml_forward.worker_del(mac)
+        self.state_save()
     
     def mac_address_list(self, mac):
         self.non_switchml_forward.worker_print(mac)
     
+    @locked
     def mac_address_clear_all(self):
         self.non_switchml_forward.worker_clear_all(mac)
 
 
     
     
+    @locked
     def port_add(self, port, lane, speed, fec):
         self.ports.port_add(port, lane, speed, fec)
         dev_port = self.ports.get_dev_port(port, lane)
         self.pre.worker_add(self.all_ports_mgid, 0x8000 + dev_port, port, lane)
+        self.state_save()
 
+    @locked
     def port_del(self, port, lane):
         self.ports.port_delete(port, lane)
         dev_port = self.ports.get_dev_port(port, lane)
         self.pre.worker_del(self.all_ports_mgid, 0x8000 + dev_port)
+        self.state_save()
 
+    @locked
     def port_clear_all(self):
         self.ports.delete_all_ports()
         self.pre.worker_clear_all(self.all_ports_mgid)
+        self.state_save()
 
+    @locked
     def port_clear_counters(self):
         self.ports.clear_counters()
 
+    @locked
     def port_load_file(self, ports_file):
         with open(ports_file) as f:
             ports = yaml.safe_load(f)
-            
+
+        # write the all-ports multicast group once for the whole file
+        with self.write_batch():
             for dev_port, v in ports['switch']['forward'].items():
                 
                 # get front panel port from dev port in file
@@ -646,97 +1045,293 @@ class Job(Cmd, object):
                 mac = v['mac']
                 self.mac_address_add(mac, fp_port, fp_lane)
     
+    # worker_id, mgid and the pool slice default to those of the
+    # single job; JobManager passes its own for each logical job.
+    @locked
     def worker_add_udp(self,
                        worker_rank, worker_count,
-                       worker_mac, worker_ip):
+                       worker_mac, worker_ip,
+                       worker_id=None, mgid=None, pool_base=0, pool_size=22528):
         
         if worker_count > 32:
             print("Current design supports only 32 SwitchML workers per job; you requested {}".format(worker_count))
             return
 
-        worker_rid = worker_rank
+        worker_rid = worker_rank if worker_id is None else worker_id
         worker_mask = 1 << worker_rank
         worker_type = WorkerType.SWITCHML_UDP
-
-        # add to ingress pipeline
-        self.get_worker_bitmap.add_udp_entry(
-            # destination address for packets
-            self.switch_mac,
-            self.switch_ip,
-            self.switch_udp_port,
-            self.switch_udp_port_mask,
+        if mgid is None:
+            mgid = self.switchml_workers_mgid
+
+        # queue all table writes for this worker and send them together
+        with self.write_batch():
+            # add to ingress pipeline
+            self.get_worker_bitmap.add_udp_entry(
+                # destination address for packets
+                self.switch_mac,
+                self.switch_ip,
+                self.switch_udp_port,
+                self.switch_udp_port_mask,
             
-            # worker info
-            worker_rid,
-            worker_mac,
-            worker_ip,
-            worker_mask,
+                # worker info
+                worker_rid,
+                worker_mac,
+                worker_ip,
+                worker_mask,
             
-            # total number of workers
-            worker_count,
+                # total number of workers
+                worker_count,
             
-            # match priority. TODO: remove, since it's not important
-            10,
+                # match priority. TODO: remove, since it's not important
+                10,
             
-            # multicast group for switchml
-            self.switchml_workers_mgid,
+                # multicast group for switchml
+                mgid,
             
-            # pool base and size. TODO: fix when supported by design
-            0, 22528)
+                # pool base and size
+                pool_base, pool_size)
         
-        # add to multicast group
-        port, lane = self.non_switchml_forward.worker_port_get(worker_mac)
-        self.pre.worker_add(self.switchml_workers_mgid, worker_rid, port, lane)
+            # add to multicast group
+            port, lane = self.non_switchml_forward.worker_port_get(worker_mac)
+            self.pre.worker_add(mgid, worker_rid, port, lane)
         
-        # add to egress pipeline
-        self.set_dst_addr.add_udp_entry(worker_rid, worker_mac, worker_ip)
+            # add to egress pipeline
+            self.set_dst_addr.add_udp_entry(worker_rid, worker_mac, worker_ip)
+
+        # the default pool size is larger than the pool index counters
+        self.pool_size_in_use = max(self.pool_size_in_use,
+                                    min(pool_base + pool_size, self.next_step.broadcast_counter.info.size))
+
+        self.udp_workers[worker_rid] = {'worker_rank':  worker_rank,
+                                        'worker_count': worker_count,
+                                        'worker_mac':   worker_mac,
+                                        'worker_ip':    worker_ip,
+                                        'worker_id':    worker_rid,
+                                        'mgid':         mgid,
+                                        'pool_base':    pool_base,
+                                        'pool_size':    pool_size}
+        self.state_save()
 
 
     # add a ROCEv2 worker.
     # worker_qpns_and_psns is a list of qpn, psn tuples
+    @locked
     def worker_add_roce(self,
                         worker_rank, worker_count,
                         worker_mac, worker_ip, worker_rkey,
                         worker_packet_size, worker_message_size,
-                        worker_qpns_and_psns):
+                        worker_qpns_and_psns,
+                        worker_id=None, mgid=None, pool_base=0):
 
         if worker_count > 32:
             print("Current design supports only 32 SwitchML workers per job; you requested {}".format(worker_count))
             return
 
-        worker_rid = worker_rank
+        worker_rid = worker_rank if worker_id is None else worker_id
         worker_mask = 1 << worker_rank
         worker_type = WorkerType.SWITCHML_UDP
+        if mgid is None:
+            mgid = self.switchml_workers_mgid
+
+        # queue all table writes for this worker and send them together
+        with self.write_batch():
+            # add to ingress pipeline
+            self.rdma_receiver.add_entry(
+                # destination address for packets
+                self.switch_mac,
+                self.switch_ip,
+                self.switch_partition_key,
+                mgid,
+
+                # worker info
+                worker_ip,
+                worker_rid,
+                worker_mask,
+                worker_packet_size,
+
+                # total number of workers
+                worker_count)
+
+            # add to multicast group
+            port, lane = self.non_switchml_forward.worker_port_get(worker_mac)
+            self.pre.worker_add(mgid, worker_rid, port, lane)
+
+            pprint(worker_mac)
+            pprint(worker_ip)
+            pprint(worker_qpns_and_psns)
+        
+            # add to egress pipeline
+            self.rdma_sender.add_write_worker(worker_rid, worker_mac, worker_ip, worker_rkey,
+                                              worker_packet_size, worker_message_size,
+                                              worker_qpns_and_psns, pool_base)
+
+        # remember how much of the pool this job may touch
+        self.pool_size_in_use = max(self.pool_size_in_use,
+                                    pool_base + self.rdma_sender.pool_size(worker_packet_size, worker_message_size,
+                                                                           len(worker_qpns_and_psns)))
+
+        self.roce_workers[worker_rid] = self.roce_worker_args(worker_rank, worker_count,
+                                                              worker_mac, worker_ip, worker_rkey,
+                                                              worker_packet_size, worker_message_size,
+                                                              worker_qpns_and_psns,
+                                                              worker_rid, mgid, pool_base)
+        self.state_save()
+
+    # arguments of worker_add_roce for a worker, in a form the state file can hold
+    def roce_worker_args(self,
+                         worker_rank, worker_count,
+                         worker_mac, worker_ip, worker_rkey,
+                         worker_packet_size, worker_message_size,
+                         worker_qpns_and_psns,
+                         worker_id, mgid, pool_base):
+        return {'worker_rank':          worker_rank,
+                'worker_count':         worker_count,
+                'worker_mac':           worker_mac,
+                'worker_ip':            worker_ip,
+                'worker_rkey':          worker_rkey,
+                'worker_packet_size':   int(worker_packet_size),
+                'worker_message_size':  worker_message_size,
+                'worker_qpns_and_psns': [[qpn, psn] for qpn, psn in worker_qpns_and_psns],
+                'worker_id':            worker_id,
+                'mgid':                 mgid,
+                'pool_base':            pool_base}
+
+
+    # Prepare for a new job of worker_count ROCEv2 workers without
+    # tearing down the old one: remove RoCE workers beyond the new
+    # job size and all UDP workers of the single job, then clear
+    # counters and only the pool slots the previous job used. The
+    # remaining workers are then brought up to date with
+    # worker_update_roce, which only writes entries that changed.
+    # Workers of logical jobs from the job manager are left alone.
+    @locked
+    def worker_reconfigure_roce(self, worker_count):
+        start = timer()
+
+        with self.write_batch():
+            for worker_rid in sorted(self.rdma_receiver.workers.keys()):
+                if worker_rid >= worker_count:
+                    self.rdma_receiver.del_entry(worker_rid)
+            for worker_rid in sorted(self.rdma_sender.workers.keys()):
+                if worker_rid >= worker_count:
+                    self.rdma_sender.del_write_worker(worker_rid)
+            for worker_rid in sorted(self.pre.rids[self.switchml_workers_mgid]):
+                if worker_rid >= worker_count:
+                    self.pre.worker_del(self.switchml_workers_mgid, worker_rid)
+            for worker_rid in sorted(self.roce_workers.keys()):
+                if worker_rid >= worker_count:
+                    del self.roce_workers[worker_rid]
+            for worker_rid, args in sorted(self.udp_workers.items()):
+                if args['mgid'] == self.switchml_workers_mgid:
+                    self.get_worker_bitmap.del_udp_entry(worker_rid)
+                    self.set_dst_addr.del_udp_entry(worker_rid)
+                    self.pre.worker_del(self.switchml_workers_mgid, worker_rid)
+                    del self.udp_workers[worker_rid]
+
+        # clear aggregation state left by the previous job, only once
+        # the stale workers' entries are gone so they can't write to
+        # the cleared registers. inside an outer batch, the deletes
+        # above are only queued, so clear after it's flushed.
+        pool_size_in_use = self.pool_size_in_use
+        def clear():
+            self.clear_registers(pool_size_in_use)
+            self.clear_counters()
+            self.drop_simulator.clear()
+            self.debug_log.clear_log()
+        if self.batch is not None:
+            self.batch.defer(clear)
+        else:
+            clear()
+        self.pool_size_in_use = 0
+        self.state_save()
+
+        end = timer()
+        self.logger.info("Reconfigured for {} workers in {} seconds.".format(worker_count, end - start))
+
+
+    # Like worker_add_roce, but leaves the worker's entries alone if
+    # they already match, and modifies only changed entries otherwise.
+    @locked
+    def worker_update_roce(self,
+                           worker_rank, worker_count,
+                           worker_mac, worker_ip, worker_rkey,
+                           worker_packet_size, worker_message_size,
+                           worker_qpns_and_psns,
+                           worker_id=None, mgid=None, pool_base=0):
 
-        # add to ingress pipeline
-        self.rdma_receiver.add_entry(
-            # destination address for packets
-            self.switch_mac,
-            self.switch_ip,
-            self.switch_partition_key,
-            self.switchml_workers_mgid,
+        if worker_count > 32:
+            print("Current design supports only 32 SwitchML workers per job; you requested {}".format(worker_count))
+            return
 
-            # worker info
-            worker_ip,
-            worker_rid,
-            worker_mask,
-            worker_packet_size,
+        worker_rid = worker_rank if worker_id is None else worker_id
+        worker_mask = 1 << worker_rank
+        if mgid is None:
+            mgid = self.switchml_workers_mgid
+
+        # queue all table writes for this worker and send them together
+        with self.write_batch():
+            receiver_changed = self.rdma_receiver.update_entry(
+                # destination address for packets
+                self.switch_mac,
+                self.switch_ip,
+                self.switch_partition_key,
+                mgid,
+
+                # worker info
+                worker_ip,
+                worker_rid,
+                worker_mask,
+                worker_packet_size,
+
+                # total number of workers
+                worker_count)
+
+            port, lane = self.non_switchml_forward.worker_port_get(worker_mac)
+            pre_changed = self.pre.worker_update(mgid, worker_rid, port, lane)
+
+            sender_changed = self.rdma_sender.update_write_worker(worker_rid, worker_mac, worker_ip, worker_rkey,
+                                                                  worker_packet_size, worker_message_size,
+                                                                  worker_qpns_and_psns, pool_base)
+
+        if not (receiver_changed or pre_changed or sender_changed):
+            self.logger.info("Worker {} unchanged.".format(worker_rank))
+
+        self.pool_size_in_use = max(self.pool_size_in_use,
+                                    pool_base + self.rdma_sender.pool_size(worker_packet_size, worker_message_size,
+                                                                           len(worker_qpns_and_psns)))
+
+        self.roce_workers[worker_rid] = self.roce_worker_args(worker_rank, worker_count,
+                                                              worker_mac, worker_ip, worker_rkey,
+                                                              worker_packet_size, worker_message_size,
+                                                              worker_qpns_and_psns,
+                                                              worker_rid, mgid, pool_base)
+        self.state_save()
+
+
+    # Reconcile the switch with a complete set of ROCEv2 workers.
+    # workers is a list of dicts with worker_update_roce's arguments.
+    @locked
+    def worker_reconcile_roce(self, workers):
+        # remove stale workers and clear registers before the batch,
+        # so the clears follow the deletes
+        self.worker_reconfigure_roce(len(workers))
+        with self.write_batch():
+            for worker in workers:
+                self.worker_update_roce(**worker)
 
-            # total number of workers
-            worker_count)
+    
+    def get_job_manager(self):
+        if self.job_manager is None:
+            raise Exception("Error: multiple jobs not enabled; start with --multi_job.")
+        return self.job_manager
 
-        # add to multicast group
-        port, lane = self.non_switchml_forward.worker_port_get(worker_mac)
-        self.pre.worker_add(self.switchml_workers_mgid, worker_rid, port, lane)
 
-        pprint(worker_mac)
-        pprint(worker_ip)
-        pprint(worker_qpns_and_psns)
-        
-        # add to egress pipeline
-        self.rdma_sender.add_write_worker(worker_rid, worker_mac, worker_ip, worker_rkey,
-                                          worker_packet_size, worker_message_size,
-                                          worker_qpns_and_psns)
+    # bitmap a slot has when all workers in the job have contributed
+    def complete_worker_bitmap(self):
+        complete_bitmap = 0
+        for worker_rid in self.pre.rids[self.switchml_workers_mgid]:
+            complete_bitmap |= 1 << worker_rid
+        return complete_bitmap
 
     
     def worker_del(self):
@@ -750,15 +1345,24 @@ class Job(Cmd, object):
         self.rdma_sender.print_counters()
 
 
+    @locked
     def worker_clear_all(self):
         self.get_worker_bitmap.clear()
         self.rdma_receiver.clear()
         self.clear_registers()
+        self.pool_size_in_use = 0
         self.clear_counters()
         self.pre.worker_clear_all(self.switchml_workers_mgid)
         self.set_dst_addr.clear_udp_entries()
         self.rdma_sender.clear_workers()
         self.drop_simulator.clear()
+        self.udp_workers = {}
+        self.roce_workers = {}
+
+        # the logical jobs' workers are gone too, so remove the jobs
+        if self.job_manager is not None:
+            self.job_manager.clear()
+        self.state_save()
 
         self.debug_log.clear_log()
         #self.debug_log.clear_log()
@@ -766,6 +1370,7 @@ class Job(Cmd, object):
         #self.debug_log.clear_log()
         #self.debug_log.clear_log()
 
+    @locked
     def worker_load_file(self, filename):
         # clear out previous job
         self.worker_clear_all()
@@ -778,19 +1383,21 @@ class Job(Cmd, object):
             # are we using the dev_port list format?
             if 'workers_ports' in switchml:
                 ports = job['switch']['switchML']['workers_ports']
-                for i, dev_port in enumerate(ports):
-                    fp_port, fp_lane = self.ports.get_fp_port(dev_port)            
-                    macs = self.non_switchml_forward.get_macs_on_port(fp_port, fp_lane)
-
-                    if not macs:
-                        print("Port {}/{} (dev_port {}) not currently configured.".format(fp_port, fp_lane, dev_port))
-                        return
+                # send all workers' entries in one batch
+                with self.write_batch():
+                    for i, dev_port in enumerate(ports):
+                        fp_port, fp_lane = self.ports.get_fp_port(dev_port)            
+                        macs = self.non_switchml_forward.get_macs_on_port(fp_port, fp_lane)
+
+                        if not macs:
+                            print("Port {}/{} (dev_port {}) not currently configured.".format(fp_port, fp_lane, dev_port))
+                            return
                     
-                    # assume we only have one mac per port
-                    mac = macs[0]
+                        # assume we only have one mac per port
+                        mac = macs[0]
 
-                    # add with no IP
-                    self.worker_add_udp(i, len(ports), mac, '0.0.0.0')
+                        # add with no IP
+                        self.worker_add_udp(i, len(ports), mac, '0.0.0.0')
                     
 
     def get_workers_from_files(self, ports_file, job_file):
@@ -831,10 +1438,13 @@ class Job(Cmd, object):
 
     def __init__(self, gc, bfrt_info,
                  switch_ip, switch_mac, switch_udp_port=0xbee0, switch_udp_port_mask=0xfff0,
-                 workers=None, ports_file=None, job_file=None):
+                 workers=None, ports_file=None, job_file=None, serve_grpc=True,
+                 register_clear_threads=8, telemetry_interval=0, port_map_cache=None,
+                 multi_job=False, state_file=None, warm_restart=False):
         
         # call Cmd constructor
         super(Job, self).__init__()
+        self.logger = logging.getLogger('Job')
         self.intro = "SwitchML command loop. Use 'help' or '?' to list commands."
         self.prompt = "-> "
 
@@ -842,9 +1452,20 @@ class Job(Cmd, object):
         self.gc = gc
         self.bfrt_info = bfrt_info
 
-        # set up RPC server
-        self.grpc_server = GRPCServer()
+        # time spent in each stage of startup, and events set once
+        # the block objects exist and once the background clears finish
+        self.startup_start = timer()
+        self.startup_times = []
+        self.started = threading.Event()
+        self.ready = threading.Event()
 
+        # held while changing tables or job state, since the CLI and
+        # RPC threads both do
+        self.lock = threading.RLock()
+
+        # set up RPC server, unless running in-process (e.g., offline)
+        self.grpc_server = None
+        self.serve_grpc = serve_grpc
 
         # self.thrift_connection = ThriftInterface('switchml', '127.0.0.1')
         # self.thrift_client = self.thrift_connection.setup()
@@ -856,9 +1477,8 @@ class Job(Cmd, object):
 
 
         
-        # set up ports object
-        self.ports = Ports(self.gc, self.bfrt_info)
-        self.ports.enable_loopback_ports()
+        # file to cache the port map in
+        self.port_map_cache = port_map_cache
         
         # capture job state
         self.switch_mac = switch_mac
@@ -874,24 +1494,160 @@ class Job(Cmd, object):
         self.switchml_workers_mgid = 0x1234
         self.all_ports_mgid = 0x1235
 
+        # number of registers to clear concurrently, and the time
+        # each took the last time they were cleared
+        self.register_clear_threads = register_clear_threads
+        self.register_clear_times = []
+
+        # number of pool indices used since registers were last cleared
+        self.pool_size_in_use = 0
+
+        # batch of pending table writes, if any
+        self.batch = None
+
+        # background counter sampling; started on demand if interval is 0
+        self.telemetry = None
+        self.telemetry_interval = telemetry_interval
+
+        # most recent snapshot taken by counter_rates
+        self.counter_snapshot = None
+
+        # logical jobs sharing the switch; set up once tables exist
+        self.multi_job = multi_job
+        self.job_manager = None
+
+        # file the configuration is saved to after every change
+        self.state_file = state_file
+
+        # start listening for RPCs right away; connect requests are
+        # held until the tables are set up and cleared
+        if self.serve_grpc:
+            with self.startup_stage('grpc'):
+                self.grpc_server = GRPCServer()
+                self.grpc_server.serve(self)
+
+        # whole-register clears and counter pre-fills are collected
+        # while the blocks are created and run in the background after
+        Table.startup_clears = []
+        try:
+            # on a warm restart, adopt what's on the switch if it matches
+            # the saved state; otherwise clear the switch and program it
+            saved_state = self.state_load() if warm_restart else None
+            adopted = False
+            if saved_state is not None:
+                with self.startup_stage('adopt'):
+                    adopted = self.adopt(saved_state)
+
+            if not adopted:
+                with self.startup_stage('blocks'):
+                    self.create_blocks()
+
+                with self.startup_stage('configure'):
+                    if saved_state is not None:
+                        self.state_restore(saved_state)
+                    # If list of worker objects isn't provided, expect to load worker info from yaml files
+                    elif self.workers:
+                        with self.write_batch():
+                            for worker in self.workers:
+                                self.port_add(worker.front_panel_port, worker.lane, worker.speed, worker.fec)
+                                self.mac_address_add(worker.mac, worker.front_panel_port, worker.lane)
+                    elif ports_file:
+                        self.port_load_file(ports_file)
+
+                    if self.switch_mac and self.switch_ip:
+                        self.arp_and_icmp.add_switch_mac_and_ip(self.switch_mac, self.switch_ip)
+
+            self.state_save()
+        finally:
+            startup_clears = Table.startup_clears
+            Table.startup_clears = None
+
+        self.started.set()
+        self.logger.info("Started in {:.3f} seconds.".format(timer() - self.startup_start))
+        self.startup_clear(startup_clears)
+
+        # start sampling counters if requested
+        if self.telemetry_interval > 0:
+            self.telemetry_start(self.telemetry_interval)
+
+
+    @contextmanager
+    def startup_stage(self, name):
+        # record how long a stage of startup takes
+        start = timer()
+        try:
+            yield
+        finally:
+            self.startup_times.append((name, timer() - start))
+
+    def startup_clear(self, clears):
+        # run the clears collected during startup in a background
+        # thread, concurrently like clear_registers, and set ready
+        # when they're done
+        def run():
+            try:
+                with self.startup_stage('clears'):
+                    with futures.ThreadPoolExecutor(max_workers=self.register_clear_threads) as executor:
+                        pending = [executor.submit(function, *args) for function, args in clears]
+                        for f in pending:
+                            try:
+                                f.result()
+                            except Exception:
+                                self.logger.exception("Clear at startup failed")
+            finally:
+                self.ready_time = timer() - self.startup_start
+                self.ready.set()
+                self.logger.info(self.format_startup_profile())
+
+        if not clears:
+            run()
+            return
+
+        thread = threading.Thread(target=run, name='Job startup clears')
+        thread.daemon = True
+        thread.start()
+
+    def wait_ready(self, timeout=None):
+        'Wait for the background clears started at startup to finish. Returns True if they have.'
+        return self.ready.wait(timeout)
+
+    def format_startup_profile(self):
+        stages = ', '.join('{} {:.3f}s'.format(name, t) for name, t in self.startup_times)
+        if self.ready.is_set():
+            return "Startup: {}; ready after {:.3f} seconds.".format(stages, self.ready_time)
+        return "Startup: {}; still clearing in the background.".format(stages)
+
+    # create objects for each block, clearing the tables they use
+    # unless adopting the switch's state
+    def create_blocks(self):
+        # set up ports object
+        self.ports = Ports(self.gc, self.bfrt_info, self.port_map_cache)
+        self.ports.enable_loopback_ports()
+
         # allocate storage
         self.registers_to_clear = []
         self.tables_to_clear    = []
         self.counters_to_clear = []
+        self.tables_to_batch = []
+        self.tables_to_verify = []
+
+        # arguments each worker was added with, indexed by worker ID
+        self.udp_workers = {}
+        self.roce_workers = {}
 
-        #
-        # create objects for each block
-        #
-        
         self.arp_and_icmp = ARPandICMP(self.gc, self.bfrt_info)
         
         self.get_worker_bitmap = GetWorkerBitmap(self.gc, self.bfrt_info)
         self.tables_to_clear.append(self.get_worker_bitmap)
         self.counters_to_clear.append(self.get_worker_bitmap)
+        self.tables_to_batch.append(self.get_worker_bitmap)
+        self.tables_to_verify.append(self.get_worker_bitmap)
 
         self.rdma_receiver = RDMAReceiver(self.gc, self.bfrt_info)
         self.tables_to_clear.append(self.rdma_receiver)
         self.counters_to_clear.append(self.rdma_receiver)
+        self.tables_to_batch.append(self.rdma_receiver)
+        self.tables_to_verify.append(self.rdma_receiver)
 
         # add update rules for bitmap and clear register
         self.update_and_check_worker_bitmap = UpdateAndCheckWorkerBitmap(self.gc, self.bfrt_info)
@@ -934,6 +1690,7 @@ class Job(Cmd, object):
         self.pre = PRE(self.gc, self.bfrt_info, self.ports,
                        self.switchml_workers_mgid, self.all_ports_mgid,
                        self.cpu_port)
+        self.tables_to_batch.append(self.pre)
 
         self.mirror = Mirror(self.gc, self.bfrt_info, self.cpu_port)
 
@@ -952,11 +1709,14 @@ class Job(Cmd, object):
         
         # add workers to non-switchml forwarding table
         self.non_switchml_forward = NonSwitchMLForward(self.gc, self.bfrt_info, self.ports, self.all_ports_mgid)
+        self.tables_to_verify.append(self.non_switchml_forward)
 
         # now add workers to set_dst_addr table in egress
         self.set_dst_addr = SetDstAddr(self.gc, self.bfrt_info, self.switch_mac, self.switch_ip)
         self.tables_to_clear.append(self.set_dst_addr)
         self.counters_to_clear.append(self.set_dst_addr)
+        self.tables_to_batch.append(self.set_dst_addr)
+        self.tables_to_verify.append(self.set_dst_addr)
 
         self.rdma_sender = RDMASender(self.gc, self.bfrt_info,
                                       self.switch_mac, self.switch_ip)
@@ -966,24 +1726,11 @@ class Job(Cmd, object):
                                       #packet_size = 256)
         self.tables_to_clear.append(self.rdma_sender)
         self.counters_to_clear.append(self.rdma_sender)
+        self.tables_to_batch.append(self.rdma_sender)
+        self.tables_to_verify.append(self.rdma_sender)
 
         # do this last to print more cleanly
         self.counters_to_clear.append(self.next_step)
 
-        # # configure job
-        # self.configure_job()
-
-        # If list of worker objects isn't provided, expect to load worker info from yaml files
-        if self.workers:
-            for worker in self.workers:
-                self.port_add(worker.front_panel_port, worker.lane, worker.speed, worker.fec)
-                self.mac_address_add(worker.mac, worker.front_panel_port, worker.lane)
-        elif ports_file:
-            self.port_load_file(ports_file)
-
-        if self.switch_mac and self.switch_ip:
-            self.arp_and_icmp.add_switch_mac_and_ip(self.switch_mac, self.switch_ip)
-
-            
-        # start listening for RPCs
-        self.grpc_server.serve(self)
+        if self.multi_job:
+            self.job_manager = JobManager(self)
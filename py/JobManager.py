@@ -0,0 +1,285 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import logging
+
+from FreeList import FreeList
+from PoolAllocator import PoolAllocator
+from locking import locked
+
+
+class LogicalJob(object):
+    """Switch resources assigned to one of several jobs sharing the
+    switch: a multicast group, a range of worker IDs, and a slice of
+    the pool."""
+
+    def __init__(self, job_id, worker_count, mgid, worker_base, pool_base, pool_size):
+        self.job_id = job_id
+        self.worker_count = worker_count
+        self.mgid = mgid
+        self.worker_base = worker_base
+        self.pool_base = pool_base
+        self.pool_size = pool_size
+
+        # worker type of each rank added so far
+        self.workers = {}
+
+    def worker_id(self, worker_rank):
+        return self.worker_base + worker_rank
+
+    def __str__(self):
+        return "Job {}: {} workers at IDs {}-{}, multicast group 0x{:x}, pool indices 0x{:04x}-0x{:04x}, {} workers added".format(
+            self.job_id, self.worker_count,
+            self.worker_base, self.worker_base + self.worker_count - 1,
+            self.mgid, self.pool_base, self.pool_base + self.pool_size - 1,
+            len(self.workers))
+
+
+class JobManager(object):
+    """Runs several jobs on the switch at once. Each logical job gets
+    its own multicast group, worker IDs and pool slice from free
+    lists, so jobs don't share slots or receive each other's
+    results. Worker bitmaps are still indexed by rank within each
+    job, since slots are never shared."""
+
+    def __init__(self, job, max_jobs=32, max_num_workers=32, pool_size=None):
+        self.logger = logging.getLogger('JobManager')
+
+        self.job = job
+
+        # share the job's lock, since jobs change the job's tables
+        self.lock = job.lock
+
+        # multicast groups start after the single-job and all-ports groups
+        self.mgids = FreeList(max(job.switchml_workers_mgid, job.all_ports_mgid) + 1, max_jobs)
+        self.worker_ids = FreeList(0, max_num_workers)
+
+        # pool indices, including both sets of each slot
+        if pool_size is None:
+            pool_size = job.next_step.broadcast_counter.info.size
+        self.pool = PoolAllocator(pool_size)
+
+        # logical jobs indexed by job ID
+        self.jobs = {}
+
+    @locked
+    def job_create(self, job_id, worker_count, pool_size):
+        if job_id in self.jobs:
+            raise Exception("Error: job {} already exists.".format(job_id))
+        if worker_count > 32:
+            raise Exception("Error: current design supports only 32 SwitchML workers per job; you requested {}.".format(worker_count))
+
+        # take resources from each free list, returning them if a later one is full
+        allocated = []
+        try:
+            mgid = self.mgids.allocate(1)
+            allocated.append((self.mgids, mgid))
+            worker_base = self.worker_ids.allocate(worker_count)
+            allocated.append((self.worker_ids, worker_base))
+            pool_base = self.pool.allocate(pool_size)
+            allocated.append((self.pool, pool_base))
+        except Exception:
+            for free_list, base in allocated:
+                free_list.free(base)
+            raise
+
+        logical_job = LogicalJob(job_id, worker_count, mgid, worker_base, pool_base, pool_size)
+        self.job.pre.group_add(mgid)
+        self.jobs[job_id] = logical_job
+        self.job.state_save()
+
+        self.logger.info("Created {}".format(logical_job))
+        return logical_job
+
+    @locked
+    def job_create_roce(self, job_id, worker_count, packet_size, message_size, num_queue_pairs):
+        'Create a job with a pool slice sized for its RoCE workers.'
+        return self.job_create(job_id, worker_count,
+                               self.job.rdma_sender.pool_size(packet_size, message_size, num_queue_pairs))
+
+    @locked
+    def job_remove(self, job_id):
+        if job_id not in self.jobs:
+            raise Exception("Error: job {} doesn't exist.".format(job_id))
+        logical_job = self.jobs[job_id]
+
+        # remove workers and the job's group together
+        with self.job.write_batch():
+            for worker_rank in sorted(logical_job.workers):
+                self.worker_remove(logical_job, worker_rank)
+            self.job.pre.group_del(logical_job.mgid)
+
+        # leave the slice clean for the next job that gets it
+        self.job.clear_registers(logical_job.pool_size, logical_job.pool_base)
+
+        # forget the job only once it's gone from the switch
+        del self.jobs[job_id]
+        self.release(logical_job)
+        self.logger.info("Removed job {}".format(job_id))
+
+        self.compact()
+
+    def release(self, logical_job):
+        # return a removed job's resources to the free lists
+        self.mgids.free(logical_job.mgid)
+        self.worker_ids.free(logical_job.worker_base)
+        self.pool.free(logical_job.pool_base)
+
+    @locked
+    def clear(self):
+        """Remove every job's multicast group and release its
+        resources. Used by Job.worker_clear_all, which has already
+        removed the jobs' workers and cleared the registers."""
+        with self.job.write_batch():
+            for job_id in sorted(self.jobs):
+                self.job.pre.group_del(self.jobs[job_id].mgid)
+
+        for job_id in sorted(self.jobs):
+            self.release(self.jobs.pop(job_id))
+        self.logger.info("Removed all jobs")
+
+    @locked
+    def compact(self):
+        """Move the pool slices of jobs that have no workers yet to
+        merge free space. Workers address pool indices directly, so
+        slices of jobs with workers stay put; RoCE jobs get a new slice
+        if they reconnect with a different size."""
+        movable = dict((j.pool_base, j) for j in self.jobs.values() if not j.workers)
+        moves = self.pool.compact(movable)
+        for old_base, new_base in sorted(moves.items()):
+            logical_job = movable[old_base]
+            logical_job.pool_base = new_base
+            self.logger.info("Moved job {} from pool index 0x{:04x} to 0x{:04x}".format(
+                logical_job.job_id, old_base, new_base))
+        self.logger.info(self.pool.format_stats())
+        self.job.state_save()
+        return moves
+
+    def state(self):
+        'Return a list of dicts describing each job, for the state file.'
+        return [{'job_id':       j.job_id,
+                 'worker_count': j.worker_count,
+                 'mgid':         j.mgid,
+                 'worker_base':  j.worker_base,
+                 'pool_base':    j.pool_base,
+                 'pool_size':    j.pool_size,
+                 'workers':      dict(j.workers)}
+                for j in sorted(self.jobs.values(), key=lambda j: j.job_id)]
+
+    @locked
+    def restore(self, jobs):
+        """Recreate jobs from a list returned by state(), taking the
+        same resources they had before. Their groups are created empty;
+        workers are restored separately by Job."""
+        for j in jobs:
+            self.mgids.reserve(j['mgid'], 1)
+            self.worker_ids.reserve(j['worker_base'], j['worker_count'])
+            self.pool.reserve(j['pool_base'], j['pool_size'])
+
+            logical_job = LogicalJob(j['job_id'], j['worker_count'], j['mgid'],
+                                     j['worker_base'], j['pool_base'], j['pool_size'])
+            logical_job.workers = dict(j['workers'])
+            self.job.pre.group_add(logical_job.mgid)
+            self.jobs[logical_job.job_id] = logical_job
+            self.logger.info("Restored {}".format(logical_job))
+
+    @locked
+    def worker_remove(self, logical_job, worker_rank):
+        worker_id = logical_job.worker_id(worker_rank)
+        if logical_job.workers.pop(worker_rank) == 'roce':
+            self.job.rdma_receiver.del_entry(worker_id)
+            self.job.rdma_sender.del_write_worker(worker_id)
+            self.job.roce_workers.pop(worker_id, None)
+        else:
+            self.job.get_worker_bitmap.del_udp_entry(worker_id)
+            self.job.set_dst_addr.del_udp_entry(worker_id)
+            self.job.udp_workers.pop(worker_id, None)
+        self.job.pre.worker_del(logical_job.mgid, worker_id)
+
+    def check_rank(self, logical_job, worker_rank):
+        if not 0 <= worker_rank < logical_job.worker_count:
+            raise Exception("Error: rank {} is outside job {} of {} workers.".format(
+                worker_rank, logical_job.job_id, logical_job.worker_count))
+        if worker_rank in logical_job.workers:
+            raise Exception("Error: rank {} of job {} already added.".format(worker_rank, logical_job.job_id))
+
+    @locked
+    def worker_add_udp(self, job_id, worker_rank, worker_mac, worker_ip):
+        logical_job = self.jobs[job_id]
+        self.check_rank(logical_job, worker_rank)
+        self.job.worker_add_udp(worker_rank, logical_job.worker_count, worker_mac, worker_ip,
+                                worker_id=logical_job.worker_id(worker_rank),
+                                mgid=logical_job.mgid,
+                                pool_base=logical_job.pool_base,
+                                pool_size=logical_job.pool_size)
+        logical_job.workers[worker_rank] = 'udp'
+        self.job.state_save()
+
+    @locked
+    def worker_add_roce(self, job_id, worker_rank,
+                        worker_mac, worker_ip, worker_rkey,
+                        worker_packet_size, worker_message_size,
+                        worker_qpns_and_psns):
+        logical_job = self.jobs[job_id]
+        self.check_rank(logical_job, worker_rank)
+        self.job.worker_add_roce(worker_rank, logical_job.worker_count,
+                                 worker_mac, worker_ip, worker_rkey,
+                                 worker_packet_size, worker_message_size,
+                                 worker_qpns_and_psns,
+                                 worker_id=logical_job.worker_id(worker_rank),
+                                 mgid=logical_job.mgid,
+                                 pool_base=logical_job.pool_base)
+        logical_job.workers[worker_rank] = 'roce'
+        self.job.state_save()
+
+    def roce_pool_size(self, workers):
+        # pool indices needed by the largest worker
+        return max(self.job.rdma_sender.pool_size(w['worker_packet_size'], w['worker_message_size'],
+                                                  len(w['worker_qpns_and_psns'])) for w in workers)
+
+    @locked
+    def job_connect_roce(self, job_id, workers):
+        """Program a complete RoCE job, given a list of dicts with
+        Job.worker_update_roce's arguments for every rank. A job
+        reconnecting with the same size and pool needs is updated in
+        place; otherwise its old resources are released first."""
+        worker_count = workers[0]['worker_count']
+        pool_size = self.roce_pool_size(workers)
+
+        # ranks outside the job would use another job's worker IDs
+        for w in workers:
+            if not 0 <= w['worker_rank'] < worker_count:
+                raise Exception("Error: rank {} is outside job {} of {} workers.".format(
+                    w['worker_rank'], job_id, worker_count))
+
+        logical_job = self.jobs.get(job_id)
+        if logical_job is not None and (logical_job.worker_count != worker_count or
+                                        logical_job.pool_size != pool_size):
+            self.job_remove(job_id)
+            logical_job = None
+
+        if logical_job is None:
+            logical_job = self.job_create(job_id, worker_count, pool_size)
+        else:
+            # clear aggregation state left by the job's previous run
+            self.job.clear_registers(logical_job.pool_size, logical_job.pool_base)
+
+        with self.job.write_batch():
+            for w in workers:
+                self.job.worker_update_roce(worker_id=logical_job.worker_id(w['worker_rank']),
+                                            mgid=logical_job.mgid,
+                                            pool_base=logical_job.pool_base,
+                                            **w)
+                logical_job.workers[w['worker_rank']] = 'roce'
+
+        self.job.state_save()
+        return logical_job
+
+    def print_jobs(self):
+        for job_id in sorted(self.jobs):
+            print(self.jobs[job_id])
+        print("{} jobs; {} of {} worker IDs and {} of {} multicast groups free.".format(
+            len(self.jobs),
+            self.worker_ids.free_count(), self.worker_ids.size,
+            self.mgids.free_count(), self.mgids.size))
+        print(self.pool.format_stats())
@@ -44,6 +44,8 @@ class Mirror(Table):
         # delete each session we created
         while len(self.sessions):
             sid = self.sessions.pop(0)
+            if self.adopting:
+                continue
             self.table.entry_del(
                 self.target,
                 [self.table.make_key([gc.KeyTuple('$sid', sid)])])
@@ -51,6 +53,9 @@ class Mirror(Table):
         
     def add_default_entries(self):
         sid = self.normal_base
+        self.sessions.append(sid)
+        if self.adopting:
+            return
         self.table.entry_add(
             self.target,
             [self.table.make_key([gc.KeyTuple('$sid', sid)])],
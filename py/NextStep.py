@@ -70,8 +70,10 @@ class NextStep(Table):
                     [gc.DataTuple('$COUNTER_SPEC_PKTS', 0)])] * count)
 
 
-    # Print 
-    def print_counters(self, start=0, count=8):
+    # Read pool index counters for count indices from start, or all
+    # of them if count is None. Returns a (4, count) array with rows
+    # for recirculated, broadcast, retransmitted and dropped packets.
+    def get_counter_values(self, start=0, count=None):
         counters = [#self.consume_counter,
                     #self.harvest_counter,
                     self.recirculate_counter,
@@ -79,26 +81,21 @@ class NextStep(Table):
                     self.retransmit_counter,
                     self.drop_counter]
 
-        count = count * 2 # double count to get both sets
-        #values = [{}, {}, {}, {}, {}]
-        values = [{}, {}, {}, {}]
-        
-        for counter_id, counter in enumerate(counters):
-            counter.operations_execute(self.target, 'Sync')
-            resp = counter.entry_get(
-                self.target,
-                [counter.make_key([gc.KeyTuple('$COUNTER_INDEX', i)])
-                 for i in range(start, start+count)],
-                flags={"from_hw": False})
+        if count is None:
+            return self.read_counters(counters)
+        return self.read_counters(counters, range(start, start+count))
 
-            for v, k in resp:
-                v = v.to_dict()
-                k = k.to_dict()
+    # Read pool index counters. Returns a list of dicts of pool index
+    # -> packets, one each for recirculated, broadcast, retransmitted
+    # and dropped packets.
+    def get_counters(self, start=0, count=16):
+        values = self.get_counter_values(start, count)
+        return [dict(zip(range(start, start+count), row.tolist())) for row in values]
 
-                #pprint((counter_id, k, v))
-                pool_index = k['$COUNTER_INDEX']['value']
-                value = v['$COUNTER_SPEC_PKTS']
-                values[counter_id][pool_index] = value
+    # Print 
+    def print_counters(self, start=0, count=8):
+        count = count * 2 # double count to get both sets
+        values = self.get_counter_values(start, count)
 
         print("                      " +
               #"      Consumed" +
@@ -108,14 +105,14 @@ class NextStep(Table):
               "  Retransmitted " +
               "        Dropped")
 
-        for index in range(start, start+count):
+        for i, index in enumerate(range(start, start+count)):
             #print("Pool index {:5} set {}: {:13}  {:13}  {:13}  {:13}  {:13}".format(
             print("Pool index {:5} set {}: {:13}  {:13}  {:13}  {:13}".format(
                 index >> 1, index & 1,
-                values[0][index],
-                values[1][index],
-                values[2][index],
-                values[3][index]))
+                values[0, i],
+                values[1, i],
+                values[2, i],
+                values[3, i]))
             
 
         # # get direct counter
@@ -41,8 +41,8 @@ class NonSwitchMLForward(Table):
         
     def add_default_entries(self):
         # add broadcast entry
-        self.table.entry_add(
-            self.target,
+        self.add_entries(
+            self.table,
             [self.table.make_key([gc.KeyTuple('hdr.ethernet.dst_addr',
                                               "ff:ff:ff:ff:ff:ff")])],
             [self.table.make_data([gc.DataTuple('flood_mgid', self.mgid)],
@@ -52,8 +52,8 @@ class NonSwitchMLForward(Table):
     def worker_add(self, mac_address, front_panel_port, lane):
         dev_port = self.ports.get_dev_port(front_panel_port, lane)
         try:
-            self.table.entry_add(
-                self.target,
+            self.add_entries(
+                self.table,
                 [self.table.make_key([gc.KeyTuple('hdr.ethernet.dst_addr',
                                                   mac_address)])],
                 [self.table.make_data([gc.DataTuple('egress_port', dev_port)],
@@ -64,8 +64,8 @@ class NonSwitchMLForward(Table):
 
         
     def worker_del(self, mac_address):
-        self.table.entry_del(
-            self.target,
+        self.del_entries(
+            self.table,
             [self.table.make_key([gc.KeyTuple('hdr.ethernet.dst_addr',
                                               mac_address)])])
         del self.mac_addresses[mac_address]
@@ -90,8 +90,8 @@ class NonSwitchMLForward(Table):
         return results
     
     def worker_clear_all(self):
-        self.table.entry_add(
-            self.target,
+        self.del_entries(
+            self.table,
             [self.table.make_key([gc.KeyTuple('hdr.ethernet.dst_addr',
                                               mac_address)])
              for mac_address in self.mac_addresses])
@@ -105,8 +105,8 @@ class NonSwitchMLForward(Table):
     def add_workers(self, switch_mgid, workers):
         for worker in workers:
             dev_port = self.ports.get_dev_port(worker.front_panel_port, worker.lane)
-            self.table.entry_add(
-                self.target,
+            self.add_entries(
+                self.table,
                 [self.table.make_key([gc.KeyTuple('hdr.ethernet.dst_addr',
                                                   worker.mac)])],
                 [self.table.make_data([gc.DataTuple('egress_port', dev_port)],
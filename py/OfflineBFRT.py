@@ -0,0 +1,700 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+#
+# In-memory stand-in for the BF-RT GRPC client.
+#
+# This implements the part of the bfrt_grpc.client interface that the
+# controller uses, keyed by the same table names, so a Job can be
+# built and exercised without a Tofino or the SDE. Register and
+# counter sizes come from p4/configuration.p4. Every call that would
+# be an RPC on a real switch can be delayed by a configurable latency,
+# which makes this useful for measuring control-plane throughput.
+#
+# Usage:
+#   import OfflineBFRT
+#   OfflineBFRT.install()  # before importing Job or any table module
+#   c = OfflineBFRT.client.ClientInterface('offline', 0, 0, rpc_latency=0.0005)
+#   bfrt_info = c.bfrt_info_get('switchml')
+#   job = Job(OfflineBFRT.client, bfrt_info, ...)
+#
+
+import os
+import re
+import sys
+import time
+import types
+import logging
+import threading
+from collections import OrderedDict
+
+
+#
+# exceptions and simple value types
+#
+
+class BfruntimeRpcException(Exception):
+    pass
+
+class BfruntimeReadWriteRpcException(BfruntimeRpcException):
+    pass
+
+
+class TableModIncFlag(object):
+    MOD_INC_ADD    = 0
+    MOD_INC_DELETE = 1
+
+
+class Target(object):
+
+    def __init__(self, device_id=0, pipe_id=0xffff, direction=0xff, prsr_id=0xff):
+        self.device_id = device_id
+        self.pipe_id = pipe_id
+        self.direction = direction
+        self.prsr_id = prsr_id
+
+
+class KeyTuple(object):
+
+    def __init__(self, name, value=None, mask=None, prefix_len=None, low=None, high=None):
+        self.name = name
+        self.value = value
+        self.mask = mask
+        self.prefix_len = prefix_len
+        self.low = low
+        self.high = high
+
+
+class DataTuple(object):
+
+    def __init__(self, name, val=None, float_val=None, str_val=None,
+                 int_arr_val=None, bool_arr_val=None, bool_val=None,
+                 container_arr_val=None, str_arr_val=None):
+        self.name = name
+        self.value = None
+        for v in [val, float_val, str_val, int_arr_val, bool_arr_val,
+                  bool_val, container_arr_val, str_arr_val]:
+            if v is not None:
+                self.value = v
+                break
+
+
+#
+# keys, data and table info
+#
+
+class _Key(object):
+
+    def __init__(self, table, fields):
+        self.table = table
+        self.fields = OrderedDict((f.name, f) for f in fields)
+
+    def identity(self):
+        return tuple(sorted((f.name, f.value, f.mask, f.prefix_len, f.low, f.high)
+                            for f in self.fields.values()))
+
+    def to_dict(self):
+        result = {}
+        for name, f in self.fields.items():
+            d = {'value': f.value}
+            if f.mask is not None:
+                d['mask'] = f.mask
+            if f.prefix_len is not None:
+                d['prefix_len'] = f.prefix_len
+            if f.low is not None:
+                d['low'] = f.low
+                d['high'] = f.high
+            result[name] = d
+        return result
+
+
+class _Data(object):
+
+    def __init__(self, table, fields, action_name=None, is_default_entry=False):
+        self.table = table
+        self.fields = OrderedDict(fields)
+        self.action_name = action_name
+        self.is_default_entry = is_default_entry
+
+    def copy(self):
+        return _Data(self.table, [(k, list(v) if isinstance(v, list) else v)
+                                  for k, v in self.fields.items()],
+                     self.action_name, self.is_default_entry)
+
+    def to_dict(self):
+        result = dict(self.fields)
+        result['action_name'] = self.action_name
+        result['is_default_entry'] = self.is_default_entry
+        return result
+
+
+class _TableInfo(object):
+
+    def __init__(self, name, size, key_fields, data_fields):
+        self.name = name
+        self.size = size
+        self.key_fields = list(key_fields)
+        self.data_fields = list(data_fields)
+        self.annotations = {}
+
+    def name_get(self):
+        return self.name
+
+    def key_field_name_list_get(self):
+        return list(self.key_fields)
+
+    def data_field_name_list_get(self, action_name=None):
+        return list(self.data_fields)
+
+    def key_field_annotation_add(self, field_name, custom_annotation):
+        self.annotations[field_name] = custom_annotation
+
+    def data_field_annotation_add(self, field_name, action_name, custom_annotation):
+        self.annotations[(field_name, action_name)] = custom_annotation
+
+
+#
+# tables
+#
+
+class _Table(object):
+
+    def __init__(self, bfrt, name, size, key_fields=(), data_fields=()):
+        self.bfrt = bfrt
+        self.info = _TableInfo(name, size, key_fields, data_fields)
+        self.lock = threading.Lock()
+
+    def _rpc(self, operation, entries=1):
+        self.bfrt.rpc(self.info.name, operation, entries)
+
+    def make_key(self, key_field_list):
+        return _Key(self, key_field_list)
+
+    def make_data(self, data_field_list, action_name=None, get=False):
+        return _Data(self, [(f.name, f.value) for f in data_field_list], action_name)
+
+    def operations_execute(self, target, table_op):
+        self._rpc('operations_execute')
+
+    def entry_add(self, target, key_list=None, data_list=None, p4_name=None):
+        raise BfruntimeReadWriteRpcException("entry_add not supported on table {}".format(self.info.name))
+
+    def entry_mod(self, target, key_list=None, data_list=None, flags={}, p4_name=None):
+        raise BfruntimeReadWriteRpcException("entry_mod not supported on table {}".format(self.info.name))
+
+    def entry_mod_inc(self, target, key_list=None, data_list=None, flag_type=0, p4_name=None):
+        raise BfruntimeReadWriteRpcException("entry_mod_inc not supported on table {}".format(self.info.name))
+
+    def default_entry_set(self, target, data, p4_name=None):
+        raise BfruntimeReadWriteRpcException("default_entry_set not supported on table {}".format(self.info.name))
+
+    def default_entry_reset(self, target, p4_name=None):
+        self._rpc('default_entry_reset')
+
+
+class _MatchTable(_Table):
+    """Match-action table, or a fixed-function table that behaves like one."""
+
+    def __init__(self, bfrt, name, size, key_fields=(), data_fields=(),
+                 direct_counter=False, fixed=False):
+        super(_MatchTable, self).__init__(bfrt, name, size, key_fields, data_fields)
+
+        # direct counters start at zero for each new entry
+        self.direct_counter = direct_counter
+
+        # fixed-function tables accept adds of existing keys and
+        # deletes of missing keys, like the port tables do
+        self.fixed = fixed
+
+        self.entries = OrderedDict()
+        self.default_data = None
+
+    def _new_data(self, data):
+        data = data.copy()
+        if self.direct_counter:
+            data.fields.setdefault('$COUNTER_SPEC_BYTES', 0)
+            data.fields.setdefault('$COUNTER_SPEC_PKTS', 0)
+        return data
+
+    def entry_add(self, target, key_list=None, data_list=None, p4_name=None):
+        key_list = key_list or []
+        data_list = data_list or []
+        self._rpc('entry_add', len(key_list))
+        with self.lock:
+            for key, data in zip(key_list, data_list):
+                identity = key.identity()
+                if identity in self.entries and not self.fixed:
+                    raise BfruntimeReadWriteRpcException(
+                        "Entry {} already exists in table {}".format(key.to_dict(), self.info.name))
+                if identity not in self.entries and self.info.size and len(self.entries) >= self.info.size:
+                    raise BfruntimeReadWriteRpcException(
+                        "Table {} is full ({} entries)".format(self.info.name, self.info.size))
+                self.entries[identity] = (key, self._new_data(data))
+
+    def entry_mod(self, target, key_list=None, data_list=None, flags={}, p4_name=None):
+        key_list = key_list or []
+        data_list = data_list or []
+        self._rpc('entry_mod', len(key_list))
+        with self.lock:
+            for key, data in zip(key_list, data_list):
+                identity = key.identity()
+                if identity not in self.entries:
+                    if not self.fixed:
+                        raise BfruntimeReadWriteRpcException(
+                            "Entry {} not found in table {}".format(key.to_dict(), self.info.name))
+                    self.entries[identity] = (key, self._new_data(data))
+                    continue
+                old_key, old_data = self.entries[identity]
+                new_data = old_data.copy()
+                new_data.fields.update(data.fields)
+                if data.action_name is not None:
+                    new_data.action_name = data.action_name
+                self.entries[identity] = (old_key, new_data)
+
+    def entry_mod_inc(self, target, key_list=None, data_list=None, flag_type=0, p4_name=None):
+        key_list = key_list or []
+        data_list = data_list or []
+        self._rpc('entry_mod_inc', len(key_list))
+        with self.lock:
+            for key, data in zip(key_list, data_list):
+                identity = key.identity()
+                if identity not in self.entries:
+                    raise BfruntimeReadWriteRpcException(
+                        "Entry {} not found in table {}".format(key.to_dict(), self.info.name))
+                old_key, old_data = self.entries[identity]
+                new_data = old_data.copy()
+                array_fields = [k for k, v in data.fields.items() if isinstance(v, list)]
+                if flag_type == TableModIncFlag.MOD_INC_ADD:
+                    for k in array_fields:
+                        new_data.fields[k] = list(new_data.fields.get(k, [])) + list(data.fields[k])
+                else:
+                    # remove members matching the first array field,
+                    # along with the parallel elements of the others
+                    first = array_fields[0]
+                    current = new_data.fields.get(first, [])
+                    keep = [i for i, v in enumerate(current) if v not in data.fields[first]]
+                    if len(keep) + len(data.fields[first]) != len(current):
+                        raise BfruntimeReadWriteRpcException(
+                            "Members {} not found in entry {} of table {}".format(
+                                data.fields[first], key.to_dict(), self.info.name))
+                    for k in array_fields:
+                        values = new_data.fields.get(k, [])
+                        new_data.fields[k] = [values[i] for i in keep]
+                self.entries[identity] = (old_key, new_data)
+
+    def entry_del(self, target, key_list=None, p4_name=None):
+        key_list = key_list or []
+        self._rpc('entry_del', len(key_list))
+        with self.lock:
+            if not key_list:
+                self.entries.clear()
+                return
+            for key in key_list:
+                identity = key.identity()
+                if identity in self.entries:
+                    del self.entries[identity]
+                elif not self.fixed:
+                    raise BfruntimeReadWriteRpcException(
+                        "Entry {} not found in table {}".format(key.to_dict(), self.info.name))
+
+    def entry_get(self, target, key_list=None, flags={"from_hw": True}, required_data=None, p4_name=None):
+        key_list = key_list or []
+        self._rpc('entry_get', len(key_list))
+        with self.lock:
+            if not key_list:
+                results = [(data.copy(), key) for key, data in self.entries.values()]
+            else:
+                results = []
+                for key in key_list:
+                    identity = key.identity()
+                    if identity not in self.entries:
+                        raise BfruntimeReadWriteRpcException(
+                            "Entry {} not found in table {}".format(key.to_dict(), self.info.name))
+                    old_key, data = self.entries[identity]
+                    results.append((data.copy(), old_key))
+        return iter(results)
+
+    def default_entry_set(self, target, data, p4_name=None):
+        self._rpc('default_entry_set')
+        with self.lock:
+            self.default_data = data.copy()
+            self.default_data.is_default_entry = True
+
+    def default_entry_reset(self, target, p4_name=None):
+        self._rpc('default_entry_reset')
+        with self.lock:
+            self.default_data = None
+
+
+class _IndexedTable(_Table):
+    """Register or indirect counter array indexed by $REGISTER_INDEX or $COUNTER_INDEX."""
+
+    def __init__(self, bfrt, name, size, index_name, fields, num_pipes, per_pipe):
+        super(_IndexedTable, self).__init__(bfrt, name, size, [index_name], fields)
+        self.index_name = index_name
+        self.fields = list(fields)
+        self.num_pipes = num_pipes
+
+        # registers are read back with one value per pipe; counters are summed
+        self.per_pipe = per_pipe
+
+        # only nonzero indices are stored: index -> {field: [value per pipe]}
+        self.values = {}
+
+    def _index(self, key):
+        index = key.fields[self.index_name].value
+        if index < 0 or index >= self.info.size:
+            raise BfruntimeReadWriteRpcException(
+                "Index {} out of range for table {} of size {}".format(index, self.info.name, self.info.size))
+        return index
+
+    def _set(self, key, data):
+        index = self._index(key)
+        entry = self.values.setdefault(index, dict((f, [0] * self.num_pipes) for f in self.fields))
+        for name, value in data.fields.items():
+            if name not in entry:
+                raise BfruntimeReadWriteRpcException(
+                    "Unknown field {} for table {}".format(name, self.info.name))
+            if isinstance(value, list):
+                entry[name] = list(value)
+            else:
+                entry[name] = [value] + [0] * (self.num_pipes - 1) if not self.per_pipe else [value] * self.num_pipes
+
+    def set_pipe_value(self, index, pipe, field, value):
+        'Set one pipe of one entry directly, as the data plane would.'
+        with self.lock:
+            entry = self.values.setdefault(index, dict((f, [0] * self.num_pipes) for f in self.fields))
+            entry[field][pipe] = value
+
+    def entry_add(self, target, key_list=None, data_list=None, p4_name=None):
+        key_list = key_list or []
+        data_list = data_list or []
+        self._rpc('entry_add', len(key_list))
+        with self.lock:
+            for key, data in zip(key_list, data_list):
+                self._set(key, data)
+
+    def entry_mod(self, target, key_list=None, data_list=None, flags={}, p4_name=None):
+        self.entry_add(target, key_list, data_list)
+
+    def entry_del(self, target, key_list=None, p4_name=None):
+        key_list = key_list or []
+        # a wildcard delete touches every entry in the table
+        self._rpc('entry_del', len(key_list) or self.info.size)
+        with self.lock:
+            if not key_list:
+                self.values.clear()
+            else:
+                for key in key_list:
+                    self.values.pop(self._index(key), None)
+
+    def _to_data(self, index):
+        entry = self.values.get(index)
+        fields = []
+        for f in self.fields:
+            values = entry[f] if entry is not None else [0] * self.num_pipes
+            fields.append((f, list(values) if self.per_pipe else sum(values)))
+        return _Data(self, fields)
+
+    def entry_get(self, target, key_list=None, flags={"from_hw": True}, required_data=None, p4_name=None):
+        key_list = key_list or []
+        self._rpc('entry_get', len(key_list) or self.info.size)
+        with self.lock:
+            if key_list:
+                indices = [self._index(key) for key in key_list]
+            else:
+                indices = range(self.info.size)
+            results = [(self._to_data(i), self.make_key([KeyTuple(self.index_name, i)]))
+                       for i in indices]
+        return iter(results)
+
+
+class _PortStatTable(_Table):
+    """Port statistics; always zero offline."""
+
+    stat_fields = ['$FramesReceivedOK', '$FramesReceivedAll', '$OctetsReceivedinGoodFrames',
+                   '$FrameswithanyError', '$FramesReceivedwithFCSError', '$FramesTransmittedOK',
+                   '$FramesTransmittedAll', '$OctetsTransmittedwithouterror', '$FramesTransmittedwithError']
+
+    def entry_mod(self, target, key_list=None, data_list=None, flags={}, p4_name=None):
+        self._rpc('entry_mod', len(key_list or []))
+
+    def entry_get(self, target, key_list=None, flags={"from_hw": True}, required_data=None, p4_name=None):
+        key_list = key_list or []
+        self._rpc('entry_get', len(key_list))
+        return iter([(_Data(self, [(f, 0) for f in self.stat_fields]), key) for key in key_list])
+
+
+class _PortTable(_MatchTable):
+    """$PORT table; fills in the read-only fields the real one reports."""
+
+    def entry_add(self, target, key_list=None, data_list=None, p4_name=None):
+        key_list = key_list or []
+        data_list = data_list or []
+        filled = []
+        for key, data in zip(key_list, data_list):
+            data = data.copy()
+            dev_port = key.fields['$DEV_PORT'].value
+            conn_id, chnl_id = self.bfrt.fp_port_of(dev_port)
+            data.fields.setdefault('$PORT_NAME', '{}/{}'.format(conn_id, chnl_id))
+            data.fields.setdefault('$CONN_ID', conn_id)
+            data.fields.setdefault('$CHNL_ID', chnl_id)
+            data.fields.setdefault('$PORT_UP', False)
+            data.fields.setdefault('$IS_VALID', True)
+            filled.append(data)
+        super(_PortTable, self).entry_add(target, key_list, filled)
+
+
+#
+# program info
+#
+
+def read_configuration(p4_dir=None, test=False):
+    """Read integer constants from configuration.p4 and the debug log size."""
+    if p4_dir is None:
+        p4_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'p4')
+
+    # defaults match the non-test configuration
+    config = {'register_size': 16384,
+              'num_slots': 8192,
+              'max_num_workers': 32,
+              'max_num_non_switchml': 1024,
+              'max_num_queue_pairs_per_worker': 512,
+              'max_num_queue_pairs': 512 * 32,
+              'log_size': 22528}
+
+    try:
+        with open(os.path.join(p4_dir, 'configuration.p4')) as f:
+            lines = f.readlines()
+    except IOError:
+        return config
+
+    # handle just enough of the preprocessor for this file
+    active = [True]
+    for line in lines:
+        line = line.split('//')[0].strip()
+        m = re.match(r'#ifdef\s+(\w+)', line)
+        if m:
+            active.append(active[-1] and (m.group(1) != 'SWITCHML_TEST' or test))
+            continue
+        if line.startswith('#else'):
+            active[-1] = active[-2] and not active[-1]
+            continue
+        if line.startswith('#endif'):
+            active.pop()
+            continue
+        m = re.match(r'const\s+int\s+(\w+)\s*=\s*([^;]+);', line)
+        if m and active[-1]:
+            expression = m.group(2).replace('/', '//')
+            try:
+                config[m.group(1)] = eval(expression, {'__builtins__': {}}, dict(config))
+            except Exception:
+                pass
+
+    try:
+        with open(os.path.join(p4_dir, 'DebugLog.p4')) as f:
+            for line in f:
+                m = re.match(r'\s*const\s+log_index_t\s+log_size\s*=\s*(\d+);', line)
+                if m:
+                    config['log_size'] = int(m.group(1))
+                    break
+    except IOError:
+        pass
+
+    return config
+
+
+class BfRtInfo(object):
+
+    def __init__(self, p4_name, rpc_latency=0.0, entry_latency=0.0,
+                 num_pipes=4, p4_dir=None, test=False):
+        self.logger = logging.getLogger('OfflineBFRT')
+        self.p4_name = p4_name
+        self.rpc_latency = rpc_latency
+        self.entry_latency = entry_latency
+        self.num_pipes = num_pipes
+        self.config = read_configuration(p4_dir, test)
+
+        # RPC statistics: (table name, operation) -> [calls, entries]
+        self.stats_lock = threading.Lock()
+        self.stats = {}
+
+        # front panel port/lane <-> dev port, 16 connectors per pipe
+        self.dev_ports = OrderedDict()
+        for pipe in range(self.num_pipes):
+            for connector in range(16):
+                for lane in range(4):
+                    conn_id = pipe * 16 + connector + 1
+                    self.dev_ports[(conn_id, lane)] = (pipe << 7) | (connector * 4 + lane)
+        self.fp_ports = dict((v, k) for k, v in self.dev_ports.items())
+
+        self.table_dict = OrderedDict()
+        self.add_tables()
+
+    def rpc(self, table_name, operation, entries):
+        latency = self.rpc_latency + self.entry_latency * entries
+        if latency > 0:
+            time.sleep(latency)
+        with self.stats_lock:
+            stat = self.stats.setdefault((table_name, operation), [0, 0])
+            stat[0] += 1
+            stat[1] += entries
+
+    def rpc_count(self):
+        with self.stats_lock:
+            return sum(calls for calls, entries in self.stats.values())
+
+    def reset_stats(self):
+        with self.stats_lock:
+            self.stats = {}
+
+    def fp_port_of(self, dev_port):
+        return self.fp_ports.get(dev_port, (0, 0))
+
+    def table_get(self, name):
+        if name in self.table_dict:
+            return self.table_dict[name]
+        raise BfruntimeRpcException("Table {} not found in program {}".format(name, self.p4_name))
+
+    def _add(self, table):
+        self.table_dict[table.info.name] = table
+
+    def _match(self, name, size, direct_counter=False, fixed=False):
+        self._add(_MatchTable(self, name, size, direct_counter=direct_counter, fixed=fixed))
+
+    def _register(self, name, size, fields=('first', 'second')):
+        prefix = name[len('pipe.'):] if name.startswith('pipe.') else name
+        self._add(_IndexedTable(self, name, size, '$REGISTER_INDEX',
+                                ['{}.{}'.format(prefix, f) for f in fields],
+                                self.num_pipes, per_pipe=True))
+
+    def _counter(self, name, size, fields=('$COUNTER_SPEC_PKTS',)):
+        self._add(_IndexedTable(self, name, size, '$COUNTER_INDEX', fields,
+                                self.num_pipes, per_pipe=False))
+
+    def add_tables(self):
+        c = self.config
+        register_size = c['register_size']
+        num_slots = c['num_slots']
+        max_num_workers = c['max_num_workers']
+        max_num_queue_pairs = c['max_num_queue_pairs']
+
+        # fixed-function tables
+        port_hdl_info = _MatchTable(self, '$PORT_HDL_INFO', 0, ['$CONN_ID', '$CHNL_ID'], ['$DEV_PORT'])
+        for (conn_id, lane), dev_port in self.dev_ports.items():
+            key = port_hdl_info.make_key([KeyTuple('$CONN_ID', conn_id), KeyTuple('$CHNL_ID', lane)])
+            port_hdl_info.entries[key.identity()] = (key, _Data(port_hdl_info, [('$DEV_PORT', dev_port)]))
+        self._add(port_hdl_info)
+        self._add(_PortTable(self, '$PORT', 0, fixed=True))
+        self._add(_PortStatTable(self, '$PORT_STAT', 0))
+        self._match('$PKTGEN_PORT_CFG', 0, fixed=True)
+        self._match('$PKTGEN_APPLICATION_CFG', 0, fixed=True)
+        self._match('$PKTGEN_PKT_BUFFER', 0, fixed=True)
+        self._match('$pre.mgid', 0)
+        self._match('$pre.node', 0)
+        self._match('$pre.ecmp', 0)
+        self._match('$pre.lag', 0, fixed=True)
+        self._match('$pre.prune', 0, fixed=True)
+        self._match('$pre.port', 0, fixed=True)
+        self._match('$mirror.cfg', 0)
+        self._match('pipe.IngressParser.$PORT_METADATA', 0, fixed=True)
+
+        # match-action tables
+        self._match('pipe.Ingress.arp_and_icmp.arp_and_icmp', 2)
+        self._match('pipe.Ingress.get_worker_bitmap.get_worker_bitmap', max_num_workers, direct_counter=True)
+        self._match('pipe.Ingress.rdma_receiver.receive_roce', max_num_workers * 6, direct_counter=True)
+        self._match('pipe.Ingress.update_and_check_worker_bitmap.update_and_check_worker_bitmap', 0)
+        self._match('pipe.Ingress.count_workers.count_workers', 0)
+        self._match('pipe.Ingress.exponent_max.exponent_max', 4)
+        self._match('pipe.Ingress.next_step.next_step', 0, direct_counter=True)
+        self._match('pipe.Ingress.next_step.recirc_port', 1)
+        self._match('pipe.Ingress.non_switchml_forward.forward', c['max_num_non_switchml'])
+        self._match('pipe.Egress.set_dst_addr.switch_mac_and_ip', 1)
+        self._match('pipe.Egress.set_dst_addr.set_dst_addr', max_num_workers, direct_counter=True)
+        self._match('pipe.Egress.rdma_sender.switch_mac_and_ip', 1)
+        self._match('pipe.Egress.rdma_sender.create_roce_packet', max_num_workers, direct_counter=True)
+        self._match('pipe.Egress.rdma_sender.fill_in_qpn_and_psn', max_num_queue_pairs)
+        self._match('pipe.Egress.rdma_sender.set_opcodes', 0)
+        for n in range(32):
+            self._match('pipe.Ingress.sum{:02d}.significand_sum'.format(n), 20)
+
+        # registers
+        self._register('pipe.Ingress.update_and_check_worker_bitmap.worker_bitmap', num_slots)
+        self._register('pipe.Ingress.count_workers.worker_count', register_size)
+        self._register('pipe.Ingress.exponent_max.exponents', register_size)
+        for n in range(32):
+            self._register('pipe.Ingress.sum{:02d}.significands'.format(n), register_size)
+        self._register('pipe.Ingress.debug_packet_id.counter', 1, ['f1'])
+        self._register('pipe.Ingress.debug_log.log', c['log_size'], ['addr', 'data'])
+        self._register('pipe.Egress.debug_log.log', c['log_size'], ['addr', 'data'])
+        self._register('pipe.Ingress.rdma_receiver.receiver_data_register', max_num_queue_pairs,
+                       ['next_sequence_number', 'pool_index'])
+        self._register('pipe.Egress.rdma_sender.psn_register', max_num_queue_pairs, ['f1'])
+
+        # indirect counters
+        for name in ['recirculate_counter', 'broadcast_counter', 'retransmit_counter', 'drop_counter']:
+            self._counter('pipe.Ingress.next_step.' + name, register_size)
+        for name in ['rdma_packet_counter', 'rdma_message_counter', 'rdma_sequence_violation_counter']:
+            self._counter('pipe.Ingress.rdma_receiver.' + name, max_num_queue_pairs)
+        self._counter('pipe.Ingress.egress_drop_sim.simulated_drop_packet_counter', max_num_queue_pairs)
+
+
+class ClientInterface(object):
+
+    def __init__(self, grpc_addr, client_id, device_id, is_master=False,
+                 rpc_latency=0.0, entry_latency=0.0, num_pipes=4, p4_dir=None, test=False):
+        self.logger = logging.getLogger('OfflineBFRT')
+        self.grpc_addr = grpc_addr
+        self.client_id = client_id
+        self.device_id = device_id
+        self.p4_name = None
+        self.bfrt_info = None
+        self.rpc_latency = rpc_latency
+        self.entry_latency = entry_latency
+        self.num_pipes = num_pipes
+        self.p4_dir = p4_dir
+        self.test = test
+
+    def bind_pipeline_config(self, p4_name):
+        self.p4_name = p4_name
+        self.logger.info("Using offline BF-RT stand-in for program {}.".format(p4_name))
+
+    def bfrt_info_get(self, p4_name=None):
+        if self.bfrt_info is None:
+            self.bfrt_info = BfRtInfo(p4_name or self.p4_name,
+                                      rpc_latency=self.rpc_latency,
+                                      entry_latency=self.entry_latency,
+                                      num_pipes=self.num_pipes,
+                                      p4_dir=self.p4_dir,
+                                      test=self.test)
+        return self.bfrt_info
+
+    def tear_down_stream(self):
+        pass
+
+
+#
+# module objects standing in for bfrt_grpc.client and bfrt_grpc.bfruntime_pb2
+#
+
+client = types.ModuleType('bfrt_grpc.client')
+for _name in ['BfruntimeRpcException', 'BfruntimeReadWriteRpcException', 'Target',
+              'KeyTuple', 'DataTuple', 'ClientInterface']:
+    setattr(client, _name, globals()[_name])
+
+bfruntime_pb2 = types.ModuleType('bfrt_grpc.bfruntime_pb2')
+bfruntime_pb2.TableModIncFlag = TableModIncFlag
+
+
+def install():
+    """Make 'import bfrt_grpc.client' and 'import bfrt_grpc.bfruntime_pb2' use this stand-in.
+
+    Must be called before the table modules are imported.
+    """
+    package = types.ModuleType('bfrt_grpc')
+    package.__path__ = []
+    package.client = client
+    package.bfruntime_pb2 = bfruntime_pb2
+    sys.modules['bfrt_grpc'] = package
+    sys.modules['bfrt_grpc.client'] = client
+    sys.modules['bfrt_grpc.bfruntime_pb2'] = bfruntime_pb2
@@ -35,43 +35,47 @@ class PRE(Table):
         self.prune_table = self.bfrt_info.table_get("$pre.prune")
         self.port_table  = self.bfrt_info.table_get("$pre.port")
 
-        # keep port to rid mapping
+        # keep rid to port mapping for each group; several ranks
+        # may share a port, each with its own node
         self.rid_counter = 0x80000
         self.rids = {}
         self.rids[self.switchml_mgid] = {}
         self.rids[self.all_mgid] = {}
+
+        # nodes on the switch, as node id -> dev port, so we never
+        # have to guess whether a node exists
+        self.nodes = {}
+
+        # groups whose membership has changed since the last commit
+        self.dirty_mgids = set()
         
         # clear and add defaults
         self.clear()
         self.add_default_entries()
 
+        # remove any nodes left over from a previous run
+        self.commit()
+
 
     def clear(self):
-        # first, clean up old group if they exist
+        # when adopting, keep the switch's groups and just find its nodes
+        if self.adopting:
+            self.nodes = self.read_nodes()
+            return
+
+        # first, clean up old groups if they exist, including any
+        # added for other jobs by a previous run
         #self.mgid_table.entry_del(self.target) # ideally we could do this, but it's not supported.
-        try:
+        old_mgids = [k.to_dict()['$MGID']['value']
+                     for v, k in self.mgid_table.entry_get(self.target, [], {"from_hw": False})]
+        if old_mgids:
             self.mgid_table.entry_del(
                 self.target,
-                [self.mgid_table.make_key([gc.KeyTuple('$MGID', self.switchml_mgid)])])
-        except gc.BfruntimeReadWriteRpcException as e:
-            self.logger.info("Multicast group ID {} not found in switch already during delete; this is expected.".format(self.switchml_mgid))
-            
-        try:
-            self.mgid_table.entry_del(
-                self.target,
-                [self.mgid_table.make_key([gc.KeyTuple('$MGID', self.all_mgid)])])
-        except gc.BfruntimeReadWriteRpcException as e:
-            self.logger.info("Multicast group ID {} not found in switch already during delete; this is expected.".format(self.all_mgid))
+                [self.mgid_table.make_key([gc.KeyTuple('$MGID', mgid)]) for mgid in old_mgids])
 
-        ## now, clean up old nodes.
-        #self.node_table.entry_del(self.target)
-        
-        # try:
-        #     self.node_table.entry_del(
-        #         target,
-        #         [self.node_table.make_key([gc.KeyTuple('$MULTICAST_NODE_ID', worker.rid)])])
-        # except gc.BfruntimeReadWriteRpcException as e:
-        #     self.logger.info("Multicast node ID {} not found in switch already during delete; this is expected.".format(worker.rid))
+        # then, find nodes that still exist; they're removed or
+        # reused when groups are next committed
+        self.nodes = self.read_nodes()
 
         # # Set -1 as CopyToCPU port
         # print("Setting port", port, "as CopyToCPU port")
@@ -95,7 +99,17 @@ class PRE(Table):
 
             
         
+    def read_nodes(self):
+        'Return node id -> dev port list for each node on the switch.'
+        nodes = {}
+        for v, k in self.node_table.entry_get(self.target, [], {"from_hw": False}):
+            nodes[k.to_dict()['$MULTICAST_NODE_ID']['value']] = v.to_dict()['$DEV_PORT']
+        return nodes
+        
     def add_default_entries(self):
+        if self.adopting:
+            return
+
         # create empty multicast group for switchml
         self.mgid_table.entry_add(
             self.target,
@@ -119,168 +133,175 @@ class PRE(Table):
                                                      int_arr_val=[])])])
 
 
-    def worker_add(self, mgid, rid, port, lane):
-        # get dev port for this worker
-        dev_port = self.ports.get_dev_port(port, lane)
+    def group_add(self, mgid):
+        # create an empty multicast group for another job
+        if mgid in self.rids:
+            raise Exception("Error: multicast group {} already exists.".format(mgid))
+        self.rids[mgid] = {}
+        if self.adopting:
+            return
+        self.mgid_table.entry_add(
+            self.target,
+            [self.mgid_table.make_key([gc.KeyTuple('$MGID', mgid)])],
+            [self.group_data([])])
 
-        if rid in self.rids[mgid]:
-            print("Port {}/{} already added to multicast group {}; skipping.".format(port, lane, mgid))
+    def group_del(self, mgid):
+        # remove a job's multicast group; its nodes are removed on the next commit
+        del self.rids[mgid]
+        self.dirty_mgids.discard(mgid)
+        if not self.adopting:
+            self.mgid_table.entry_del(
+                self.target,
+                [self.mgid_table.make_key([gc.KeyTuple('$MGID', mgid)])])
+        if self.batch is not None:
+            self.batch.defer(self.commit)
+        else:
+            self.commit()
+
+
+    #
+    # Group membership is changed locally and written to the switch
+    # by commit(). Outside a write batch, each change is committed
+    # immediately; inside one, all changes are committed together
+    # when the batch is flushed. Each rid gets its own node, even
+    # when several ranks share a port.
+    #
+
+    def mark_dirty(self, mgid):
+        self.dirty_mgids.add(mgid)
+        if self.batch is not None:
+            self.batch.defer(self.commit)
+        else:
+            self.commit()
+
+    def commit(self):
+        """Write changed groups and the nodes they need to the switch:
+        one batched add and modify for new and moved nodes, one write
+        of every changed group, and one batched delete for nodes no
+        group uses anymore."""
+        # when adopting, the switch should already match; verify() checks
+        if self.adopting:
+            self.dirty_mgids.clear()
             return
 
-        # add to rid table for this group
-        self.rids[mgid][dev_port] = rid
+        needed = self.needed_nodes()
+        add_rids = sorted(rid for rid in needed if rid not in self.nodes)
+        mod_rids = sorted(rid for rid in needed if rid in self.nodes and self.nodes[rid] != [needed[rid]])
+        del_rids = sorted(rid for rid in self.nodes if rid not in needed)
 
-        # erase any existing entry
-        try:
-            self.node_table.entry_del(
+        if add_rids:
+            self.node_table.entry_add(
+                self.target,
+                [self.node_key(rid) for rid in add_rids],
+                [self.node_data(rid, needed[rid]) for rid in add_rids])
+        if mod_rids:
+            self.node_table.entry_mod(
+                self.target,
+                [self.node_key(rid) for rid in mod_rids],
+                [self.node_data(rid, needed[rid]) for rid in mod_rids])
+        for rid in add_rids + mod_rids:
+            self.nodes[rid] = [needed[rid]]
+
+        # rewrite each changed group with its complete membership
+        mgids = sorted(self.dirty_mgids)
+        if mgids:
+            self.mgid_table.entry_mod(
                 self.target,
-                [self.node_table.make_key([gc.KeyTuple('$MULTICAST_NODE_ID', rid)])])
-        except gc.BfruntimeReadWriteRpcException as e:
-            self.logger.info("Multicast node ID {} not found in switch already during delete; this is expected.".format(rid))
+                [self.mgid_table.make_key([gc.KeyTuple('$MGID', mgid)]) for mgid in mgids],
+                [self.group_data(sorted(self.rids[mgid])) for mgid in mgids])
+        self.dirty_mgids.clear()
 
-        # add to node table
-        self.node_table.entry_add(
-            self.target,
-            [self.node_table.make_key([gc.KeyTuple('$MULTICAST_NODE_ID', rid)])],
-            [self.node_table.make_data([gc.DataTuple('$MULTICAST_RID', rid),
-                                        gc.DataTuple('$DEV_PORT', int_arr_val=[dev_port])])])
+        # nodes can be removed once no group refers to them
+        if del_rids:
+            self.node_table.entry_del(
+                self.target,
+                [self.node_key(rid) for rid in del_rids])
+        for rid in del_rids:
+            del self.nodes[rid]
+
+    def needed_nodes(self):
+        'Return node id -> dev port for each node some group uses.'
+        needed = {}
+        for members in self.rids.values():
+            needed.update(members)
+        return needed
+
+    def verify(self):
+        """Compare groups and nodes with the switch, using one read of
+        each table. Returns a list of (table name, key, problem)
+        tuples, like Table.verify_shadow. Nodes no group uses are not
+        problems; the next commit removes them."""
+        problems = []
+
+        groups = {}
+        for v, k in self.mgid_table.entry_get(self.target, [], {"from_hw": False}):
+            groups[k.to_dict()['$MGID']['value']] = sorted(v.to_dict()['$MULTICAST_NODE_ID'])
+        for mgid, members in sorted(self.rids.items()):
+            expected = sorted(members)
+            if mgid not in groups:
+                problems.append(('$pre.mgid', {'$MGID': mgid}, "missing on switch"))
+            elif groups[mgid] != expected:
+                problems.append(('$pre.mgid', {'$MGID': mgid}, "has nodes {}, expected {}".format(
+                    groups[mgid], expected)))
+        for mgid in sorted(set(groups) - set(self.rids)):
+            problems.append(('$pre.mgid', {'$MGID': mgid}, "not in controller state"))
+
+        self.nodes = self.read_nodes()
+        for rid, dev_port in sorted(self.needed_nodes().items()):
+            if rid not in self.nodes:
+                problems.append(('$pre.node', {'$MULTICAST_NODE_ID': rid}, "missing on switch"))
+            elif self.nodes[rid] != [dev_port]:
+                problems.append(('$pre.node', {'$MULTICAST_NODE_ID': rid}, "is on dev ports {}, expected {}".format(
+                    self.nodes[rid], [dev_port])))
+
+        return problems
+
+    def node_key(self, rid):
+        return self.node_table.make_key([gc.KeyTuple('$MULTICAST_NODE_ID', rid)])
+
+    def node_data(self, rid, dev_port):
+        return self.node_table.make_data([gc.DataTuple('$MULTICAST_RID', rid),
+                                          gc.DataTuple('$DEV_PORT', int_arr_val=[dev_port])])
+
+    def group_data(self, rids):
+        return self.mgid_table.make_data([gc.DataTuple('$MULTICAST_NODE_ID',
+                                                       int_arr_val=rids),
+                                          gc.DataTuple('$MULTICAST_NODE_L1_XID_VALID',
+                                                       bool_arr_val=[True] * len(rids)),
+                                          gc.DataTuple('$MULTICAST_NODE_L1_XID',
+                                                       int_arr_val=rids)])
 
-        # now that node is added, extend multicast group
-        self.mgid_table.entry_mod_inc(
-            self.target,
-            [self.mgid_table.make_key([gc.KeyTuple('$MGID', mgid)])],
-            [self.mgid_table.make_data([gc.DataTuple('$MULTICAST_NODE_ID',
-                                                     int_arr_val=[rid]),
-                                        gc.DataTuple('$MULTICAST_NODE_L1_XID_VALID',
-                                                     bool_arr_val=[True]),
-                                        gc.DataTuple('$MULTICAST_NODE_L1_XID',
-                                                     int_arr_val=[rid])])],
-            bfruntime_pb2.TableModIncFlag.MOD_INC_ADD)
 
+    def worker_add(self, mgid, rid, port, lane):
+        # get dev port for this worker
+        dev_port = self.ports.get_dev_port(port, lane)
 
+        if rid in self.rids[mgid]:
+            print("Worker {} already added to multicast group {}; skipping.".format(rid, mgid))
+            return
 
-    def worker_del(self, mgid, rid):
-        # remove group entry
-        self.mgid_table.entry_mod_inc(
-            self.target,
-            [self.mgid_table.make_key([gc.KeyTuple('$MGID', mgid)])],
-            [self.mgid_table.make_data([gc.DataTuple('$MULTICAST_NODE_ID', int_arr_val=[rid]),
-                                        gc.DataTuple('$MULTICAST_NODE_L1_XID_VALID',
-                                                     bool_arr_val=[False]),
-                                        gc.DataTuple('$MULTICAST_NODE_L1_XID', int_arr_val=[0])])],
-            bfruntime_pb2.TableModIncFlag.MOD_INC_DELETE)
+        # add to rid table for this group
+        self.rids[mgid][rid] = dev_port
+        self.mark_dirty(mgid)
 
-        # remove node entry
-        self.node_table.entry_del(
-            self.target,
-            [self.node_table.make_key([gc.KeyTuple('$MULTICAST_NODE_ID', rid)])])
 
+    def worker_del(self, mgid, rid):
         # delete from rid table
+        self.rids[mgid].pop(rid, None)
+        self.mark_dirty(mgid)
+
+    def worker_update(self, mgid, rid, port, lane):
+        # leave group alone if this rid is already on this port
         dev_port = self.ports.get_dev_port(port, lane)
-        del self.rids[mgid][dev_port]
+        if self.rids[mgid].get(rid) == dev_port:
+            return False
 
-        
-    def worker_clear_all(self, mgid):
-        for dev_port, rid in self.rids[mgid].items():
-            try:
-                # remove group entry
-                self.mgid_table.entry_mod_inc(
-                    self.target,
-                    [self.mgid_table.make_key([gc.KeyTuple('$MGID', mgid)])],
-                    [self.mgid_table.make_data([gc.DataTuple('$MULTICAST_NODE_ID', int_arr_val=[rid]),
-                                                gc.DataTuple('$MULTICAST_NODE_L1_XID_VALID',
-                                                             bool_arr_val=[False]),
-                                                gc.DataTuple('$MULTICAST_NODE_L1_XID', int_arr_val=[0])])],
-                    bfruntime_pb2.TableModIncFlag.MOD_INC_DELETE)
-            except gc.BfruntimeReadWriteRpcException as e:
-                self.logger.info("Multicast node ID {} remove from group {} failed; maybe it's already deleted?".format(rid, mgid))
-
-
-            try:
-                # remove node entry
-                self.node_table.entry_del(
-                    self.target,
-                    [self.node_table.make_key([gc.KeyTuple('$MULTICAST_NODE_ID', rid)])])
-            except gc.BfruntimeReadWriteRpcException as e:
-                self.logger.info("Multicast node ID {} delete failed; maybe it's already deleted?".format(rid))
-
-            del self.rids[mgid][dev_port]
-        
-    
-    def add_workers(self, switchml_workers_mgid, switchml_workers, all_ports_mgid, all_workers):
-        # target all pipes on device 0
-        target = gc.Target(device_id=0, pipe_id=0xffff)
+        # otherwise add it, or move it to its new port
+        self.rids[mgid][rid] = dev_port
+        self.mark_dirty(mgid)
+        return True
 
-        # compute list of ports for the all_ports group
-        all_ports = [self.ports.get_dev_port(worker.front_panel_port, worker.lane) for worker in all_workers]
         
-        # first, clean up old group if they exist
-        #self.mgid_table.entry_del(target) # ideally we could do this, but it's not supported.
-        try:
-            self.mgid_table.entry_del(
-                target,
-                [self.mgid_table.make_key([gc.KeyTuple('$MGID', switchml_workers_mgid)])])
-        except gc.BfruntimeReadWriteRpcException as e:
-            self.logger.info("Multicast group ID {} not found in switch already during delete; this is expected.".format(switchml_workers_mgid))
-            
-        try:
-            self.mgid_table.entry_del(
-                target,
-                [self.mgid_table.make_key([gc.KeyTuple('$MGID', all_ports_mgid)])])
-        except gc.BfruntimeReadWriteRpcException as e:
-            self.logger.info("Multicast group ID {} not found in switch already during delete; this is expected.".format(all_ports_mgid))
-
-        # and clean up old nodes if they exist
-        for worker in switchml_workers:
-            try:
-                self.node_table.entry_del(
-                    target,
-                    [self.node_table.make_key([gc.KeyTuple('$MULTICAST_NODE_ID', worker.rid)])])
-            except gc.BfruntimeReadWriteRpcException as e:
-                self.logger.info("Multicast node ID {} not found in switch already during delete; this is expected.".format(worker.rid))
-
-        for port in all_ports:
-            try:
-                self.node_table.entry_del(
-                    target,
-                    [self.node_table.make_key([gc.KeyTuple('$MULTICAST_NODE_ID', 0x8000 + port)])])
-            except gc.BfruntimeReadWriteRpcException as e:
-                self.logger.info("Multicast node ID {} not found in switch already during delete; this is expected.".format(port))
-
-        # now add new nodes
-        for worker in switchml_workers:
-            dev_port = self.ports.get_dev_port(worker.front_panel_port, worker.lane)
-            self.node_table.entry_add(
-                target,
-                [self.node_table.make_key([gc.KeyTuple('$MULTICAST_NODE_ID', worker.rid)])],
-                [self.node_table.make_data([gc.DataTuple('$MULTICAST_RID', worker.rid),
-                                            gc.DataTuple('$DEV_PORT', int_arr_val=[dev_port])])])
-
-        for port in all_ports:
-            self.node_table.entry_add(
-                target,
-                [self.node_table.make_key([gc.KeyTuple('$MULTICAST_NODE_ID', 0x8000 + port)])],
-                [self.node_table.make_data([gc.DataTuple('$MULTICAST_RID', 0x8000 + port),
-                                            gc.DataTuple('$DEV_PORT', int_arr_val=[port])])])
-
-        # now that nodes are added, create multicast groups
-        self.mgid_table.entry_add(
-            target,
-            [self.mgid_table.make_key([gc.KeyTuple('$MGID', switchml_workers_mgid)])],
-            [self.mgid_table.make_data([gc.DataTuple('$MULTICAST_NODE_ID',
-                                                     int_arr_val=[worker.rid for worker in switchml_workers]),
-                                        gc.DataTuple('$MULTICAST_NODE_L1_XID_VALID',
-                                                     bool_arr_val=[True for worker in switchml_workers]),
-                                        gc.DataTuple('$MULTICAST_NODE_L1_XID',
-                                                     int_arr_val=[worker.xid for worker in switchml_workers])])])
-        self.mgid_table.entry_add(
-            target,
-            [self.mgid_table.make_key([gc.KeyTuple('$MGID', all_ports_mgid)])],
-            [self.mgid_table.make_data([gc.DataTuple('$MULTICAST_NODE_ID',
-                                                     int_arr_val=[0x8000 + port for port in all_ports]),
-                                        gc.DataTuple('$MULTICAST_NODE_L1_XID_VALID',
-                                                     bool_arr_val=[True for port in all_ports]),
-                                        gc.DataTuple('$MULTICAST_NODE_L1_XID',
-                                                     int_arr_val=[0x8000 + port for port in all_ports])])])
-            
-
+    def worker_clear_all(self, mgid):
+        self.rids[mgid].clear()
+        self.mark_dirty(mgid)
@@ -0,0 +1,103 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+from FreeList import FreeList
+
+
+class PoolAllocator(FreeList):
+    """Allocator for slices of the pool. Slices are rounded up to a
+    power of two and aligned to their size, so a RoCE worker's
+    message-sized groups of pool indices never straddle a slice
+    boundary and freed slices merge back into larger ones."""
+
+    def __init__(self, size, min_slice_size=2):
+        super(PoolAllocator, self).__init__(0, size)
+
+        # smallest slice handed out; 2 covers both sets of one slot
+        self.min_slice_size = min_slice_size
+
+        # base -> pool indices requested, before rounding up
+        self.requested = {}
+
+    def slice_size(self, size):
+        'Round a request up to the power-of-two size of the slice that holds it.'
+        slice_size = self.min_slice_size
+        while slice_size < size:
+            slice_size <<= 1
+        return slice_size
+
+    def allocate(self, size):
+        slice_size = self.slice_size(size)
+        base = super(PoolAllocator, self).allocate(slice_size, slice_size)
+        self.requested[base] = size
+        return base
+
+    def reserve(self, base, size):
+        slice_size = self.slice_size(size)
+        if base % slice_size:
+            raise Exception("Error: pool base 0x{:x} is not aligned to slice size {}.".format(base, slice_size))
+        super(PoolAllocator, self).reserve(base, slice_size)
+        self.requested[base] = size
+        return base
+
+    def free(self, base):
+        super(PoolAllocator, self).free(base)
+        del self.requested[base]
+
+    def compact(self, movable):
+        """Pack slices toward the start of the pool to leave the free
+        space in as few ranges as possible. Only slices whose bases
+        are in movable are moved; others stay where they are. Returns
+        a dict of old base -> new base for each slice that moved."""
+        packed = FreeList(self.start, self.size)
+        for base, size in self.allocated.items():
+            if base not in movable:
+                packed.reserve(base, size)
+
+        # placing larger slices first never leaves a gap a smaller one can't fill
+        moves = {}
+        order = sorted((b for b in self.allocated if b in movable),
+                       key=lambda b: (-self.allocated[b], b))
+        for base in order:
+            try:
+                new_base = packed.allocate(self.allocated[base], self.allocated[base])
+            except Exception:
+                # slices that can't move left no room; keep the current layout
+                return {}
+            if new_base != base:
+                moves[base] = new_base
+
+        # only use the new layout if it leaves a larger free range,
+        # or the same largest range in fewer pieces
+        def layout(free_ranges):
+            return (max([s for b, s in free_ranges] or [0]), -len(free_ranges))
+        if not moves or layout(packed.free_ranges) <= layout(self.free_ranges):
+            return {}
+
+        self.free_ranges = packed.free_ranges
+        self.allocated = packed.allocated
+        self.requested = dict((moves.get(b, b), s) for b, s in self.requested.items())
+        return moves
+
+    def stats(self):
+        'Return a dict of pool utilization metrics.'
+        allocated = self.used_count()
+        requested = sum(self.requested.values())
+        free = self.free_count()
+        largest_free = max([s for b, s in self.free_ranges] or [0])
+        return {'size':             self.size,
+                'slices':           len(self.allocated),
+                'allocated':        allocated,
+                'requested':        requested,
+                'free':             free,
+                'free_ranges':      len(self.free_ranges),
+                'largest_free':     largest_free,
+                'utilization':      float(allocated) / self.size if self.size else 0.0,
+                'rounding_waste':   allocated - requested,
+                'fragmentation':    1.0 - float(largest_free) / free if free else 0.0}
+
+    def format_stats(self):
+        s = self.stats()
+        return ("Pool: {slices} slices using {allocated} of {size} pool indices ({utilization:.1%}); "
+                "{requested} requested, {rounding_waste} lost to rounding; "
+                "{free} free in {free_ranges} ranges, largest {largest_free} (fragmentation {fragmentation:.1%}).").format(**s)
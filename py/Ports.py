@@ -6,10 +6,17 @@ from pprint import pprint, pformat
 import bfrt_grpc.bfruntime_pb2 as bfruntime_pb2
 import bfrt_grpc.client as gc
 import grpc
+import os
+import socket
+import yaml
 
 class Ports(object):
 
-    def __init__(self, gc, bfrt_info):
+    # set while adopting the switch's state after a warm restart;
+    # ports are recorded as active but not written, like Table.adopting
+    adopting = False
+
+    def __init__(self, gc, bfrt_info, port_map_cache=None):
         # get logging, client, and global program info
         self.logger = logging.getLogger('Ports')
         self.gc = gc
@@ -30,12 +37,18 @@ class Ports(object):
         # FP port to dev port lookup table
         self.port_hdl_info_table = self.bfrt_info.table_get("$PORT_HDL_INFO")
 
-        # dev port to FP port reverse lookup table
-        self.dev_port_to_fp_port = None
+        # FP port/lane to dev port lookup table and its reverse,
+        # loaded once from the switch or from the cache file
+        self.fp_port_to_dev_port = {}
+        self.dev_port_to_fp_port = {}
+        self.load_port_map(port_map_cache)
 
         # list of active ports
         self.active_ports = []
 
+        # dev port -> (front panel port, lane, speed, FEC) each active port was added with
+        self.port_settings = {}
+
         # loopback ports
         self.loopback_ports = ([64] +                # Pipe 0 CPU ethernet port
                                #[444] +                # Pipe 0 CPU ethernet port
@@ -52,37 +65,75 @@ class Ports(object):
         self.pktgen_port_cfg_table = self.bfrt_info.table_get("$PKTGEN_PORT_CFG")
 
         
-    # get dev port
-    def get_dev_port(self, front_panel_port, lane):        
-        # convert front-panel port to dev port
+    # The port map depends only on the SDE and the switch it runs
+    # on, so a cached copy is only used if both match. Returns None
+    # if the SDE can't be identified.
+    def port_map_version(self):
+        sde = os.environ.get('SDE') or os.environ.get('SDE_INSTALL')
+        if not sde:
+            return None
+        return {'sde': os.path.basename(os.path.normpath(sde)),
+                'platform': socket.gethostname()}
+
+    # fill in both port maps, from the cache file if it's current, or
+    # with one bulk read of $PORT_HDL_INFO, saving it to the cache
+    def load_port_map(self, cache_filename=None):
+        version = self.port_map_version()
+
+        # without an SDE version, a cache from an older SDE can't be detected
+        if cache_filename and version is None:
+            self.logger.warning("Neither $SDE nor $SDE_INSTALL is set; not using port map cache {}.".format(cache_filename))
+            cache_filename = None
+
+        if cache_filename and os.path.exists(cache_filename):
+            try:
+                with open(cache_filename) as f:
+                    cache = yaml.safe_load(f)
+                if cache and cache.get('version') == version:
+                    self.set_port_map((fp_port, lane, dev_port) for fp_port, lane, dev_port in cache['ports'])
+                    self.logger.info("Loaded {} ports from {}".format(len(self.fp_port_to_dev_port), cache_filename))
+                    return
+                self.logger.info("Port map cache {} is for a different SDE or platform; ignoring.".format(cache_filename))
+            except Exception as e:
+                self.logger.warning("Couldn't read port map cache {}: {}".format(cache_filename, e))
+
         resp = self.port_hdl_info_table.entry_get(
             self.target,
-            [self.port_hdl_info_table.make_key([gc.KeyTuple('$CONN_ID', front_panel_port),
-                                                gc.KeyTuple('$CHNL_ID', lane)])],
+            [],
             {"from_hw": False})
-        dev_port = next(resp)[0].to_dict()["$DEV_PORT"]
-        #self.logger.debug("Got dev port {} for front panel port {}/{}".format(dev_port, front_panel_port, lane))
 
-        return dev_port
+        ports = []
+        for v, k in resp:
+            v = v.to_dict()
+            k = k.to_dict()
+            ports.append((k['$CONN_ID']['value'], k['$CHNL_ID']['value'], v['$DEV_PORT']))
+        self.set_port_map(ports)
+        self.logger.info("Read {} ports from switch".format(len(self.fp_port_to_dev_port)))
+
+        if cache_filename:
+            try:
+                with open(cache_filename, 'w') as f:
+                    yaml.safe_dump({'version': version,
+                                    'ports': [list(p) for p in sorted(ports)]}, f)
+            except Exception as e:
+                self.logger.warning("Couldn't write port map cache {}: {}".format(cache_filename, e))
+
+    def set_port_map(self, ports):
+        self.fp_port_to_dev_port = {}
+        self.dev_port_to_fp_port = {}
+        for fp_port, lane, dev_port in ports:
+            self.fp_port_to_dev_port[(fp_port, lane)] = dev_port
+            self.dev_port_to_fp_port[dev_port] = (fp_port, lane)
+
+    # get dev port
+    def get_dev_port(self, front_panel_port, lane):
+        # convert front-panel port to dev port
+        if (front_panel_port, lane) not in self.fp_port_to_dev_port:
+            raise Exception("Error: front panel port {}/{} doesn't exist.".format(front_panel_port, lane))
+        return self.fp_port_to_dev_port[(front_panel_port, lane)]
 
     # get front panel port from dev port
     def get_fp_port(self, dev_port):
-        # if we haven't filled the reverse mapping dict yet, do so
-        if self.dev_port_to_fp_port is None:
-            self.dev_port_to_fp_port = {}
-
-            # get all ports
-            resp = self.port_hdl_info_table.entry_get(
-                self.target,
-                [],
-                {"from_hw": False})
-
-            # fill in dictionary
-            for v, k in resp:
-                v = v.to_dict()
-                k = k.to_dict()
-                self.dev_port_to_fp_port[v['$DEV_PORT']] = (k['$CONN_ID']['value'], k['$CHNL_ID']['value'])
-
         # look up front panel port/lane from dev port
         return self.dev_port_to_fp_port[dev_port]
 
@@ -108,6 +159,9 @@ class Ports(object):
         
         for (front_panel_port, lane, speed, fec) in port_list:
             self.logger.info("Adding port {}".format((front_panel_port, lane, speed, fec)))
+            self.port_settings[self.get_dev_port(front_panel_port, lane)] = (front_panel_port, lane, speed, fec)
+            if self.adopting:
+                continue
             self.port_table.entry_add(
                 self.target,
                 [self.port_table.make_key([gc.KeyTuple('$DEV_PORT', self.get_dev_port(front_panel_port, lane))])],
@@ -136,6 +190,24 @@ class Ports(object):
         self.add_ports([(front_panel_port, lane, speed, fec)])
 
 
+    # compare active ports with the switch's port table, with one
+    # read. Returns a list of (table name, key, problem) tuples.
+    def verify(self):
+        installed = {}
+        for v, k in self.port_table.entry_get(self.target, [], {'from_hw': False}):
+            installed[k.to_dict()['$DEV_PORT']['value']] = v.to_dict()
+
+        problems = []
+        for dev_port in sorted(self.active_ports):
+            front_panel_port, lane, speed, fec = self.port_settings[dev_port]
+            key = {'$DEV_PORT': dev_port}
+            if dev_port not in installed:
+                problems.append(('$PORT', key, "port {}/{} missing on switch".format(front_panel_port, lane)))
+            elif installed[dev_port].get('$SPEED') != "BF_SPEED_{}G".format(speed):
+                problems.append(('$PORT', key, "port {}/{} speed is {}, expected {}G".format(
+                    front_panel_port, lane, installed[dev_port].get('$SPEED'), speed)))
+        return problems
+
     # delete all ports
     def delete_all_ports(self):
         self.logger.info("Deleting all ports...")
@@ -154,6 +226,7 @@ class Ports(object):
 
         # clear active ports list
         self.active_ports = []
+        self.port_settings = {}
 
     # delete one port
     def port_delete(self, front_panel_port, lane):
@@ -162,6 +235,7 @@ class Ports(object):
 
         # remove from our local active port list
         self.active_ports.remove(dev_port)
+        self.port_settings.pop(dev_port, None)
 
         # remove on switch
         self.port_table.entry_del(
@@ -282,6 +356,9 @@ class Ports(object):
     def enable_loopback_ports(self):
         # enable loopback on front panel ports
 
+        if self.adopting:
+            return
+
         self.logger.info("Enabling loopback on {} front panel ports...".format(len(self.loopback_ports)))
 
         self.port_table.entry_add(
@@ -7,6 +7,7 @@ import bfrt_grpc.bfruntime_pb2 as bfruntime_pb2
 import bfrt_grpc.client as gc
 import grpc
 import struct
+import functools
 
 from Table import Table
 from Worker import Worker, WorkerType, PacketSize
@@ -45,56 +46,63 @@ class RDMAReceiver(Table):
 
     def clear(self):
         self.worker_ids = []
+
+        # configuration of each installed worker, indexed by rid
+        self.workers = {}
         
         if self.table is not None:
-            self.table.entry_del(self.target)
+            self.clear_entries(self.table)
             
-        if self.rdma_message_counter is not None:
-            # # this doesn't work yet!
-            #self.rdma_message_counter.entry_del(self.target)
-            #self.rdma_sequence_violation_counter.entry_del(self.target)
+        if self.rdma_message_counter is not None and not self.adopting:
+            # pre-filling all the counters takes a while, so do it in the background during startup
+            self.clear_later(self.zero_counters)
 
-            # generate clear operations for both message and sequence violation countsers
-            
-            #keys_resp = self.rdma_message_counter.entry_get(self.target)
-
-            packet_keys = []
-            packet_values = []
-            message_keys = []
-            message_values = []
-            sequence_violation_keys = []
-            sequence_violation_values = []
-            drop_keys = []
-            drop_values = []
-            for i in range(self.rdma_message_counter.info.size):
-                packet_keys.append(self.rdma_packet_counter.make_key([gc.KeyTuple('$COUNTER_INDEX', i)]))
-                packet_values.append(self.rdma_packet_counter.make_data([gc.DataTuple('$COUNTER_SPEC_PKTS', 0)]))
-                message_keys.append(self.rdma_message_counter.make_key([gc.KeyTuple('$COUNTER_INDEX', i)]))
-                message_values.append(self.rdma_message_counter.make_data([gc.DataTuple('$COUNTER_SPEC_PKTS', 0)]))
-                sequence_violation_keys.append(self.rdma_sequence_violation_counter.make_key([gc.KeyTuple('$COUNTER_INDEX', i)]))
-                sequence_violation_values.append(self.rdma_sequence_violation_counter.make_data([gc.DataTuple('$COUNTER_SPEC_PKTS', 0)]))
-                drop_keys.append(self.simulated_drop_counter.make_key([gc.KeyTuple('$COUNTER_INDEX', i)]))
-                drop_values.append(self.simulated_drop_counter.make_data([gc.DataTuple('$COUNTER_SPEC_PKTS', 0)]))
-
-            self.rdma_packet_counter.entry_add(
-                self.target,
-                packet_keys,
-                packet_values)
-
-            self.rdma_message_counter.entry_add(
-                self.target,
-                message_keys,
-                message_values)
-
-            self.rdma_sequence_violation_counter.entry_add(
-                self.target,
-                sequence_violation_keys,
-                sequence_violation_values)
-
-            self.simulated_drop_counter.entry_add(
-                self.target,
-                drop_keys,
-                drop_values)
+    def zero_counters(self):
+        # # this doesn't work yet!
+        #self.rdma_message_counter.entry_del(self.target)
+        #self.rdma_sequence_violation_counter.entry_del(self.target)
+
+        # generate clear operations for both message and sequence violation countsers
+        
+        #keys_resp = self.rdma_message_counter.entry_get(self.target)
+
+        packet_keys = []
+        packet_values = []
+        message_keys = []
+        message_values = []
+        sequence_violation_keys = []
+        sequence_violation_values = []
+        drop_keys = []
+        drop_values = []
+        for i in range(self.rdma_message_counter.info.size):
+            packet_keys.append(self.rdma_packet_counter.make_key([gc.KeyTuple('$COUNTER_INDEX', i)]))
+            packet_values.append(self.rdma_packet_counter.make_data([gc.DataTuple('$COUNTER_SPEC_PKTS', 0)]))
+            message_keys.append(self.rdma_message_counter.make_key([gc.KeyTuple('$COUNTER_INDEX', i)]))
+            message_values.append(self.rdma_message_counter.make_data([gc.DataTuple('$COUNTER_SPEC_PKTS', 0)]))
+            sequence_violation_keys.append(self.rdma_sequence_violation_counter.make_key([gc.KeyTuple('$COUNTER_INDEX', i)]))
+            sequence_violation_values.append(self.rdma_sequence_violation_counter.make_data([gc.DataTuple('$COUNTER_SPEC_PKTS', 0)]))
+            drop_keys.append(self.simulated_drop_counter.make_key([gc.KeyTuple('$COUNTER_INDEX', i)]))
+            drop_values.append(self.simulated_drop_counter.make_data([gc.DataTuple('$COUNTER_SPEC_PKTS', 0)]))
+
+        self.rdma_packet_counter.entry_add(
+            self.target,
+            packet_keys,
+            packet_values)
+
+        self.rdma_message_counter.entry_add(
+            self.target,
+            message_keys,
+            message_values)
+
+        self.rdma_sequence_violation_counter.entry_add(
+            self.target,
+            sequence_violation_keys,
+            sequence_violation_values)
+
+        self.simulated_drop_counter.entry_add(
+            self.target,
+            drop_keys,
+            drop_values)
 
         
     # Add SwitchML RoCE v2 entry to table
@@ -109,10 +117,78 @@ class RDMAReceiver(Table):
         if num_workers > 0x8000:
             self.logger.error("Worker count {} too large; only 32K workers supported by this code.".format(num_workers))
 
-        # remember worker id
-        self.worker_ids.append(worker_rid)
-            
-        # add entry for each opcode for each worker
+        # remember worker id and its configuration
+        old_config = self.workers.get(worker_rid)
+        if worker_rid not in self.worker_ids:
+            self.worker_ids.append(worker_rid)
+        self.workers[worker_rid] = (switch_mac, switch_ip, switch_partition_key, switch_mgid,
+                                    worker_ip, worker_rid, worker_bitmap, worker_packet_size,
+                                    num_workers)
+
+        # send all six entries at once (or queue them if batching)
+        keys, datas = self.worker_entries(*self.workers[worker_rid])
+        self.add_entries(self.table, keys, datas)
+        self.undo_write(functools.partial(self.restore_worker, worker_rid, old_config))
+
+
+    # Bring a worker's entries in line with the requested
+    # configuration, touching the switch only if something changed.
+    # Returns True if any entries were written.
+    def update_entry(self, switch_mac, switch_ip, switch_partition_key, switch_mgid,
+                     worker_ip, worker_rid, worker_bitmap, worker_packet_size,
+                     num_workers):
+        config = (switch_mac, switch_ip, switch_partition_key, switch_mgid,
+                  worker_ip, worker_rid, worker_bitmap, worker_packet_size,
+                  num_workers)
+        old_config = self.workers.get(worker_rid)
+
+        if old_config == config:
+            return False
+
+        if old_config is None:
+            self.add_entry(*config)
+        elif old_config[1:3] + old_config[4:6] == config[1:3] + config[4:6]:
+            # same match keys, so just modify action data in place
+            self.logger.info("Updating RDMA worker {}".format(worker_ip))
+            self.workers[worker_rid] = config
+            keys, datas = self.worker_entries(*config, clear_counters=False)
+            self.mod_entries(self.table, keys, datas)
+            self.undo_write(functools.partial(self.restore_worker, worker_rid, old_config))
+        else:
+            self.del_entry(worker_rid)
+            self.add_entry(*config)
+
+        return True
+
+
+    def del_entry(self, worker_rid):
+        self.logger.info("Removing RDMA worker {}".format(worker_rid))
+        old_config = self.workers.pop(worker_rid)
+        keys, datas = self.worker_entries(*old_config)
+        self.worker_ids.remove(worker_rid)
+        self.del_entries(self.table, keys)
+        self.undo_write(functools.partial(self.restore_worker, worker_rid, old_config))
+
+
+    # Put back a worker's configuration if the batch writing its
+    # entries failed; None means the worker wasn't installed.
+    def restore_worker(self, worker_rid, config):
+        if config is None:
+            self.workers.pop(worker_rid, None)
+            if worker_rid in self.worker_ids:
+                self.worker_ids.remove(worker_rid)
+        else:
+            self.workers[worker_rid] = config
+            if worker_rid not in self.worker_ids:
+                self.worker_ids.append(worker_rid)
+
+
+    # Build keys and data for all of a worker's entries, one per opcode.
+    def worker_entries(self, switch_mac, switch_ip, switch_partition_key, switch_mgid,
+                       worker_ip, worker_rid, worker_bitmap, worker_packet_size,
+                       num_workers, clear_counters=True):
+        keys = []
+        datas = []
         for opcode, action in [
                 # (rdma_opcode_s2n['UC_SEND_FIRST'],  'Ingress.rdma_receiver.first_packet'),
                 # (rdma_opcode_s2n['UC_SEND_MIDDLE'], 'Ingress.rdma_receiver.middle_packet'),
@@ -127,62 +203,48 @@ class RDMAReceiver(Table):
                 (rdma_opcode_s2n['UC_RDMA_WRITE_LAST_IMMEDIATE'],   'Ingress.rdma_receiver.last_packet_immediate'),
                 (rdma_opcode_s2n['UC_RDMA_WRITE_ONLY_IMMEDIATE'],   'Ingress.rdma_receiver.only_packet_immediate')]:
             qpn_top_bits = 0x800000 | ((worker_rid & 0xff) << 16)
-            self.table.entry_add(
-                self.target,
-                [self.table.make_key([gc.KeyTuple('$MATCH_PRIORITY', 10), # doesn't matter
-                                      # match on Ethernet addrs, IPs and port
-                                      gc.KeyTuple('hdr.ipv4.src_addr',
-                                                  worker_ip),
-                                      gc.KeyTuple('hdr.ipv4.dst_addr',
-                                                  switch_ip),
-                                      gc.KeyTuple('hdr.ib_bth.partition_key',
-                                                  switch_partition_key),
-                                      gc.KeyTuple('hdr.ib_bth.opcode',
-                                                  opcode),
-                                      gc.KeyTuple('hdr.ib_bth.dst_qp',
-                                                  qpn_top_bits,   # match on top bits of QP to allow for multiple clients on same machine.
-                                                  0xff0000)])],
-                [self.table.make_data([gc.DataTuple('mgid', switch_mgid),
-                                       gc.DataTuple('worker_type', WorkerType.ROCEv2),
-                                       # gc.DataTuple('worker_id', struct.pack('@H', worker_rid)),
-                                       # gc.DataTuple('num_workers', struct.pack('@H', num_workers)),
-                                       gc.DataTuple('worker_id',  worker_rid),
-                                       gc.DataTuple('num_workers', num_workers),
-                                       gc.DataTuple('packet_size', worker_packet_size),
-                                       gc.DataTuple('worker_bitmap', worker_bitmap)],
-                                      action)])
-
-            # clear counters
-            self.table.entry_mod(
-                self.target,
-                [self.table.make_key([gc.KeyTuple('$MATCH_PRIORITY', 10),
-                                      # match on Ethernet addrs, IPs and port
-                                      gc.KeyTuple('hdr.ipv4.src_addr',
-                                                  worker_ip),
-                                      gc.KeyTuple('hdr.ipv4.dst_addr',
-                                                  switch_ip),
-                                      gc.KeyTuple('hdr.ib_bth.partition_key',
-                                                  switch_partition_key),
-                                      gc.KeyTuple('hdr.ib_bth.opcode',
-                                                  opcode),
-                                      gc.KeyTuple('hdr.ib_bth.dst_qp',
-                                                  qpn_top_bits,   # match on top bits of QP to allow for multiple clients on same machine.
-                                                  0xff0000)])],
-                [self.table.make_data([gc.DataTuple('$COUNTER_SPEC_BYTES', 0),
-                                       gc.DataTuple('$COUNTER_SPEC_PKTS', 0)],
-                                      action)])
-
-
-    def print_counters(self):
+            keys.append(
+                self.table.make_key([gc.KeyTuple('$MATCH_PRIORITY', 10), # doesn't matter
+                                     # match on Ethernet addrs, IPs and port
+                                     gc.KeyTuple('hdr.ipv4.src_addr',
+                                                 worker_ip),
+                                     gc.KeyTuple('hdr.ipv4.dst_addr',
+                                                 switch_ip),
+                                     gc.KeyTuple('hdr.ib_bth.partition_key',
+                                                 switch_partition_key),
+                                     gc.KeyTuple('hdr.ib_bth.opcode',
+                                                 opcode),
+                                     gc.KeyTuple('hdr.ib_bth.dst_qp',
+                                                 qpn_top_bits,   # match on top bits of QP to allow for multiple clients on same machine.
+                                                 0xff0000)]))
+            data = [gc.DataTuple('mgid', switch_mgid),
+                    gc.DataTuple('worker_type', WorkerType.ROCEv2),
+                    # gc.DataTuple('worker_id', struct.pack('@H', worker_rid)),
+                    # gc.DataTuple('num_workers', struct.pack('@H', num_workers)),
+                    gc.DataTuple('worker_id',  worker_rid),
+                    gc.DataTuple('num_workers', num_workers),
+                    gc.DataTuple('packet_size', worker_packet_size),
+                    gc.DataTuple('worker_bitmap', worker_bitmap)]
+
+            # counters are set to zero as part of the add, so we
+            # don't need a separate entry_mod to clear them
+            if clear_counters:
+                data.extend([gc.DataTuple('$COUNTER_SPEC_BYTES', 0),
+                             gc.DataTuple('$COUNTER_SPEC_PKTS', 0)])
+
+            datas.append(self.table.make_data(data, action))
+
+        return keys, datas
+
+
+    # Returns a dict of worker id -> (worker ip, packets, bytes)
+    def get_counters(self):
         self.table.operations_execute(self.target, 'SyncCounters')
         resp = self.table.entry_get(
             self.target,
             flags={"from_hw": False})
 
-        ips = {}
-        total_packets = {}
-        total_bytes = {}
-        #total_messages = {}
+        counters = {}
         
         for v, k in resp:
             v = v.to_dict()
@@ -195,28 +257,40 @@ class RDMAReceiver(Table):
             worker_packets = v['$COUNTER_SPEC_PKTS']
             worker_bytes = v['$COUNTER_SPEC_BYTES']
 
-            if worker_id not in ips:
-                ips[worker_id] = worker_ip
-                total_packets[worker_id] = worker_packets
-                total_bytes[worker_id]   = worker_bytes
+            # sum over all opcodes for this worker
+            if worker_id in counters:
+                ip, packets, bytes = counters[worker_id]
+                counters[worker_id] = ip, packets + worker_packets, bytes + worker_bytes
             else:
-                total_packets[worker_id] = total_packets[worker_id] + worker_packets
-                total_bytes[worker_id]   = total_bytes[worker_id] + worker_bytes
+                counters[worker_id] = worker_ip, worker_packets, worker_bytes
 
-        for i, p in total_packets.items():
-            ip = ips[i]
-            b = total_bytes[i]
+        return counters
+
+    def print_counters(self):
+        for i, (ip, p, b) in sorted(self.get_counters().items()):
             print("Received from worker {:2} at {:15}: {:10} packets, {:10} bytes".format(i, ip, p, b))
 
 
+    # Read per-queue-pair counters for a list of counter indices, or
+    # all of them if ids is None. Returns a (4, len(ids)) array with
+    # rows for packets, messages, sequence violations and simulated
+    # drops.
+    def get_queue_pair_counter_array(self, ids=None):
+        return self.read_counters([self.rdma_packet_counter,
+                                   self.rdma_message_counter,
+                                   self.rdma_sequence_violation_counter,
+                                   self.simulated_drop_counter], ids)
+
+    # Read per-queue-pair counters for a list of counter indices.
+    # Returns dicts of index -> value for packets, messages,
+    # sequence violations and simulated drops.
+    def get_queue_pair_counter_values(self, ids):
+        values = self.get_queue_pair_counter_array(ids)
+        return [dict(zip(ids, row.tolist())) for row in values]
+
+
     #def get_queue_pair_counters(self, start=None, count=None):
     def get_queue_pair_counters(self, start=0, count=8):
-        # get other per-queue-pair info
-        self.rdma_packet_counter.operations_execute(self.target, 'Sync')
-        self.rdma_message_counter.operations_execute(self.target, 'Sync')
-        self.rdma_sequence_violation_counter.operations_execute(self.target, 'Sync')
-        self.simulated_drop_counter.operations_execute(self.target, 'Sync')
-
         ids = [worker_id * self.worker_counter_offset + offset
                for worker_id in self.worker_ids
                for offset in range(start, start+count)]
@@ -225,102 +299,24 @@ class RDMAReceiver(Table):
         if len(ids) == 0:
             print("No queue pairs currently in use.")
             return
-        
-        packets_resp = self.rdma_packet_counter.entry_get(
-            self.target,
-            [self.rdma_packet_counter.make_key([gc.KeyTuple('$COUNTER_INDEX', i)])
-             for i in ids], #range(start, start+count)],
-            flags={"from_hw": False})
-        messages_resp = self.rdma_message_counter.entry_get(
-            self.target,
-            [self.rdma_message_counter.make_key([gc.KeyTuple('$COUNTER_INDEX', i)])
-             for i in ids], #range(start, start+count)],
-            flags={"from_hw": False})
-        sequence_violations_resp = self.rdma_sequence_violation_counter.entry_get(
-            self.target,
-            [self.rdma_sequence_violation_counter.make_key([gc.KeyTuple('$COUNTER_INDEX', i)])
-             for i in ids], #range(start, start+count)],
-            flags={"from_hw": False})
-        drop_resp = self.simulated_drop_counter.entry_get(
-            self.target,
-            [self.simulated_drop_counter.make_key([gc.KeyTuple('$COUNTER_INDEX', i)])
-             for i in ids], #range(start, start+count)],
-            flags={"from_hw": False})
-        # else:
-        #     r1 = self.rdma_message_counter.entry_get(
-        #         self.target,
-        #         flags={"from_hw": False})
-        #     r2 = self.rdma_sequence_violation_counter.entry_get(
-        #         self.target,
-        #         flags={"from_hw": False})
-
-        packets = {}
-        messages = {}
-        sequence_violations = {}
-        drops = {}
-        worker_ids = {}
-        queue_pair_numbers = {}
-        
-        for v, k in packets_resp:
-            v = v.to_dict()
-            k = k.to_dict()
-            packets[k['$COUNTER_INDEX']['value']] = v['$COUNTER_SPEC_PKTS']
-            worker_ids[k['$COUNTER_INDEX']['value']] = k['$COUNTER_INDEX']['value'] / self.worker_counter_offset
-            queue_pair_numbers[k['$COUNTER_INDEX']['value']] = k['$COUNTER_INDEX']['value'] % self.worker_counter_offset
 
-        for v, k in messages_resp:
-            v = v.to_dict()
-            k = k.to_dict()
-            messages[k['$COUNTER_INDEX']['value']] = v['$COUNTER_SPEC_PKTS']
+        # get per-queue-pair info for all workers at once
+        packets, messages, sequence_violations, drops = self.get_queue_pair_counter_array(ids)
 
-        for v, k in sequence_violations_resp:
-            v = v.to_dict()
-            k = k.to_dict()
-            sequence_violations[k['$COUNTER_INDEX']['value']] = v['$COUNTER_SPEC_PKTS']
-
-        for v, k in drop_resp:
-            v = v.to_dict()
-            k = k.to_dict()
-            drops[k['$COUNTER_INDEX']['value']] = v['$COUNTER_SPEC_PKTS']
-
-            
         print("Queue Pair Index   Worker ID  Worker Queue Pair Number     Packets    Messages  Sequence Violations  Simulated Drops")
-        for i in ids:
+        for j, i in enumerate(ids):
             print("{:>16}  {:>10}  {:>24}  {:>10}  {:>10}  {:>19}  {:>15}".format(i,
-                                                                                  worker_ids[i],
-                                                                                  queue_pair_numbers[i],
-                                                                                  packets[i],
-                                                                                  messages[i],
-                                                                                  sequence_violations[i],
-                                                                                  drops[i]))
+                                                                                  i // self.worker_counter_offset,
+                                                                                  i % self.worker_counter_offset,
+                                                                                  packets[j],
+                                                                                  messages[j],
+                                                                                  sequence_violations[j],
+                                                                                  drops[j]))
 
             
     def clear_counters(self):
         self.logger.info("Clearing rdma_receiver counters...")
-        self.table.operations_execute(self.target, 'SyncCounters')
-        resp = self.table.entry_get(
-            self.target,
-            flags={"from_hw": False})
-
-        keys = []
-        values = []
-        
-        for v, k in resp:
-            keys.append(k)
-
-            v = v.to_dict()
-            k = k.to_dict()
-
-            values.append(
-                self.table.make_data(
-                    [gc.DataTuple('$COUNTER_SPEC_BYTES', 0),
-                     gc.DataTuple('$COUNTER_SPEC_PKTS', 0)],
-                    v['action_name']))
-
-        self.table.entry_mod(
-            self.target,
-            keys,
-            values)
+        self.clear_direct_counters(self.table)
 
         self.rdma_packet_counter.entry_del(self.target)
         self.rdma_message_counter.entry_del(self.target)
@@ -8,6 +8,7 @@ import bfrt_grpc.client as gc
 import grpc
 
 import struct
+import functools
 import math
 
 from Table import Table
@@ -103,13 +104,17 @@ class RDMASender(Table):
         self.add_default_entries()
 
     def clear(self):
+        # configuration of each installed worker, indexed by rid
+        self.workers = {}
+
+        self.clear_entries(self.create_roce_packet);
+        self.clear_entries(self.fill_in_qpn_and_psn);
+        if self.adopting:
+            return
+
         self.switch_mac_and_ip.entry_del(self.target);
         self.switch_mac_and_ip.default_entry_reset(self.target);
-        
-        self.create_roce_packet.entry_del(self.target);
         self.create_roce_packet.default_entry_reset(self.target);
-
-        self.fill_in_qpn_and_psn.entry_del(self.target);
         self.fill_in_qpn_and_psn.default_entry_reset(self.target);
 
         #self.set_opcodes.entry_del(self.target);
@@ -117,14 +122,18 @@ class RDMASender(Table):
 
         
     def clear_workers(self):
-        self.create_roce_packet.entry_del(self.target);
+        self.workers = {}
+
+        self.clear_entries(self.create_roce_packet);
         self.create_roce_packet.default_entry_reset(self.target);
 
-        self.fill_in_qpn_and_psn.entry_del(self.target);
+        self.clear_entries(self.fill_in_qpn_and_psn);
         self.fill_in_qpn_and_psn.default_entry_reset(self.target);
 
         
     def add_default_entries(self):
+        if self.adopting:
+            return
 
         # set switch MAC/IP and message size and mask
         self.switch_mac_and_ip.default_entry_set(
@@ -179,16 +188,16 @@ class RDMASender(Table):
     # simple version first, with one QP per worker
     def add_send_worker(self, rid, mac, ip, qpn, initial_psn, rkey=None):
         # first, add entry to fill in headers for RoCE packet
-        self.create_roce_packet.entry_add(
-        self.target,
+        self.add_entries(
+            self.create_roce_packet,
             [self.create_roce_packet.make_key([gc.KeyTuple('eg_md.switchml_md.worker_id', rid)])],
             [self.create_roce_packet.make_data([gc.DataTuple('dest_mac', mac),
                                                 gc.DataTuple('dest_ip', ip)],
                                                'Egress.rdma_sender.fill_in_roce_fields')])
 
         # now, add entry to add QPN and PSN to packet
-        self.fill_in_qpn_and_psn.entry_add(
-            self.target,
+        self.add_entries(
+            self.fill_in_qpn_and_psn,
             [self.fill_in_qpn_and_psn.make_key([gc.KeyTuple('eg_md.switchml_md.worker_id', rid),
                                                 gc.KeyTuple('eg_md.switchml_md.pool_index', 0x00000, 0x00000)])],
             [self.fill_in_qpn_and_psn.make_data([gc.DataTuple('qpn', qpn),
@@ -199,18 +208,131 @@ class RDMASender(Table):
 
     # RDMA write capable version
     # qpns_and_psns is a list of qpn, psn tuples
-    def add_write_worker(self, rid, mac, ip, rkey, packet_size, message_size, qpns_and_psns):
+    # pool_base is the first pool index of the worker's job
+    def add_write_worker(self, rid, mac, ip, rkey, packet_size, message_size, qpns_and_psns, pool_base=0):
+        # remember configuration so the worker can be updated or removed later
+        old_config = self.workers.get(rid)
+        self.workers[rid] = (mac, ip, rkey, packet_size, message_size, list(qpns_and_psns), pool_base)
+
         # first, add entry to fill in headers for RoCE packet
-        self.create_roce_packet.entry_add(
-        self.target,
-            [self.create_roce_packet.make_key([gc.KeyTuple('eg_md.switchml_md.worker_id', rid)])],
-            [self.create_roce_packet.make_data([gc.DataTuple('dest_mac', mac),
-                                                gc.DataTuple('dest_ip', ip),
-                                                gc.DataTuple('base_addr', 0), # TODO: shouldn't need this when using 0-based addressing
-                                                gc.DataTuple('rkey', rkey)],                                                
-                                               'Egress.rdma_sender.fill_in_roce_write_fields')])
+        self.add_entries(
+            self.create_roce_packet,
+            [self.create_roce_packet_key(rid)],
+            [self.create_roce_packet_data(mac, ip, rkey)])
+
+        # now, add entry to add QPN and PSN to packet
+        # each QPN handles both sets of a slot in the pool
+        keys = []
+        datas = []
+        for shifted_index, mask, qpn in self.queue_pair_entries(packet_size, message_size, qpns_and_psns, pool_base):
+            keys.append(self.fill_in_qpn_and_psn_key(rid, shifted_index, mask))
+            datas.append(self.fill_in_qpn_and_psn_data(qpn))
+
+        # send all queue pairs for this worker at once (or queue them if batching)
+        self.logger.info("Adding {} queue pairs for worker {}".format(len(keys), rid))
+        self.add_entries(self.fill_in_qpn_and_psn, keys, datas)
+        self.undo_write(functools.partial(self.restore_worker, rid, old_config))
+
+
+    # Bring a worker's entries in line with the requested
+    # configuration, writing only the entries that changed.
+    # Returns True if any entries were written.
+    def update_write_worker(self, rid, mac, ip, rkey, packet_size, message_size, qpns_and_psns, pool_base=0):
+        config = (mac, ip, rkey, packet_size, message_size, list(qpns_and_psns), pool_base)
+        old_config = self.workers.get(rid)
+
+        if old_config == config:
+            return False
+
+        if old_config is None:
+            self.add_write_worker(rid, *config)
+            return True
+
+        self.workers[rid] = config
+
+        # modify packet header entry if addresses changed
+        if old_config[0:3] != config[0:3]:
+            self.mod_entries(
+                self.create_roce_packet,
+                [self.create_roce_packet_key(rid)],
+                [self.create_roce_packet_data(mac, ip, rkey)])
+
+        # compare queue pair entries by their pool index match
+        old_entries = dict(((i, m), q) for i, m, q in self.queue_pair_entries(*old_config[3:]))
+        new_entries = dict(((i, m), q) for i, m, q in self.queue_pair_entries(*config[3:]))
+
+        del_keys = [self.fill_in_qpn_and_psn_key(rid, i, m)
+                    for (i, m) in old_entries if (i, m) not in new_entries]
+        mod_keys = []
+        mod_datas = []
+        add_keys = []
+        add_datas = []
+        for (i, m), qpn in new_entries.items():
+            if (i, m) not in old_entries:
+                add_keys.append(self.fill_in_qpn_and_psn_key(rid, i, m))
+                add_datas.append(self.fill_in_qpn_and_psn_data(qpn))
+            elif old_entries[(i, m)] != qpn:
+                mod_keys.append(self.fill_in_qpn_and_psn_key(rid, i, m))
+                mod_datas.append(self.fill_in_qpn_and_psn_data(qpn))
+
+        self.logger.info("Updating worker {}: removing {}, modifying {}, and adding {} queue pairs".format(
+            rid, len(del_keys), len(mod_keys), len(add_keys)))
+        if del_keys:
+            self.del_entries(self.fill_in_qpn_and_psn, del_keys)
+        if mod_keys:
+            self.mod_entries(self.fill_in_qpn_and_psn, mod_keys, mod_datas)
+        if add_keys:
+            self.add_entries(self.fill_in_qpn_and_psn, add_keys, add_datas)
+        self.undo_write(functools.partial(self.restore_worker, rid, old_config))
+
+        return True
+
+
+    def del_write_worker(self, rid):
+        old_config = self.workers.pop(rid)
+        mac, ip, rkey, packet_size, message_size, qpns_and_psns, pool_base = old_config
+        self.logger.info("Removing worker {}".format(rid))
+        self.del_entries(
+            self.fill_in_qpn_and_psn,
+            [self.fill_in_qpn_and_psn_key(rid, i, m)
+             for i, m, q in self.queue_pair_entries(packet_size, message_size, qpns_and_psns, pool_base)])
+        self.del_entries(self.create_roce_packet, [self.create_roce_packet_key(rid)])
+        self.undo_write(functools.partial(self.restore_worker, rid, old_config))
+
+
+    # Put back a worker's configuration if the batch writing its
+    # entries failed; None means the worker wasn't installed.
+    def restore_worker(self, rid, config):
+        if config is None:
+            self.workers.pop(rid, None)
+        else:
+            self.workers[rid] = config
 
 
+    def create_roce_packet_key(self, rid):
+        return self.create_roce_packet.make_key([gc.KeyTuple('eg_md.switchml_md.worker_id', rid)])
+
+    def create_roce_packet_data(self, mac, ip, rkey):
+        return self.create_roce_packet.make_data([gc.DataTuple('dest_mac', mac),
+                                                  gc.DataTuple('dest_ip', ip),
+                                                  gc.DataTuple('base_addr', 0), # TODO: shouldn't need this when using 0-based addressing
+                                                  gc.DataTuple('rkey', rkey)],
+                                                 'Egress.rdma_sender.fill_in_roce_write_fields')
+
+    def fill_in_qpn_and_psn_key(self, rid, shifted_index, mask):
+        return self.fill_in_qpn_and_psn.make_key([gc.KeyTuple('eg_md.switchml_md.worker_id', rid),
+                                                  gc.KeyTuple('eg_md.switchml_md.pool_index',
+                                                              shifted_index,
+                                                              mask)])
+
+    def fill_in_qpn_and_psn_data(self, qpn):
+        return self.fill_in_qpn_and_psn.make_data([gc.DataTuple('qpn', qpn),
+                                                   #gc.DataTuple('Egress.rdma_sender.psn_register.f1', initial_psn)],
+                                                   ],
+                                                  'Egress.rdma_sender.add_qpn_and_psn')
+
+
+    def packets_per_message(self, packet_size, message_size):
         if packet_size == PacketSize.IBV_MTU_128:
             packet_size = 128
         elif packet_size == PacketSize.IBV_MTU_256:
@@ -222,11 +344,24 @@ class RDMASender(Table):
         
         packets_per_message = message_size / packet_size
 
-        print(packet_size, message_size, packets_per_message)
+        self.logger.debug("{}B packets, {}B messages, {} packets per message".format(
+            packet_size, message_size, packets_per_message))
+
+        return packets_per_message
+
+
+    # number of pool indices (both sets of each slot) used by a worker
+    def pool_size(self, packet_size, message_size, num_queue_pairs):
+        return num_queue_pairs * self.packets_per_message(packet_size, message_size) * 2
+
+
+    # compute (pool index, mask, qpn) for each of a worker's queue pairs
+    def queue_pair_entries(self, packet_size, message_size, qpns_and_psns, pool_base=0):
+        packets_per_message = self.packets_per_message(packet_size, message_size)
         
         log2_packets_per_message = math.log(packets_per_message, 2)
         if log2_packets_per_message != int(log2_packets_per_message):
-            self.logger.error("Number of {}B packets per {}B message is not a power of 2!".format(packet_size, message_size))
+            self.logger.error("Number of packets per {}B message is not a power of 2!".format(message_size))
         else:
             log2_packets_per_message = int(log2_packets_per_message)
             
@@ -236,48 +371,36 @@ class RDMASender(Table):
         # per-packet payload size, shifted left once to skip the slot
         # bit.
         first_last_mask = ((packets_per_message) - 1) << 1
-        self.logger.info("First last mask is 0x{:x}".format(first_last_mask))
+        self.logger.debug("First last mask is 0x{:x}".format(first_last_mask))
 
+        # pool base bits inside a message would be masked off
+        if pool_base & (first_last_mask | 1):
+            self.logger.error("Pool base 0x{:x} is not aligned to {}B messages!".format(pool_base, message_size))
 
-        # now, add entry to add QPN and PSN to packet
-        # each QPN handles both sets of a slot in the pool
+        entries = []
         for index, (qpn, initial_psn) in enumerate(qpns_and_psns):
             # shifted_index = index << 3
             # mask = 0x7ff8;
             # shifted_index = index << 5
             # mask = 0x7ffe & ~self.first_last_mask;
 
-            shifted_index = index << (log2_packets_per_message + 1) # 1 extra for slot bit
+            shifted_index = pool_base + (index << (log2_packets_per_message + 1)) # 1 extra for slot bit
             mask = 0x7ffe & ~first_last_mask;
 
-            
-            print("Adding qpn {} and psn {} for index {:x} mask {:x}".format(qpn, initial_psn, shifted_index, mask))
-            self.fill_in_qpn_and_psn.entry_add(
-                self.target,
-                [self.fill_in_qpn_and_psn.make_key([gc.KeyTuple('eg_md.switchml_md.worker_id', rid),
-                                                    gc.KeyTuple('eg_md.switchml_md.pool_index',
-                                                                shifted_index,
-                                                                mask)])],
-                [self.fill_in_qpn_and_psn.make_data([gc.DataTuple('qpn', qpn),
-                                                     #gc.DataTuple('Egress.rdma_sender.psn_register.f1', initial_psn)],
-                                                     ],
-                                                    'Egress.rdma_sender.add_qpn_and_psn')])
+            self.logger.debug("Adding qpn {} and psn {} for index {:x} mask {:x}".format(qpn, initial_psn, shifted_index, mask))
+            entries.append((shifted_index, mask, qpn))
 
+        return entries
 
 
-
-
-
-
-
-
-
-    def print_counters(self):
+    # Returns a dict of worker id -> (worker ip, packets, bytes)
+    def get_counters(self):
         self.create_roce_packet.operations_execute(self.target, 'SyncCounters')
         resp = self.create_roce_packet.entry_get(
             self.target,
             flags={"from_hw": False})
 
+        counters = {}
         for v, k in resp:
             v = v.to_dict()
             k = k.to_dict()
@@ -289,33 +412,15 @@ class RDMASender(Table):
             worker_packets = v['$COUNTER_SPEC_PKTS']
             worker_bytes = v['$COUNTER_SPEC_BYTES']
 
+            counters[worker_id] = worker_ip, worker_packets, worker_bytes
+
+        return counters
+
+    def print_counters(self):
+        for worker_id, (worker_ip, worker_packets, worker_bytes) in sorted(self.get_counters().items()):
             print("Sent to worker       {:2} at {:15}: {:10} packets, {:10} bytes".format(worker_id, worker_ip, worker_packets, worker_bytes))
 
 
     def clear_counters(self):
         self.logger.info("Clearing rdma_sender counters...")
-        self.create_roce_packet.operations_execute(self.target, 'SyncCounters')
-        resp = self.create_roce_packet.entry_get(
-            self.target,
-            flags={"from_hw": False})
-
-        keys = []
-        values = []
-        
-        for v, k in resp:
-            keys.append(k)
-
-            v = v.to_dict()
-            k = k.to_dict()
-
-            values.append(
-                self.create_roce_packet.make_data(
-                    [gc.DataTuple('$COUNTER_SPEC_BYTES', 0),
-                     gc.DataTuple('$COUNTER_SPEC_PKTS', 0)],
-                    v['action_name']))
-
-        self.create_roce_packet.entry_mod(
-            self.target,
-            keys,
-            values)
-        
+        self.clear_direct_counters(self.create_roce_packet)
@@ -37,10 +37,14 @@ class SetDstAddr(Table):
         self.add_default_entries()
 
     def clear(self):
-        self.table.entry_del(self.target)
-        self.switch_mac_and_ip.entry_del(self.target)
+        self.clear_entries(self.table)
+        if not self.adopting:
+            self.switch_mac_and_ip.entry_del(self.target)
         
     def add_default_entries(self):
+        if self.adopting:
+            return
+
         # set switch MAC/IP and message size and mask
         self.switch_mac_and_ip.default_entry_set(
             self.target,
@@ -49,29 +53,35 @@ class SetDstAddr(Table):
                                              'Egress.set_dst_addr.set_switch_mac_and_ip'))
 
     def clear_udp_entries(self):
-        self.table.entry_del(self.target)
+        self.clear_entries(self.table)
 
     # Add SwitchML UDP entry to table
     def add_udp_entry(self, worker_rid, worker_mac, worker_ip):
         self.logger.info("Adding worker {} {} at rid {}".format(worker_mac, worker_ip, worker_rid))
 
-        # target all pipes on device 0
-        target = gc.Target(device_id=0, pipe_id=0xffff)
-
-        self.table.entry_add(
-            target,
+        self.add_entries(
+            self.table,
             [self.table.make_key([gc.KeyTuple('eg_md.switchml_md.worker_id',
                                               worker_rid)])],
             [self.table.make_data([gc.DataTuple('eth_dst_addr', worker_mac),
                                    gc.DataTuple('ip_dst_addr', worker_ip)],
                                   'Egress.set_dst_addr.set_dst_addr_for_SwitchML_UDP')])
 
-    def print_counters(self):
+    def del_udp_entry(self, worker_rid):
+        self.logger.info("Removing worker at rid {}".format(worker_rid))
+        self.del_entries(
+            self.table,
+            [self.table.make_key([gc.KeyTuple('eg_md.switchml_md.worker_id',
+                                              worker_rid)])])
+
+    # Returns a dict of worker id -> (worker ip, packets, bytes)
+    def get_counters(self):
         self.table.operations_execute(self.target, 'SyncCounters')
         resp = self.table.entry_get(
             self.target,
             flags={"from_hw": False})
 
+        counters = {}
         for v, k in resp:
             v = v.to_dict()
             k = k.to_dict()
@@ -80,34 +90,16 @@ class SetDstAddr(Table):
             worker_ip = v['ip_dst_addr']
             worker_packets = v['$COUNTER_SPEC_PKTS']
             worker_bytes = v['$COUNTER_SPEC_BYTES']
-            
-            print("Sent to worker       {:2} at {:15}: {:10} packets, {:10} bytes".format(worker_id, worker_ip, worker_packets, worker_bytes))
             #print("key {}: value {}".format(pformat(k), pformat(v)))
-            
-    def clear_counters(self):
-        self.logger.info("Clearing set_dst_addr counters...")
-        self.table.operations_execute(self.target, 'SyncCounters')
-        resp = self.table.entry_get(
-            self.target,
-            flags={"from_hw": False})
-
-        keys = []
-        values = []
-        
-        for v, k in resp:
-            keys.append(k)
 
-            v = v.to_dict()
-            k = k.to_dict()
+            counters[worker_id] = worker_ip, worker_packets, worker_bytes
 
-            values.append(
-                self.table.make_data(
-                    [gc.DataTuple('$COUNTER_SPEC_BYTES', 0),
-                     gc.DataTuple('$COUNTER_SPEC_PKTS', 0)],
-                    v['action_name']))
+        return counters
 
-        self.table.entry_mod(
-            self.target,
-            keys,
-            values)
+    def print_counters(self):
+        for worker_id, (worker_ip, worker_packets, worker_bytes) in sorted(self.get_counters().items()):
+            print("Sent to worker       {:2} at {:15}: {:10} packets, {:10} bytes".format(worker_id, worker_ip, worker_packets, worker_bytes))
             
+    def clear_counters(self):
+        self.logger.info("Clearing set_dst_addr counters...")
+        self.clear_direct_counters(self.table)
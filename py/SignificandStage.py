@@ -45,7 +45,7 @@ class SignificandStage(Table):
         # just clear registers
         self.clear_registers()
 
-    def clear_registers(self):
+    def clear_registers(self, pool_size=None, pool_base=0):
         self.logger.info("Clearing significand registers...")
 
         # target all pipes on device 0
@@ -9,11 +9,15 @@ import grpc
 
 from timeit import default_timer as timer
 
-from Table import Table
+from Table import Table, TableHandle
 
 
 class SignificandSum(Table):
 
+    # looked up when first used, since there are 32 of these
+    table    = TableHandle("pipe.Ingress.sum{n:02d}.significand_sum")
+    register = TableHandle("pipe.Ingress.sum{n:02d}.significands")
+
     def __init__(self, client, bfrt_info, n):
         # set up base class
         super(SignificandSum, self).__init__(client, bfrt_info)
@@ -27,8 +31,7 @@ class SignificandSum(Table):
         # else:
         #     self.table    = self.bfrt_info.table_get("pipe.Ingress.sum{:02d}.significand_sum".format(n))
         #     self.register = self.bfrt_info.table_get("pipe.Ingress.sum{:02d}.significands".format(n))
-        self.table    = self.bfrt_info.table_get("pipe.Ingress.sum{:02d}.significand_sum".format(n))
-        self.register = self.bfrt_info.table_get("pipe.Ingress.sum{:02d}.significands".format(n))
+        self.n = n
 
         # clear register
         self.clear()
@@ -36,15 +39,15 @@ class SignificandSum(Table):
         
     def clear(self):
         # override base class method so we don't clear entries set by p4 code
-        # just clear registers
-        self.clear_registers()
+        # just clear registers, in the background during startup
+        self.clear_later(self.clear_registers)
 
-    def clear_registers(self):
+    def clear_registers(self, pool_size=None, pool_base=0):
         self.logger.info("Clearing significand sum register...")
 
         # for each register in sum
         start = timer()
-        self.register.entry_del(self.target)
+        self.clear_register(self.register, pool_size, pool_base)
         end = timer()
         self.logger.info("Cleared register in {} seconds...".format((end-start)))
         
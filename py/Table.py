@@ -6,9 +6,140 @@ from pprint import pprint, pformat
 import bfrt_grpc.bfruntime_pb2 as bfruntime_pb2
 import bfrt_grpc.client as gc
 import grpc
+import numpy as np
+
+from collections import OrderedDict
+from timeit import default_timer as timer
+
+
+def key_identity(key):
+    'Return a hashable value identifying the entry a key matches.'
+    return tuple(sorted((name, tuple(sorted(field.items())))
+                        for name, field in key.to_dict().items()))
+
+
+class WriteBatch(object):
+    """Collect table writes and send them as one bulk RPC per table and operation."""
+
+    def __init__(self, target):
+        self.logger = logging.getLogger('WriteBatch')
+        self.target = target
+
+        # ordered list of [operation, table, keys, datas] groups
+        self.groups = []
+
+        # index of the most recent group for each table, so
+        # consecutive writes of the same kind to a table can be merged
+        # into one RPC
+        self.last_group = {}
+
+        # (group index, function) pairs that roll back local state if
+        # that group isn't sent
+        self.undo_log = []
+
+        # functions to call once after the writes are sent
+        self.deferred = []
+
+    def write(self, operation, table, keys, datas=None):
+        'Queue a write and return the index of the group it will be sent in.'
+        index = self.last_group.get(id(table))
+        if index is not None and self.groups[index][0] == operation:
+            group = self.groups[index]
+            group[2].extend(keys)
+            if datas is not None:
+                group[3].extend(datas)
+        else:
+            index = len(self.groups)
+            self.groups.append([operation, table, list(keys), list(datas) if datas is not None else None])
+            self.last_group[id(table)] = index
+        return index
+
+    def undo(self, index, function):
+        'Call function if the flush fails before group index is sent.'
+        self.undo_log.append((index, function))
+
+    def defer(self, function):
+        'Call function once after the next flush.'
+        if function not in self.deferred:
+            self.deferred.append(function)
+
+    def flush(self):
+        start = timer()
+        count = 0
+        try:
+            for index, (operation, table, keys, datas) in enumerate(self.groups):
+                # while adopting the switch's state, nothing is written
+                if not keys or Table.adopting:
+                    continue
+                try:
+                    if operation == 'del':
+                        table.entry_del(self.target, keys)
+                    else:
+                        getattr(table, 'entry_' + operation)(self.target, keys, datas)
+                except Exception:
+                    self.logger.error("Writing {} entries to {} failed; rolling back {} unsent groups.".format(
+                        len(keys), table.info.name_get(), len(self.groups) - index))
+                    self.rollback(index)
+                    raise
+                count = count + len(keys)
+        finally:
+            groups = len(self.groups)
+            self.groups = []
+            self.last_group = {}
+            self.undo_log = []
+        end = timer()
+
+        if groups:
+            self.logger.info("Flushed {} entries in {} RPCs in {} seconds.".format(
+                count, groups, end - start))
+
+        deferred = self.deferred
+        self.deferred = []
+        for function in deferred:
+            function()
+
+    def rollback(self, failed):
+        """Undo the local state changes that went with the groups from
+        failed on, newest first, so the shadow and each object's state
+        match what actually reached the switch. The failed group
+        counts as not sent, even if the switch applied part of it."""
+        for index, function in reversed(self.undo_log):
+            if index >= failed:
+                function()
+
+
+class TableHandle(object):
+    """Class attribute standing for a table handle that is looked up
+    the first time it's used instead of when the object is created.
+    The name is formatted with the object's attributes, so numbered
+    blocks can share one definition."""
+
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, obj, cls=None):
+        if obj is None:
+            return self
+        return obj.table_get(self.name.format(**vars(obj)))
+
 
 class Table(object):
 
+    # child clases must set table, in the constructor or as a TableHandle
+    table = None
+
+    # table handles looked up so far, by program info and name
+    table_handles = {}
+
+    # set while the job starts up; whole-register and counter clears
+    # are collected here and run in the background afterward
+    startup_clears = None
+
+    # set while the controller adopts the state already on the switch
+    # after a warm restart: writes are skipped, but each object still
+    # updates its local state and shadow as if they had been sent
+    adopting = False
+
     def __init__(self, client, bfrt_info):
         # get logging, client, and global program info
         self.logger = logging.getLogger('Table')
@@ -18,21 +149,227 @@ class Table(object):
         # target all pipes on device 0
         self.target = gc.Target(device_id=0, pipe_id=0xffff)
 
-        # child clases must set table
-        self.table = None
-
         # lowest possible  priority for ternary match rules
         self.lowest_priority = 1 << 24
-        
+
+        # if set, writes are collected here instead of being sent immediately
+        self.batch = None
+
+        # keys and data of entries installed through the write
+        # helpers, indexed by table name and key identity, so entries
+        # can be read and rewritten without going to the switch
+        self.shadow = {}
+        self.shadow_tables = {}
+
+        # (batch, group index) of the last group this object's writes
+        # went into since undo_write was last called
+        self.written = None
+
+
+    def table_get(self, name):
+        'Return the handle of a table, looking it up only the first time any object needs it.'
+        handles = Table.table_handles.setdefault(self.bfrt_info, {})
+        if name not in handles:
+            handles[name] = self.bfrt_info.table_get(name)
+        return handles[name]
+
+    def clear_later(self, function, *args):
+        """Call function now, or during startup, queue it to run in
+        the background with the other bulk clears. While adopting,
+        it's called now, since it won't write anything."""
+        if Table.startup_clears is not None and not Table.adopting:
+            Table.startup_clears.append((function, args))
+        else:
+            function(*args)
 
     def clear(self):
         """Remove all existing entries in table."""
         if self.table is not None:
-            self.table.entry_del(self.target)
+            self.clear_entries(self.table)
 
             # # try to reinsert default entry if it exists
             # try:
             #     self.table.default_entry_reset(self.target)
             # except:
             #     pass
-            
+
+    #
+    # write helpers; these go through the current batch if there is one
+    #
+
+    def add_entries(self, table, keys, datas):
+        if self.batch is not None:
+            self.shadow_undo(table, keys, self.batch.write('add', table, keys, datas))
+        elif not self.adopting:
+            table.entry_add(self.target, keys, datas)
+        self.shadow_update(table, keys, datas)
+
+    def mod_entries(self, table, keys, datas):
+        if self.batch is not None:
+            self.shadow_undo(table, keys, self.batch.write('mod', table, keys, datas))
+        elif not self.adopting:
+            table.entry_mod(self.target, keys, datas)
+        self.shadow_update(table, keys, datas)
+
+    def del_entries(self, table, keys):
+        if self.batch is not None:
+            self.shadow_undo(table, keys, self.batch.write('del', table, keys))
+        elif not self.adopting:
+            table.entry_del(self.target, keys)
+        entries = self.shadow_entries(table)
+        for key in keys:
+            entries.pop(key_identity(key), None)
+
+    def undo_write(self, function):
+        """Call function if any write this object queued in the
+        current batch since the last call isn't sent, to roll back the
+        local state that went with the writes. Without a batch, writes
+        are sent right away, so there's nothing to roll back."""
+        if self.written is not None and self.written[0] is self.batch:
+            self.batch.undo(self.written[1], function)
+        self.written = None
+
+    def clear_entries(self, table):
+        """Remove all entries in a table."""
+        if not self.adopting:
+            table.entry_del(self.target)
+        self.shadow_entries(table).clear()
+
+    #
+    # shadow of installed entries
+    #
+
+    def shadow_entries(self, table):
+        'Return the ordered dict of key identity -> (key, data) for entries installed in table.'
+        name = table.info.name_get()
+        if name not in self.shadow:
+            self.shadow[name] = OrderedDict()
+            self.shadow_tables[name] = table
+        return self.shadow[name]
+
+    def shadow_undo(self, table, keys, index):
+        'Put the shadow entries for keys back as they are now if batch group index is not sent.'
+        entries = self.shadow_entries(table)
+        saved = [(identity, entries.get(identity)) for identity in map(key_identity, keys)]
+
+        def undo():
+            for identity, entry in saved:
+                if entry is None:
+                    entries.pop(identity, None)
+                else:
+                    entries[identity] = entry
+
+        self.batch.undo(index, undo)
+        if self.written is None or self.written[0] is not self.batch:
+            self.written = (self.batch, index)
+        else:
+            self.written = (self.batch, max(index, self.written[1]))
+
+    def shadow_update(self, table, keys, datas):
+        entries = self.shadow_entries(table)
+        for key, data in zip(keys, datas):
+            entries[key_identity(key)] = (key, data)
+
+    def get_entries(self, table, from_hw=False):
+        """Return (data dict, key dict) pairs for the entries in a
+        table, like entry_get. Entries are served from the shadow
+        unless hardware values such as counters are needed."""
+        if from_hw:
+            return [(v.to_dict(), k.to_dict()) for v, k in
+                    table.entry_get(self.target, flags={"from_hw": True})]
+        return [(data.to_dict(), key.to_dict()) for key, data in self.shadow_entries(table).values()]
+
+    def verify_shadow(self):
+        """Compare the shadow of each table with the entries on the
+        switch. Returns a list of (table name, key, problem) tuples
+        for entries missing on the switch, entries not in the shadow,
+        and fields with different values."""
+        problems = []
+        for name, entries in self.shadow.items():
+            table = self.shadow_tables[name]
+            installed = {}
+            for v, k in table.entry_get(self.target, flags={"from_hw": False}):
+                installed[key_identity(k)] = (k.to_dict(), v.to_dict())
+
+            for identity, (key, data) in entries.items():
+                if identity not in installed:
+                    problems.append((name, key.to_dict(), "missing on switch"))
+                    continue
+                expected = data.to_dict()
+                actual = installed.pop(identity)[1]
+                for field, value in sorted(expected.items()):
+                    # counters change as packets arrive
+                    if field.startswith('$COUNTER_SPEC') or field not in actual:
+                        continue
+                    if actual[field] != value:
+                        problems.append((name, key.to_dict(), "{} is {}, expected {}".format(
+                            field, actual[field], value)))
+
+            for key, actual in installed.values():
+                problems.append((name, key, "not in shadow"))
+
+        return problems
+
+    def clear_direct_counters(self, table):
+        """Zero the direct counters of all entries installed in a
+        table with one entry_mod, using the shadow instead of reading
+        the entries back."""
+        entries = self.shadow_entries(table).values()
+        if not entries:
+            return
+
+        # entries with the same action can share the same data
+        datas = {}
+        for key, data in entries:
+            if data.action_name not in datas:
+                datas[data.action_name] = table.make_data(
+                    [gc.DataTuple('$COUNTER_SPEC_BYTES', 0),
+                     gc.DataTuple('$COUNTER_SPEC_PKTS', 0)],
+                    data.action_name)
+
+        table.entry_mod(
+            self.target,
+            [key for key, data in entries],
+            [datas[data.action_name] for key, data in entries])
+
+    def clear_register(self, register, count=None, start=0):
+        """Zero count entries of a register from start, or all of them if count is None."""
+        if self.adopting:
+            return
+
+        if start == 0 and (count is None or count >= register.info.size):
+            register.entry_del(self.target)
+            return
+
+        if count is None:
+            count = register.info.size - start
+        count = min(count, register.info.size - start)
+        if count > 0:
+            fields = register.info.data_field_name_list_get()
+            register.entry_mod(
+                self.target,
+                [register.make_key([gc.KeyTuple('$REGISTER_INDEX', i)])
+                 for i in range(start, start + count)],
+                [register.make_data([gc.DataTuple(f, 0) for f in fields])] * count)
+
+    def read_counters(self, counters, indices=None, field='$COUNTER_SPEC_PKTS'):
+        """Read indexed counter tables with one Sync and one wildcard
+        read each. Returns a (len(counters), count) int64 array with
+        the values at indices, or at every index if indices is None."""
+        values = np.zeros((len(counters), max(c.info.size for c in counters)), dtype=np.int64)
+        for row, counter in enumerate(counters):
+            counter.operations_execute(self.target, 'Sync')
+            resp = counter.entry_get(
+                self.target,
+                flags={"from_hw": False})
+
+            read = []
+            counts = []
+            for v, k in resp:
+                read.append(k.to_dict()['$COUNTER_INDEX']['value'])
+                counts.append(v.to_dict()[field])
+            values[row, read] = counts
+
+        if indices is None:
+            return values
+        return values[:, np.asarray(indices, dtype=np.int64)]
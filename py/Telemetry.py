@@ -0,0 +1,159 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import logging
+import threading
+import time
+
+import numpy as np
+
+from CounterSnapshot import CounterSnapshot
+
+
+class Telemetry(object):
+    """Sample switch counters in the background and compute rates."""
+
+    # per-worker counter rows
+    RX_PACKETS = CounterSnapshot.RX_PACKETS
+    RX_BYTES   = CounterSnapshot.RX_BYTES
+    TX_PACKETS = CounterSnapshot.TX_PACKETS
+    TX_BYTES   = CounterSnapshot.TX_BYTES
+
+    # per-queue-pair counter rows; simulated drops aren't kept
+    QP_PACKETS             = CounterSnapshot.QP_PACKETS
+    QP_MESSAGES            = CounterSnapshot.QP_MESSAGES
+    QP_SEQUENCE_VIOLATIONS = CounterSnapshot.QP_SEQUENCE_VIOLATIONS
+
+    # pool counter columns, in NextStep.get_counter_values order
+    POOL_RECIRCULATED  = CounterSnapshot.POOL_RECIRCULATED
+    POOL_BROADCAST     = CounterSnapshot.POOL_BROADCAST
+    POOL_RETRANSMITTED = CounterSnapshot.POOL_RETRANSMITTED
+    POOL_DROPPED       = CounterSnapshot.POOL_DROPPED
+
+    def __init__(self, job, interval=1.0, history=300,
+                 max_num_workers=32, queue_pairs_per_worker=64):
+        self.logger = logging.getLogger('Telemetry')
+        self.job = job
+        self.interval = interval
+        self.history = history
+        self.max_num_workers = max_num_workers
+        self.queue_pairs_per_worker = queue_pairs_per_worker
+
+        # preallocated ring buffer; sample n is stored at n % history.
+        # values are kept as doubles so differences can't wrap. to
+        # bound its size, only the first queue_pairs_per_worker queue
+        # pairs of each worker are kept.
+        self.times = np.zeros(history)
+        self.worker_counters = np.zeros((history, 4, max_num_workers))
+        self.queue_pair_counters = np.zeros((history, 3, max_num_workers, queue_pairs_per_worker))
+        self.pool_counters = np.zeros((history, 4))
+
+        # workers and their queue pair count in the most recent sample
+        self.workers = {}
+
+        # number of samples taken so far
+        self.samples = 0
+
+        # protects the ring buffer; notified on each new sample
+        self.condition = threading.Condition()
+
+        self.thread = None
+        self.stop_event = threading.Event()
+
+    def start(self):
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, name='Telemetry')
+        self.thread.daemon = True
+        self.thread.start()
+        self.logger.info("Sampling counters every {} seconds.".format(self.interval))
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def run(self):
+        while not self.stop_event.is_set():
+            start = time.time()
+            try:
+                self.sample()
+            except Exception:
+                self.logger.exception("Counter sample failed")
+            self.stop_event.wait(max(0, self.interval - (time.time() - start)))
+
+    def sample(self):
+        'Read all counters once and store them in the next ring buffer slot.'
+        snapshot = CounterSnapshot(self.job, None, self.max_num_workers, self.queue_pairs_per_worker)
+
+        with self.condition:
+            i = self.samples % self.history
+            self.times[i] = snapshot.timestamp
+            self.worker_counters[i] = snapshot.worker_counters
+            self.queue_pair_counters[i] = snapshot.queue_pair_counters[:3]
+
+            # pool counters, summed over the slots in use
+            self.pool_counters[i] = snapshot.pool_counters.sum(axis=1)
+
+            self.workers = snapshot.workers
+            self.samples += 1
+            self.condition.notify_all()
+
+    def wait_for_sample(self, seen, timeout=None):
+        'Wait until more than seen samples have been taken; returns the sample count.'
+        with self.condition:
+            if self.samples <= seen:
+                self.condition.wait(timeout)
+            return self.samples
+
+    def rates(self, sample=None):
+        """Per-second rates between a sample and the one before it.
+
+        Returns None if there aren't two samples yet. Otherwise
+        returns a dict with timestamp, interval, and arrays of
+        worker rates (4 x max_num_workers), queue pair rates
+        (3 x max_num_workers x queue_pairs_per_worker) and pool
+        rates (4), along with the workers present in the sample.
+        """
+        with self.condition:
+            if sample is None:
+                sample = self.samples - 1
+            if sample < 1 or sample >= self.samples or self.samples - sample >= self.history:
+                return None
+
+            current = sample % self.history
+            previous = (sample - 1) % self.history
+            interval = self.times[current] - self.times[previous]
+            if interval <= 0:
+                return None
+
+            # counters may be cleared between samples, so don't report negative rates
+            return {'timestamp': self.times[current],
+                    'interval': interval,
+                    'workers': dict(self.workers),
+                    'worker_rates': np.maximum(self.worker_counters[current] - self.worker_counters[previous], 0) / interval,
+                    'queue_pair_rates': np.maximum(self.queue_pair_counters[current] - self.queue_pair_counters[previous], 0) / interval,
+                    'pool_rates': np.maximum(self.pool_counters[current] - self.pool_counters[previous], 0) / interval}
+
+    def print_rates(self):
+        rates = self.rates()
+        if rates is None:
+            print("Not enough samples yet.")
+            return
+
+        print("Rates over {:.3f} seconds:".format(rates['interval']))
+        w = rates['worker_rates']
+        for worker_id in sorted(rates['workers']):
+            print("Worker {:2}: received {:12.1f} packets/s {:14.1f} bytes/s, sent {:12.1f} packets/s {:14.1f} bytes/s".format(
+                worker_id,
+                w[self.RX_PACKETS, worker_id], w[self.RX_BYTES, worker_id],
+                w[self.TX_PACKETS, worker_id], w[self.TX_BYTES, worker_id]))
+
+        p = rates['pool_rates']
+        print("Pool: {:12.1f} recirculated/s {:12.1f} broadcast/s {:12.1f} retransmitted/s {:12.1f} dropped/s".format(
+            p[self.POOL_RECIRCULATED], p[self.POOL_BROADCAST], p[self.POOL_RETRANSMITTED], p[self.POOL_DROPPED]))
@@ -6,23 +6,26 @@ from pprint import pprint, pformat
 import bfrt_grpc.bfruntime_pb2 as bfruntime_pb2
 import bfrt_grpc.client as gc
 import grpc
+import time
 
+import numpy as np
 
-from Table import Table
+from Table import Table, TableHandle
+import bitmap_analyze
 
 
 class UpdateAndCheckWorkerBitmap(Table):
 
+    # looked up when first used
+    table    = TableHandle("pipe.Ingress.update_and_check_worker_bitmap.update_and_check_worker_bitmap")
+    register = TableHandle("pipe.Ingress.update_and_check_worker_bitmap.worker_bitmap")
+
     def __init__(self, client, bfrt_info):
         # set up base class
         super(UpdateAndCheckWorkerBitmap, self).__init__(client, bfrt_info)
 
         self.logger = logging.getLogger('UpdateAndCheckWorkerBitmap')
         self.logger.info("Setting up update_and_check_worker_bitmap table...")
-        
-        # get this table
-        self.table    = self.bfrt_info.table_get("pipe.Ingress.update_and_check_worker_bitmap.update_and_check_worker_bitmap")
-        self.register = self.bfrt_info.table_get("pipe.Ingress.update_and_check_worker_bitmap.worker_bitmap")
 
         # clear and add defaults
         self.clear() # don't clear entries from p4 code; just clear registers
@@ -30,14 +33,19 @@ class UpdateAndCheckWorkerBitmap(Table):
 
     def clear(self):
         # override base class method so we don't clear entries set by p4 code
-        # just clear registers
-        self.clear_registers()
+        # just clear registers, in the background during startup
+        self.clear_later(self.clear_registers)
 
-    def clear_registers(self):
+    def clear_registers(self, pool_size=None, pool_base=0):
         self.logger.info("Clearing bitmap registers...")
 
-        # clear all register entries
-        self.register.entry_del(self.target)
+        # bitmap register holds both sets of a slot in one entry
+        start = pool_base // 2
+        if pool_size is not None:
+            pool_size = (pool_base + pool_size + 1) // 2 - start
+
+        # clear register entries for pool slots in use, or all of them
+        self.clear_register(self.register, pool_size, start)
         
         
     def add_default_entries(self):
@@ -45,36 +53,67 @@ class UpdateAndCheckWorkerBitmap(Table):
         pass
     
 
-    def show_bitmaps(self, start=0, count=8):
-        resp = self.register.entry_get(
-            self.target,
-            [self.register.make_key([gc.KeyTuple('$REGISTER_INDEX', i)])
-             for i in range(start, start+count)],
-            flags={"from_hw": True})
-
+    def get_bitmaps(self, start=0, count=None):
+        """Read bitmap register entries from start, or all of them if
+        count is None. Returns an array of the pool indices read and a
+        (count, 2, pipes) uint32 array with the bitmaps of both sets in
+        each pipe."""
+        if count is None:
+            resp = self.register.entry_get(
+                self.target,
+                [],
+                flags={"from_hw": True})
+        else:
+            resp = self.register.entry_get(
+                self.target,
+                [self.register.make_key([gc.KeyTuple('$REGISTER_INDEX', i)])
+                 for i in range(start, start+count)],
+                flags={"from_hw": True})
+
+        indices = []
+        set0 = []
+        set1 = []
         for v, k in resp:
             v = v.to_dict()
             k = k.to_dict()
+            indices.append(k['$REGISTER_INDEX']['value'])
+            set0.append(v['Ingress.update_and_check_worker_bitmap.worker_bitmap.first'])
+            set1.append(v['Ingress.update_and_check_worker_bitmap.worker_bitmap.second'])
+
+        if not indices:
+            return np.zeros(0, dtype=np.int64), np.zeros((0, 2, 0), dtype=np.uint32)
+        bitmaps = np.array([set0, set1], dtype=np.uint32)
+        return np.array(indices, dtype=np.int64), bitmaps.transpose(1, 0, 2)
+
+    def get_snapshot(self, start=0, count=None):
+        'Read bitmaps as with get_bitmaps, in a dict with the time they were read.'
+        timestamp = time.time()
+        indices, bitmaps = self.get_bitmaps(start, count)
+        return {'timestamp': timestamp,
+                'indices':   indices,
+                'bitmaps':   bitmaps}
 
-            #print k, v
-            pool_index = k['$REGISTER_INDEX']['value']
-            set0 = v['Ingress.update_and_check_worker_bitmap.worker_bitmap.first'][0]
-            set1 = v['Ingress.update_and_check_worker_bitmap.worker_bitmap.second'][0]
+    def show_bitmaps(self, start=0, count=8):
+        indices, bitmaps = self.get_bitmaps(start, count)
+        for pool_index, (set0, set1) in zip(indices, bitmaps[:, :, 0]):
             print("Pool index 0x{:04x}: set 0: 0x{:08x} set 1:0x{:08x}".format(pool_index, set0, set1))
 
     def show_weird_bitmaps(self):
-        resp = self.register.entry_get(
-            self.target,
-            [],
-            flags={"from_hw": True})
-
-        for v, k in resp:
-            v = v.to_dict()
-            k = k.to_dict()
-
-            pool_index = k['$REGISTER_INDEX']['value']
-            set0 = v['Ingress.update_and_check_worker_bitmap.worker_bitmap.first'][0]
-            set1 = v['Ingress.update_and_check_worker_bitmap.worker_bitmap.second'][0]
-
-            if set0 is not 0 and set1 is not 0:
-                print("Pool index 0x{:04x}: set 0: 0x{:08x} set 1:0x{:08x}".format(pool_index, set0, set1))
+        indices, bitmaps = self.get_bitmaps()
+        bitmaps = bitmaps[:, :, 0]
+        for i in np.flatnonzero((bitmaps != 0).all(axis=1)):
+            print("Pool index 0x{:04x}: set 0: 0x{:08x} set 1:0x{:08x}".format(indices[i], bitmaps[i, 0], bitmaps[i, 1]))
+
+    def show_analysis(self, complete_bitmap, snapshots=2, interval=1.0):
+        """Take a series of snapshots interval seconds apart and print
+        slot occupancy for the last one and any sets stuck across all
+        of them."""
+        series = []
+        for i in range(snapshots):
+            if i:
+                time.sleep(interval)
+            series.append(self.get_snapshot())
+
+        report = bitmap_analyze.occupancy(series[-1], complete_bitmap)
+        stuck = bitmap_analyze.stuck_slots(series, complete_bitmap) if len(series) > 1 else None
+        print(bitmap_analyze.format_report(report, stuck))
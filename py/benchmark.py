@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+#
+# Control-plane benchmarks for the SwitchML controller.
+#
+# Times the Job operations used during job setup and debugging against
+# the in-memory BF-RT stand-in (or a real switch with --switch), and
+# reports ops/s and p50/p99 latency for each. With --json the results
+# are also saved so job setup time can be compared between commits.
+#
+# Example:
+#   python benchmark.py --workers 32 --queue_pairs 16 --rpc_latency 0.0005 --json results.json
+#
+
+import os
+import sys
+import json
+import math
+import time
+import yaml
+import argparse
+import logging
+import tempfile
+import subprocess
+
+from timeit import default_timer as timer
+
+
+# set up options
+argparser = argparse.ArgumentParser(description="SwitchML control-plane benchmarks.")
+argparser.add_argument('--switch', default=False, action='store_true', help='Benchmark a real switch instead of the offline BF-RT stand-in')
+argparser.add_argument('--grpc_server', type=str, default='localhost', help='GRPC server name/address when using --switch')
+argparser.add_argument('--grpc_port', type=int, default=50052, help='GRPC server port when using --switch')
+argparser.add_argument('--program', type=str, default='switchml', help='P4 program name')
+argparser.add_argument('--rpc_latency', type=float, default=0.0, help='Simulated latency of each BF-RT RPC in seconds when offline')
+argparser.add_argument('--entry_latency', type=float, default=0.0, help='Simulated additional latency per table entry in seconds when offline')
+
+argparser.add_argument('--workers', type=int, default=8, help='Number of workers to add')
+argparser.add_argument('--queue_pairs', type=int, default=16, help='Number of queue pairs per worker')
+argparser.add_argument('--iterations', type=int, default=10, help='Number of times to run each operation')
+argparser.add_argument('--log_entries', type=int, default=1024, help='Number of debug log entries to fill in when offline')
+argparser.add_argument('--operations', type=str, nargs='*', default=None, help='Operations to run (default: all)')
+
+argparser.add_argument('--register_clear_threads', type=int, default=8, help='Number of registers to clear concurrently')
+
+argparser.add_argument('--json', type=str, default=None, help='Write results to this JSON file')
+argparser.add_argument('--verbose', default=False, action='store_true', help='Show controller output while benchmarking')
+
+args = argparser.parse_args()
+
+# use in-memory stand-in for BF-RT unless benchmarking a switch
+if not args.switch:
+    import OfflineBFRT
+    OfflineBFRT.install()
+
+# add BF Python to search path
+try:
+    # Import BFRT GRPC stuff
+    import bfrt_grpc.bfruntime_pb2 as bfruntime_pb2
+    import bfrt_grpc.client as gc
+    import grpc
+except:
+    sys.path.append(os.environ['SDE_INSTALL'] + "/lib/python2.7/site-packages/tofino")
+    import bfrt_grpc.bfruntime_pb2 as bfruntime_pb2
+    import bfrt_grpc.client as gc
+    import grpc
+
+from Job import Job
+import log_decode
+
+
+def percentile(samples, p):
+    'Nearest-rank percentile of a list of samples.'
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = max(0, int(math.ceil(p / 100.0 * len(ordered))) - 1)
+    return ordered[min(index, len(ordered) - 1)]
+
+
+class Quiet(object):
+    'Discard stdout inside a with block, since many Job methods print progress.'
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+
+    def __enter__(self):
+        if self.enabled:
+            self.stdout = sys.stdout
+            sys.stdout = open(os.devnull, 'w')
+
+    def __exit__(self, *exc):
+        if self.enabled:
+            sys.stdout.close()
+            sys.stdout = self.stdout
+
+
+class Benchmark(object):
+
+    def __init__(self, job, bfrt_info, args):
+        self.logger = logging.getLogger('Benchmark')
+        self.job = job
+        self.bfrt_info = bfrt_info
+        self.args = args
+        self.quiet = not args.verbose
+        self.results = {}
+
+        # worker addresses, one worker per front panel port
+        self.worker_macs = ['b8:83:03:00:{:02x}:{:02x}'.format(r >> 8, r & 0xff) for r in range(args.workers)]
+        self.worker_ips = ['198.19.{}.{}'.format(r >> 8, (r & 0xff) + 1) for r in range(args.workers)]
+        self.worker_ports = [(r + 1, 0) for r in range(args.workers)]
+
+        # write a ports file describing the workers
+        ports = {}
+        for mac, (port, lane) in zip(self.worker_macs, self.worker_ports):
+            dev_port = self.job.ports.get_dev_port(port, lane)
+            ports[dev_port] = {'speed': '100G', 'fec': 'none', 'mac': mac}
+        fd, self.ports_file = tempfile.mkstemp(prefix='switchml-benchmark-', suffix='.yaml')
+        with os.fdopen(fd, 'w') as f:
+            yaml.safe_dump({'switch': {'forward': ports}}, f)
+
+        # workers' MACs must be known before they can be added
+        with Quiet(self.quiet):
+            self.job.port_load_file(self.ports_file)
+
+    def rpc_count(self):
+        # only the offline stand-in counts RPCs
+        if hasattr(self.bfrt_info, 'rpc_count'):
+            return self.bfrt_info.rpc_count()
+        return None
+
+    def measure(self, name, operation, setup=None, ops_per_call=1):
+        'Run setup (untimed) and operation (timed) for each iteration and record statistics.'
+        samples = []
+        total_rpcs = 0
+        for i in range(self.args.iterations):
+            with Quiet(self.quiet):
+                if setup:
+                    setup()
+                rpcs_before = self.rpc_count()
+                start = timer()
+                operation()
+                end = timer()
+                rpcs_after = self.rpc_count()
+            samples.append((end - start) / ops_per_call)
+            if rpcs_before is not None:
+                total_rpcs += rpcs_after - rpcs_before
+
+        ops = self.args.iterations * ops_per_call
+        total = sum(samples) * ops_per_call
+        result = {'ops': ops,
+                  'total_seconds': total,
+                  'ops_per_second': ops / total if total > 0 else 0.0,
+                  'mean_ms': 1000.0 * total / ops,
+                  'p50_ms': 1000.0 * percentile(samples, 50),
+                  'p99_ms': 1000.0 * percentile(samples, 99)}
+        if self.rpc_count() is not None:
+            result['rpcs_per_op'] = float(total_rpcs) / ops
+        self.results[name] = result
+        self.logger.info("{}: {:.2f} ops/s".format(name, result['ops_per_second']))
+
+    #
+    # setup helpers
+    #
+
+    def clear_ports(self):
+        for mac in list(self.job.non_switchml_forward.mac_addresses):
+            self.job.mac_address_del(mac)
+        self.job.pre.worker_clear_all(self.job.all_ports_mgid)
+
+    def add_workers(self):
+        self.job.worker_clear_all()
+        for rank in range(self.args.workers):
+            self.add_worker(rank)
+
+    def add_worker(self, rank):
+        self.job.worker_add_roce(rank, self.args.workers,
+                                 self.worker_macs[rank], self.worker_ips[rank],
+                                 0x1234, 256, 1 << 16,
+                                 [(0x100 + i, i) for i in range(self.args.queue_pairs)])
+
+    def fill_log(self):
+        # put some nonzero entries in the debug log so decoding is exercised
+        for name in ['pipe.Ingress.debug_log.log', 'pipe.Egress.debug_log.log']:
+            table = self.bfrt_info.table_get(name)
+            prefix = name[len('pipe.'):]
+            for i in range(min(self.args.log_entries, table.info.size)):
+                for pipe in range(table.num_pipes):
+                    table.set_pipe_value(i, pipe, prefix + '.addr', (i & 0x7ff) | 0x800)
+                    table.set_pipe_value(i, pipe, prefix + '.data', (pipe << 30) | i)
+
+    #
+    # operations
+    #
+
+    def port_load_file(self):
+        self.measure('port_load_file',
+                     lambda: self.job.port_load_file(self.ports_file),
+                     setup=self.clear_ports)
+
+    def worker_add_roce(self):
+        # time each worker add separately
+        rank = [0]
+
+        def setup():
+            if rank[0] == 0:
+                self.job.worker_clear_all()
+
+        def operation():
+            self.add_worker(rank[0])
+            rank[0] = (rank[0] + 1) % self.args.workers
+
+        iterations = self.args.iterations
+        self.args.iterations = iterations * self.args.workers
+        try:
+            self.measure('worker_add_roce', operation, setup=setup)
+        finally:
+            self.args.iterations = iterations
+
+    def worker_add_roce_job(self):
+        def operation():
+            for rank in range(self.args.workers):
+                self.add_worker(rank)
+
+        self.measure('worker_add_roce_job', operation, setup=self.job.worker_clear_all)
+
+    def worker_clear_all(self):
+        self.measure('worker_clear_all', self.job.worker_clear_all, setup=self.add_workers)
+
+    def clear_registers(self):
+        self.measure('clear_registers', self.job.clear_registers)
+
+    def clear_counters(self):
+        self.measure('clear_counters', self.job.clear_counters)
+
+    def get_log(self):
+        if not self.args.switch:
+            self.fill_log()
+        self.measure('get_log', self.job.debug_log.get_log)
+
+    def decode_log(self):
+        # decode only, from words already read from the switch
+        if not self.args.switch:
+            self.fill_log()
+        words = self.job.debug_log.get_log_words()
+        self.measure('decode_log', lambda: log_decode.decode_log(words))
+
+    operations = ['port_load_file', 'worker_add_roce', 'worker_add_roce_job',
+                  'worker_clear_all', 'clear_registers', 'clear_counters', 'get_log',
+                  'decode_log']
+
+    def run(self, operations=None):
+        for name in operations or self.operations:
+            getattr(self, name)()
+        os.remove(self.ports_file)
+
+    def print_results(self):
+        print("{:<20} {:>8} {:>12} {:>10} {:>10} {:>10}".format(
+            "Operation", "Ops", "Ops/s", "p50 ms", "p99 ms", "RPCs/op"))
+        for name in self.operations:
+            if name not in self.results:
+                continue
+            r = self.results[name]
+            print("{:<20} {:>8} {:>12.2f} {:>10.3f} {:>10.3f} {:>10}".format(
+                name, r['ops'], r['ops_per_second'], r['p50_ms'], r['p99_ms'],
+                "{:.1f}".format(r['rpcs_per_op']) if 'rpcs_per_op' in r else '-'))
+
+    def save_results(self, filename):
+        try:
+            commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                             cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+            commit = commit.decode() if isinstance(commit, bytes) else commit
+        except Exception:
+            commit = None
+
+        config = dict((k, getattr(self.args, k)) for k in
+                      ['switch', 'rpc_latency', 'entry_latency', 'workers',
+                       'queue_pairs', 'iterations', 'log_entries', 'register_clear_threads'])
+
+        with open(filename, 'w') as f:
+            json.dump({'commit': commit,
+                       'timestamp': time.time(),
+                       'config': config,
+                       'results': self.results}, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+
+    if args.switch:
+        c = gc.ClientInterface("{}:{}".format(args.grpc_server, args.grpc_port), 0, 0, is_master=False)
+    else:
+        c = gc.ClientInterface("offline", 0, 0, is_master=False,
+                               rpc_latency=args.rpc_latency, entry_latency=args.entry_latency)
+    c.bind_pipeline_config(args.program)
+    bfrt_info = c.bfrt_info_get(args.program)
+
+    with Quiet(not args.verbose):
+        job = Job(gc, bfrt_info, '198.19.200.200', '06:00:00:00:00:01', serve_grpc=False,
+                  register_clear_threads=args.register_clear_threads)
+
+        # measure with the startup clears finished
+        job.wait_ready()
+
+    benchmark = Benchmark(job, bfrt_info, args)
+    benchmark.run(args.operations)
+    benchmark.print_results()
+
+    if args.json:
+        benchmark.save_results(args.json)
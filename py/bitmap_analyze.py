@@ -0,0 +1,181 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+#
+# Analysis of snapshots of the worker bitmap register.
+#
+# Each register entry holds the bitmaps of both sets of one pool
+# index. A worker's packet for a set adds the worker's bit to that
+# set and removes it from the other, so a set that has some but not
+# all of the job's bits is a slot still waiting for workers.
+#
+# Snapshots are dicts as returned by
+# UpdateAndCheckWorkerBitmap.get_snapshot, with the time the snapshot
+# was taken, the pool indices read, and a (count, 2, pipes) uint32
+# array of bitmaps. Like log_analyze, this depends only on NumPy.
+#
+
+import numpy as np
+
+# characters for heatmap cells, from empty to full
+heatmap_levels = ' .:-=+*#%@'
+
+
+def popcount(x):
+    'Count the bits set in each element of a uint32 array.'
+    x = np.ascontiguousarray(x, dtype='<u4')
+    bits = np.unpackbits(x.view(np.uint8).reshape(x.shape + (4,)), axis=-1)
+    return bits.sum(axis=-1, dtype=np.int64)
+
+
+def worker_bits(x):
+    """Expand a uint32 array of bitmaps into a boolean array with one
+    more dimension, indexed by worker ID."""
+    x = np.ascontiguousarray(x, dtype='<u4')
+    bits = np.unpackbits(x.view(np.uint8).reshape(x.shape + (4,)), axis=-1)
+    # unpackbits is MSB first within each byte; reorder so bit i is worker i
+    bits = bits.reshape(x.shape + (4, 8))[..., ::-1]
+    return bits.reshape(x.shape + (32,)).astype(bool)
+
+
+def slot_bitmaps(snapshot):
+    """Combine the pipes of a snapshot into a (count, 2) array with the
+    bitmap of each set of each pool index."""
+    return np.bitwise_or.reduce(snapshot['bitmaps'], axis=-1).astype(np.uint32)
+
+
+def partial_slots(snapshot, complete_bitmap):
+    """Return a (count, 2) boolean array marking sets that have some,
+    but not all, of the job's workers."""
+    bitmaps = slot_bitmaps(snapshot) & np.uint32(complete_bitmap)
+    return (bitmaps != 0) & (bitmaps != complete_bitmap)
+
+
+def heatmap(counts, width=64):
+    """Sum per-pool-index counts into width buckets of consecutive
+    pool indices. Returns the bucket sums and the bucket size."""
+    counts = np.asarray(counts)
+    bucket = max(1, -(-len(counts) // width))
+    padded = np.zeros(bucket * width, dtype=np.int64)
+    padded[:len(counts)] = counts
+    return padded.reshape(width, bucket).sum(axis=1), bucket
+
+
+def format_heatmap(sums, maximum):
+    'Render heatmap bucket sums as one line of characters.'
+    if maximum <= 0:
+        return ' ' * len(sums)
+    levels = len(heatmap_levels) - 1
+    cells = np.ceil(np.asarray(sums, dtype=np.float64) * levels / maximum).astype(np.int64)
+    return ''.join(heatmap_levels[min(c, levels)] for c in cells)
+
+
+def occupancy(snapshot, complete_bitmap, max_examples=10, width=64):
+    """Summarize slot usage in a snapshot: how many sets are empty,
+    partial or complete, which workers partial sets are waiting for,
+    and a heatmap of partial sets by pool index."""
+    indices = snapshot['indices']
+    bitmaps = slot_bitmaps(snapshot)
+    extra = bitmaps & ~np.uint32(complete_bitmap)
+    bitmaps = bitmaps & np.uint32(complete_bitmap)
+
+    empty = bitmaps == 0
+    complete = ~empty & (bitmaps == complete_bitmap)
+    partial = ~empty & ~complete
+
+    # workers missing from partial sets
+    missing = np.where(partial, np.uint32(complete_bitmap) & ~bitmaps, 0).astype(np.uint32)
+    missing_by_worker = worker_bits(missing).sum(axis=(0, 1))
+    missing_counts = popcount(missing)[partial]
+
+    examples = []
+    for i, s in np.argwhere(partial)[:max_examples]:
+        examples.append({'pool_index': int(indices[i]),
+                         'set':        int(s),
+                         'bitmap':     int(bitmaps[i, s]),
+                         'missing':    [int(w) for w in np.flatnonzero(worker_bits(missing[i, s]))]})
+
+    sums, bucket = heatmap(partial.sum(axis=1), width)
+
+    return {'timestamp':          snapshot['timestamp'],
+            'pool_indices':       len(indices),
+            'complete_bitmap':    int(complete_bitmap),
+            'workers':            int(popcount(np.uint32(complete_bitmap))),
+            'empty':              int(np.count_nonzero(empty)),
+            'partial':            int(np.count_nonzero(partial)),
+            'complete':           int(np.count_nonzero(complete)),
+            'both_sets_nonzero':  int(np.count_nonzero(~empty.any(axis=1))),
+            'unknown_workers':    int(np.count_nonzero(extra)),
+            'missing_histogram':  [int(c) for c in np.bincount(missing_counts, minlength=1)],
+            'missing_by_worker':  dict((int(w), int(c)) for w, c in enumerate(missing_by_worker) if c),
+            'heatmap':            [int(c) for c in sums],
+            'heatmap_bucket':     bucket,
+            'examples':           examples}
+
+
+def stuck_slots(snapshots, complete_bitmap, max_examples=10):
+    """Find sets that are partial with the same bitmap in every one of
+    a series of snapshots of the same pool indices. Slots in flight
+    change between snapshots taken while a job is making progress, so
+    these are waiting on workers that aren't sending."""
+    if len(snapshots) < 2:
+        raise ValueError("Need at least two snapshots to find stuck slots")
+    first = snapshots[0]
+    for s in snapshots[1:]:
+        if not np.array_equal(s['indices'], first['indices']):
+            raise ValueError("Snapshots must cover the same pool indices")
+
+    bitmaps = slot_bitmaps(first) & np.uint32(complete_bitmap)
+    stuck = partial_slots(first, complete_bitmap)
+    for s in snapshots[1:]:
+        stuck &= (slot_bitmaps(s) & np.uint32(complete_bitmap)) == bitmaps
+
+    missing = np.where(stuck, np.uint32(complete_bitmap) & ~bitmaps, 0).astype(np.uint32)
+    examples = []
+    for i, s in np.argwhere(stuck)[:max_examples]:
+        examples.append({'pool_index': int(first['indices'][i]),
+                         'set':        int(s),
+                         'bitmap':     int(bitmaps[i, s]),
+                         'missing':    [int(w) for w in np.flatnonzero(worker_bits(missing[i, s]))]})
+
+    return {'snapshots':          len(snapshots),
+            'duration':           snapshots[-1]['timestamp'] - first['timestamp'],
+            'stuck':              int(np.count_nonzero(stuck)),
+            'missing_by_worker':  dict((int(w), int(c)) for w, c in
+                                       enumerate(worker_bits(missing).sum(axis=(0, 1))) if c),
+            'examples':           examples}
+
+
+def format_workers(workers):
+    return ', '.join('{}: {}'.format(w, c) for w, c in sorted(workers.items())) or 'none'
+
+
+def format_report(report, stuck=None):
+    lines = []
+    lines.append("Pool indices: {}; {} workers, complete bitmap 0x{:08x}.".format(
+        report['pool_indices'], report['workers'], report['complete_bitmap']))
+    lines.append("Sets: {} empty, {} partial, {} complete; {} pool indices with both sets nonzero.".format(
+        report['empty'], report['partial'], report['complete'], report['both_sets_nonzero']))
+    if report['unknown_workers']:
+        lines.append("Sets with bits for workers not in this job: {}".format(report['unknown_workers']))
+
+    lines.append("Partial sets by number of missing workers: {}".format(
+        ', '.join('{}: {}'.format(n, c) for n, c in enumerate(report['missing_histogram']) if c) or 'none'))
+    lines.append("Partial sets missing each worker: {}".format(format_workers(report['missing_by_worker'])))
+
+    lines.append("Partial sets by pool index ({} pool indices per cell, max {}):".format(
+        report['heatmap_bucket'], max(report['heatmap'])))
+    lines.append("|{}|".format(format_heatmap(report['heatmap'], max(report['heatmap']))))
+
+    for e in report['examples']:
+        lines.append("    Pool index 0x{pool_index:04x} set {set}: 0x{bitmap:08x}, missing workers {missing}".format(**e))
+
+    if stuck is not None:
+        lines.append("")
+        lines.append("Stuck sets unchanged over {} snapshots in {:.3f} seconds: {}".format(
+            stuck['snapshots'], stuck['duration'], stuck['stuck']))
+        lines.append("Stuck sets missing each worker: {}".format(format_workers(stuck['missing_by_worker'])))
+        for e in stuck['examples']:
+            lines.append("    Pool index 0x{pool_index:04x} set {set}: 0x{bitmap:08x}, missing workers {missing}".format(**e))
+
+    return '\n'.join(lines)
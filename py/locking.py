@@ -0,0 +1,23 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+#
+# Serializing changes to the controller's state.
+#
+# The CLI, the gRPC writer thread and others all change the job's
+# tables and local state. Methods that do are decorated with locked,
+# so they hold their object's lock (a reentrant lock that Job shares
+# with JobManager) and take turns instead of interleaving writes or
+# sharing a write batch.
+#
+
+import functools
+
+
+def locked(method):
+    'Run method holding self.lock.'
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return wrapper
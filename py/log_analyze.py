@@ -0,0 +1,233 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+#
+# Automated analysis of decoded SwitchML debug logs.
+#
+# Works on structured arrays of log_decode.log_entry_dtype records in
+# capture order, as returned by log_decode.decode_log or
+# log_decode.iter_records, and produces a report dict that can be
+# printed with format_report or saved as JSON.
+#
+# Like log_decode, this depends only on NumPy so it can be used from
+# the controller and from offline tools.
+#
+
+import numpy as np
+
+import log_decode
+
+# packet types, as in packet_type_t in p4/types.p4
+BROADCAST  = 0x1
+RETRANSMIT = 0x2
+CONSUME0   = 0x4
+CONSUME3   = 0x7
+
+# packet IDs in the log are the low 11 bits of the packet ID counter
+packet_id_modulus = 1 << 11
+
+
+def sequences(records):
+    """Split records into the sequences the checks run over: one per
+    log and capture pipe. Returns a list of (log, pipe, indices) with
+    the indices of each sequence's records, in capture order."""
+    key = records['log'].astype(np.int64) * 256 + records['capture_pipe']
+    order = np.argsort(key, kind='mergesort')
+    boundaries = np.flatnonzero(np.diff(key[order])) + 1
+    result = []
+    for indices in np.split(order, boundaries):
+        if len(indices):
+            r = records[indices[0]]
+            result.append((int(r['log']), int(r['capture_pipe']), indices))
+    return result
+
+
+def packet_id_gaps(records, max_examples=10):
+    """Find gaps in packet IDs. IDs are assigned from a per-pipe
+    counter on a packet's first pass (CONSUME0), so those records in
+    each ingress pipe should have consecutive IDs; any other jump
+    means packets were dropped before being logged, or the log
+    wrapped between reads; a repeated ID means a packet's first pass
+    was logged twice. Later passes and egress copies interleave with
+    other packets, so they aren't checked."""
+    result = []
+    for log, pipe, indices in sequences(records):
+        if log != log_decode.INGRESS:
+            continue
+        r = records[indices]
+        r = r[r['packet_type'] == CONSUME0]
+        for ingress_pipe in np.unique(r['ingress_pipe']):
+            selected = np.flatnonzero(r['ingress_pipe'] == ingress_pipe)
+            ids = r['packet_id'][selected].astype(np.int64)
+            step = np.diff(ids) % packet_id_modulus
+            gaps = np.flatnonzero(step > 1)
+
+            examples = []
+            for g in gaps[:max_examples]:
+                examples.append({'capture_index':      int(r['capture_index'][selected[g + 1]]),
+                                 'packet_id':          int(ids[g + 1]),
+                                 'previous_packet_id': int(ids[g]),
+                                 'missing':            int(step[g] - 1)})
+
+            result.append({'log':          log_decode.log_names[log],
+                           'capture_pipe': pipe,
+                           'ingress_pipe': int(ingress_pipe),
+                           'packets':      len(selected),
+                           'duplicates':   int(np.count_nonzero(step == 0)),
+                           'gaps':         len(gaps),
+                           'missing':      int((step[gaps] - 1).sum()),
+                           'examples':     examples})
+    return result
+
+
+def retransmit_rates(records, key, top=None):
+    """Count first-pass packets and retransmissions per value of key
+    (e.g. worker_id or pool_index). Ingress retransmissions are
+    CONSUME0 packets the switch had already seen; egress
+    retransmissions are RETRANSMIT packets sent back to workers."""
+    ingress = (records['log'] == log_decode.INGRESS) & (records['packet_type'] == CONSUME0)
+    egress = (records['log'] == log_decode.EGRESS) & (records['packet_type'] == RETRANSMIT)
+    values = records[key].astype(np.int64)
+
+    size = int(values.max()) + 1 if len(values) else 0
+    packets = np.bincount(values[ingress], minlength=size)
+    received = np.bincount(values[ingress & records['nonzero_map_result']], minlength=size)
+    sent = np.bincount(values[egress], minlength=size)
+
+    present = np.flatnonzero(packets + sent)
+    if top is not None:
+        # keep the values with the most retransmissions
+        present = present[np.argsort(-(received[present] + sent[present]), kind='mergesort')][:top]
+
+    return [{key:                      int(v),
+             'packets':                int(packets[v]),
+             'retransmits_received':   int(received[v]),
+             'retransmits_sent':       int(sent[v]),
+             'retransmit_rate':        float(received[v]) / packets[v] if packets[v] else 0.0}
+            for v in present]
+
+
+def ordering_anomalies(records, max_examples=10):
+    """Find passes of a packet that are out of order. Each packet goes
+    through CONSUME0-3 and then HARVEST0-7 in increasing packet type
+    order, so consecutive records of the same packet in a pipe should
+    never go backwards."""
+    count = 0
+    examples = []
+    for log, pipe, indices in sequences(records):
+        if log != log_decode.INGRESS:
+            continue
+        r = records[indices]
+        same = ((r['packet_id'][1:] == r['packet_id'][:-1]) &
+                (r['ingress_pipe'][1:] == r['ingress_pipe'][:-1]))
+        backwards = np.flatnonzero(same & (r['packet_type'][1:] < r['packet_type'][:-1]))
+        count += len(backwards)
+
+        for b in backwards[:max(0, max_examples - len(examples))]:
+            examples.append({'log':                  log_decode.log_names[log],
+                             'capture_pipe':         pipe,
+                             'capture_index':        int(r['capture_index'][b + 1]),
+                             'packet_id':            int(r['packet_id'][b + 1]),
+                             'packet_type':          int(r['packet_type'][b + 1]),
+                             'previous_packet_type': int(r['packet_type'][b])})
+
+    return {'backwards': count,
+            'examples': examples}
+
+
+def slot_latency(records):
+    """Measure how many packets each pipe logs between the first and
+    last worker's packet for a slot. Only novel CONSUME packets update
+    the worker count, so retransmissions are ignored."""
+    latencies = []
+    incomplete = 0
+    for log, pipe, indices in sequences(records):
+        if log != log_decode.INGRESS:
+            continue
+        r = records[indices]
+        position = np.arange(len(r))
+        novel = ((r['packet_type'] >= CONSUME0) & (r['packet_type'] <= CONSUME3) &
+                 ~r['nonzero_map_result'] &
+                 (r['first_worker_for_slot'] | r['last_worker_for_slot']))
+
+        # order each slot's first/last events by position
+        slot = r['pool_index'][novel].astype(np.int64) * 2 + r['pool_set'][novel]
+        pos = position[novel]
+        first = r['first_worker_for_slot'][novel]
+        last = r['last_worker_for_slot'][novel]
+        order = np.lexsort((pos, slot))
+        slot, pos, first, last = slot[order], pos[order], first[order], last[order]
+
+        # a first followed by a last for the same slot is a completion
+        done = first[:-1] & last[1:] & (slot[:-1] == slot[1:])
+        latencies.append(pos[1:][done] - pos[:-1][done])
+
+        # firsts not followed by a last haven't completed
+        incomplete += int(np.count_nonzero(first)) - int(np.count_nonzero(done))
+
+    latencies = np.concatenate(latencies) if latencies else np.zeros(0, dtype=np.int64)
+    result = {'slots': len(latencies), 'incomplete': incomplete}
+    if len(latencies):
+        result.update({'min':    int(latencies.min()),
+                       'median': float(np.median(latencies)),
+                       'p99':    float(np.percentile(latencies, 99)),
+                       'max':    int(latencies.max())})
+    return result
+
+
+def analyze(records, max_examples=10, top=10):
+    'Run all checks on an array of decoded records and return a report dict.'
+    records = np.asarray(records)
+    return {'records':              len(records),
+            'packet_id_gaps':       packet_id_gaps(records, max_examples),
+            'workers':              retransmit_rates(records, 'worker_id'),
+            'pool_indices':         retransmit_rates(records, 'pool_index', top),
+            'ordering_anomalies':   ordering_anomalies(records, max_examples),
+            'slot_latency':         slot_latency(records)}
+
+
+def violations(report):
+    'Count packet ID gaps, duplicates and ordering anomalies in a report.'
+    return (sum(p['gaps'] + p['duplicates'] for p in report['packet_id_gaps']) +
+            report['ordering_anomalies']['backwards'])
+
+
+def format_report(report):
+    lines = []
+    lines.append("Analyzed {} log records.".format(report['records']))
+
+    lines.append("")
+    lines.append("Packet IDs of first passes:")
+    lines.append("{:>6} {:>8} {:>10} {:>10} {:>8} {:>10}".format(
+        'Pipe', 'Ingress', 'Packets', 'Duplicates', 'Gaps', 'Missing'))
+    for p in report['packet_id_gaps']:
+        lines.append("{:>6} {:>8} {:>10} {:>10} {:>8} {:>10}".format(
+            p['capture_pipe'], p['ingress_pipe'], p['packets'], p['duplicates'], p['gaps'], p['missing']))
+        for e in p['examples']:
+            lines.append("    index {capture_index}: packet ID {previous_packet_id} -> {packet_id} ({missing} missing)".format(**e))
+
+    for title, key, rows in [("Retransmissions by worker:", 'worker_id', report['workers']),
+                             ("Pool indices with most retransmissions:", 'pool_index', report['pool_indices'])]:
+        lines.append("")
+        lines.append(title)
+        lines.append("{:>10} {:>10} {:>10} {:>10} {:>8}".format(
+            'ID', 'Packets', 'Received', 'Sent', 'Rate'))
+        for w in rows:
+            lines.append("{:>10} {:>10} {:>10} {:>10} {:>8.4f}".format(
+                w[key], w['packets'], w['retransmits_received'], w['retransmits_sent'], w['retransmit_rate']))
+
+    o = report['ordering_anomalies']
+    lines.append("")
+    lines.append("Packet type ordering: {} passes out of order.".format(o['backwards']))
+    for e in o['examples']:
+        lines.append("    {log} pipe {capture_pipe} index {capture_index}: packet ID {packet_id} type {previous_packet_type} -> {packet_type}".format(**e))
+
+    s = report['slot_latency']
+    lines.append("")
+    if s['slots']:
+        lines.append("Slot completion latency in packets: {} slots, min {}, median {}, p99 {}, max {}; {} incomplete.".format(
+            s['slots'], s['min'], s['median'], s['p99'], s['max'], s['incomplete']))
+    else:
+        lines.append("Slot completion latency: no completed slots; {} incomplete.".format(s['incomplete']))
+
+    return '\n'.join(lines)
@@ -0,0 +1,376 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+#
+# Vectorized decoding of SwitchML debug log words.
+#
+# Each log register entry holds a 19-bit address and a 32-bit data
+# word per pipe, which together form a 51-bit log word. The functions
+# here decode all words captured in all pipes at once into a NumPy
+# structured array with one record per logged packet.
+#
+# This module depends only on NumPy so it can be shared by the
+# controller (DebugLog.py) and offline tools (tools/convert_log.py).
+#
+
+import os
+
+import numpy as np
+
+num_pipes = 4
+
+# log ids
+INGRESS = 0
+EGRESS  = 1
+
+log_names = ['Ingress', 'Egress']
+
+# one record per logged packet
+log_entry_dtype = np.dtype([
+    ('log',                     np.uint8),   # INGRESS or EGRESS
+    ('capture_index',           np.uint32),  # register index of entry
+    ('capture_pipe',            np.uint8),   # pipe that logged the entry
+    ('address_bits',            np.uint8),   # upper 8 bits of 19-bit packet_id
+    ('packet_id',               np.uint16),  # lower 11 bits of 19-bit packet_id
+    ('ingress_pipe',            np.uint8),
+    ('worker_id',               np.uint8),
+    ('first_packet_of_message', np.bool_),
+    ('last_packet_of_message',  np.bool_),
+    ('nonzero_bitmap_before',   np.bool_),
+    ('nonzero_map_result',      np.bool_),
+    ('first_worker_for_slot',   np.bool_),
+    ('last_worker_for_slot',    np.bool_),
+    ('packet_type',             np.uint8),
+    ('pool_index',              np.uint16),
+    ('pool_set',                np.uint8)])
+
+# (field, shift, mask) for each field packed in a log word
+log_word_fields = [
+    ('address_bits',            43, 0xff),
+    ('packet_id',               32, 0x7ff),
+    ('ingress_pipe',            30, 0x3),
+    ('worker_id',               25, 0x1f),
+    ('first_packet_of_message', 24, 0x1),
+    ('last_packet_of_message',  23, 0x1),
+    ('nonzero_bitmap_before',   22, 0x1),
+    ('nonzero_map_result',      21, 0x1),
+    ('first_worker_for_slot',   20, 0x1),
+    ('last_worker_for_slot',    19, 0x1),
+    ('packet_type',             15, 0xf),
+    ('pool_index',               1, 0x3fff),
+    ('pool_set',                 0, 0x1)]
+
+
+def combine_words(addrs, datas):
+    'Combine per-pipe address and data register arrays into 51-bit log words.'
+    addrs = np.asarray(addrs, dtype=np.uint64)
+    datas = np.asarray(datas, dtype=np.uint64)
+    return (addrs << np.uint64(32)) | datas
+
+
+def words_from_dict(values, size=None):
+    """Convert a dict of index -> (pipe 0, ..., pipe 3) log words, as
+    saved by DebugLog.save_log, into a (size, num_pipes) word array."""
+    if size is None:
+        size = max(values) + 1 if values else 0
+    if not values:
+        return np.zeros((size, num_pipes), dtype=np.uint64)
+    indices = np.fromiter(values.keys(), dtype=np.int64, count=len(values))
+    entries = np.array(list(values.values()), dtype=np.uint64)
+    words = np.zeros((size, entries.shape[1]), dtype=np.uint64)
+    words[indices] = entries
+    return words
+
+
+def rotation_start(indices):
+    """Find where a circular log starts, given the sorted indices of
+    nonzero entries for one pipe. The log wraps at the last gap in the
+    indices, so that's where the oldest entry is."""
+    gaps = np.flatnonzero(np.diff(np.concatenate(([0], indices))) != 1)
+    if len(gaps) == 0:
+        return 0
+    return gaps[-1]
+
+
+def next_write_indices(words):
+    """For each pipe of a (size, num_pipes) word array, find the index
+    after its newest entry, where the log will be written next.
+    Empty logs are written from the start."""
+    size, pipes = words.shape
+    next_index = np.zeros(pipes, dtype=np.int64)
+    for pipe in range(pipes):
+        indices = np.flatnonzero(words[:, pipe])
+        if len(indices):
+            newest = indices[rotation_start(indices) - 1]
+            next_index[pipe] = (newest + 1) % size
+    return next_index
+
+
+def decode_words(words, log=INGRESS, rotate=True):
+    """Decode a (size, num_pipes) array of log words into a structured
+    array of log_entry_dtype. Zero words are skipped. Entries are
+    ordered by capture pipe, then by capture order within each pipe if
+    rotate is set, or by register index otherwise."""
+    words = np.asarray(words, dtype=np.uint64)
+
+    # transpose so nonzero entries come out ordered by pipe, then index
+    pipes, indices = np.nonzero(words.T)
+    entries = words.T[pipes, indices]
+
+    if rotate:
+        # rotate each pipe's entries so the oldest comes first
+        order = np.arange(len(entries))
+        boundaries = np.searchsorted(pipes, np.arange(words.shape[1] + 1))
+        for pipe in range(words.shape[1]):
+            begin, end = boundaries[pipe], boundaries[pipe + 1]
+            start = rotation_start(indices[begin:end])
+            if start:
+                order[begin:end] = np.roll(order[begin:end], -start)
+        pipes, indices, entries = pipes[order], indices[order], entries[order]
+
+    return decode_entries(entries, indices, pipes, log)
+
+
+def decode_entries(entries, indices, pipes, log=INGRESS):
+    """Decode an array of log words, with the register index and pipe
+    each was captured at, into a structured array of log_entry_dtype."""
+    entries = np.asarray(entries, dtype=np.uint64)
+    decoded = np.empty(len(entries), dtype=log_entry_dtype)
+    decoded['log'] = log
+    decoded['capture_index'] = indices
+    decoded['capture_pipe'] = pipes
+    for field, shift, mask in log_word_fields:
+        decoded[field] = (entries >> np.uint64(shift)) & np.uint64(mask)
+    return decoded
+
+
+def decode_log(log, rotate=True):
+    """Decode a log with 'Ingress' and 'Egress' entries, each either a
+    word array or a dict as saved by DebugLog.save_log, into one
+    structured array with ingress entries before egress entries."""
+    decoded = []
+    for log_id, name in enumerate(log_names):
+        words = log.get(name, {})
+        if isinstance(words, dict):
+            words = words_from_dict(words)
+        decoded.append(decode_words(words, log_id, rotate))
+    return np.concatenate(decoded)
+
+
+#
+# Binary log files.
+#
+# A file starts with a fixed-size little-endian header:
+#
+#   magic          8 bytes  b'SwitchML'
+#   version        uint32
+#   num_logs       uint32   always 2 (Ingress, then Egress)
+#   num_pipes      uint32
+#   register_size  uint32
+#   reserved       8 bytes
+#
+# followed by num_logs * num_pipes packed little-endian uint64 arrays
+# of register_size log words each, ordered by log, then pipe. Files
+# can be mapped with numpy.memmap without parsing.
+#
+
+log_file_magic = b'SwitchML'
+log_file_version = 1
+
+log_file_header_dtype = np.dtype([
+    ('magic',         'S8'),
+    ('version',       '<u4'),
+    ('num_logs',      '<u4'),
+    ('num_pipes',     '<u4'),
+    ('register_size', '<u4'),
+    ('reserved',      'V8')])
+
+
+def is_log_file(filename):
+    'Check whether a file is a binary log file, rather than YAML.'
+    with open(filename, 'rb') as f:
+        return f.read(len(log_file_magic)) == log_file_magic
+
+
+def write_log_file(filename, log):
+    'Write a dict of Ingress and Egress word arrays to a binary log file.'
+    words = [np.asarray(log[name], dtype=np.uint64) for name in log_names]
+    register_size, pipes = words[0].shape
+
+    header = np.zeros(1, dtype=log_file_header_dtype)
+    header['magic'] = log_file_magic
+    header['version'] = log_file_version
+    header['num_logs'] = len(log_names)
+    header['num_pipes'] = pipes
+    header['register_size'] = register_size
+
+    with open(filename, 'wb') as f:
+        f.write(header.tobytes())
+        for w in words:
+            # one contiguous array per pipe
+            f.write(np.ascontiguousarray(w.T, dtype='<u8').tobytes())
+
+
+def read_log_file(filename):
+    """Map a binary log file and return a dict of Ingress and Egress
+    (register_size, num_pipes) word arrays backed by the file."""
+    header = np.fromfile(filename, dtype=log_file_header_dtype, count=1)
+    if len(header) != 1 or header['magic'][0] != log_file_magic:
+        raise ValueError("{} is not a SwitchML log file".format(filename))
+    if header['version'][0] != log_file_version:
+        raise ValueError("{} has unsupported log file version {}".format(filename, header['version'][0]))
+
+    num_logs = int(header['num_logs'][0])
+    num_pipes = int(header['num_pipes'][0])
+    register_size = int(header['register_size'][0])
+    words = np.memmap(filename, dtype='<u8', mode='r',
+                      offset=log_file_header_dtype.itemsize,
+                      shape=(num_logs, num_pipes, register_size))
+
+    return dict((name, words[i].T) for i, name in enumerate(log_names[:num_logs]))
+
+
+def load_log(filename):
+    'Load a log from a binary log file, or from a YAML file saved by older versions.'
+    if is_log_file(filename):
+        return read_log_file(filename)
+
+    import yaml
+    with open(filename, 'r') as f:
+        return yaml.load(f, Loader=yaml.Loader)
+
+
+#
+# Record files.
+#
+# Decoded records can be appended to files with a fixed-size header:
+#
+#   magic          8 bytes  b'SwMLRecs'
+#   version        uint32
+#   record_size    uint32   log_entry_dtype.itemsize
+#   reserved       8 bytes
+#
+# followed by packed little-endian log_entry_dtype records. Files can
+# be mapped with numpy.memmap, and may be read while being appended to.
+#
+
+record_file_magic = b'SwMLRecs'
+record_file_version = 1
+
+record_file_header_dtype = np.dtype([
+    ('magic',       'S8'),
+    ('version',     '<u4'),
+    ('record_size', '<u4'),
+    ('reserved',    'V8')])
+
+record_file_dtype = log_entry_dtype.newbyteorder('<')
+
+
+def read_record_file(filename):
+    'Map a record file and return its records as a structured array.'
+    header = np.fromfile(filename, dtype=record_file_header_dtype, count=1)
+    if len(header) != 1 or header['magic'][0] != record_file_magic:
+        raise ValueError("{} is not a SwitchML record file".format(filename))
+    if (header['version'][0] != record_file_version or
+        header['record_size'][0] != record_file_dtype.itemsize):
+        raise ValueError("{} has unsupported record file version {}".format(filename, header['version'][0]))
+
+    count = (os.path.getsize(filename) - record_file_header_dtype.itemsize) // record_file_dtype.itemsize
+    if count == 0:
+        return np.zeros(0, dtype=record_file_dtype)
+    return np.memmap(filename, dtype=record_file_dtype, mode='r',
+                     offset=record_file_header_dtype.itemsize, shape=(count,))
+
+
+class RecordFileWriter(object):
+    """Append records to a series of size-bounded files named
+    <prefix>-000000.rec, <prefix>-000001.rec, ... in a directory,
+    deleting the oldest files to keep at most max_files."""
+
+    def __init__(self, directory, prefix='debug_log', max_file_size=64 << 20, max_files=16):
+        self.directory = directory
+        self.prefix = prefix
+        self.max_file_size = max_file_size
+        self.max_files = max_files
+
+        self.files = []
+        self.file = None
+        self.file_size = 0
+        self.records = 0
+
+        # continue numbering after any files already in the directory
+        self.next_number = 0
+        for name in os.listdir(directory):
+            base, ext = os.path.splitext(name)
+            if ext == '.rec' and base.startswith(prefix + '-') and base[len(prefix) + 1:].isdigit():
+                self.next_number = max(self.next_number, int(base[len(prefix) + 1:]) + 1)
+
+    def filename(self, number):
+        return os.path.join(self.directory, '{}-{:06d}.rec'.format(self.prefix, number))
+
+    def open_next(self):
+        self.close()
+
+        filename = self.filename(self.next_number)
+        self.next_number = self.next_number + 1
+
+        header = np.zeros(1, dtype=record_file_header_dtype)
+        header['magic'] = record_file_magic
+        header['version'] = record_file_version
+        header['record_size'] = record_file_dtype.itemsize
+
+        self.file = open(filename, 'wb')
+        self.file.write(header.tobytes())
+        self.file_size = record_file_header_dtype.itemsize
+        self.files.append(filename)
+
+        # remove oldest files
+        while self.max_files and len(self.files) > self.max_files:
+            os.remove(self.files.pop(0))
+
+    def write(self, records):
+        records = np.asarray(records).astype(record_file_dtype)
+
+        # split records across files as they fill up
+        while len(records):
+            if self.file is None or self.file_size + record_file_dtype.itemsize > self.max_file_size:
+                self.open_next()
+            space = max(1, (self.max_file_size - self.file_size) // record_file_dtype.itemsize)
+            chunk, records = records[:space], records[space:]
+            self.file.write(chunk.tobytes())
+            self.file.flush()
+            self.file_size = self.file_size + chunk.nbytes
+            self.records = self.records + len(chunk)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def record_files(path):
+    'List the record files in a capture directory, oldest first.'
+    return sorted(os.path.join(path, name) for name in os.listdir(path) if name.endswith('.rec'))
+
+
+def iter_records(path, chunk_size=1 << 16):
+    """Yield decoded records from a log in chunks of at most
+    chunk_size. path may be a record file, a directory of record
+    files from a capture, a binary log file or a YAML log file."""
+    if os.path.isdir(path):
+        filenames = record_files(path)
+    else:
+        filenames = [path]
+
+    for filename in filenames:
+        with open(filename, 'rb') as f:
+            magic = f.read(len(record_file_magic))
+
+        if magic == record_file_magic:
+            records = read_record_file(filename)
+        else:
+            # snapshots are at most one log's worth, so decode at once
+            records = decode_log(load_log(filename))
+
+        for start in range(0, len(records), chunk_size):
+            yield np.asarray(records[start:start + chunk_size])
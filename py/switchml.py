@@ -10,18 +10,6 @@ import logging
 
 from pprint import pprint, pformat
 
-# add BF Python to search path
-try:
-    # Import BFRT GRPC stuff
-    import bfrt_grpc.bfruntime_pb2 as bfruntime_pb2
-    import bfrt_grpc.client as gc
-    import grpc
-except:
-    sys.path.append(os.environ['SDE_INSTALL'] + "/lib/python2.7/site-packages/tofino")
-    import bfrt_grpc.bfruntime_pb2 as bfruntime_pb2
-    import bfrt_grpc.client as gc
-    import grpc
-
 # set up options
 argparser = argparse.ArgumentParser(description="SwitchML controller.")
 argparser.add_argument('--grpc_server', type=str, default='localhost', help='GRPC server name/address')
@@ -36,8 +24,35 @@ argparser.add_argument('--switch_udp_mask', type=int, default=0xfff0, help='UDP
 argparser.add_argument('--ports',   type=str, default='ports.yaml',   help='YAML file describing machines connected to ports')
 argparser.add_argument('--job', type=str, default='job.yaml', help='YAML file describing active workers in job')
 
+argparser.add_argument('--register_clear_threads', type=int, default=8, help='Number of registers to clear concurrently')
+
+argparser.add_argument('--port_map_cache', type=str, default=None, help='File to cache the front panel to dev port map in between runs; used only if $SDE or $SDE_INSTALL is set')
+argparser.add_argument('--multi_job', default=False, action='store_true', help='Let several jobs share the switch, each with its own multicast group, worker IDs and pool slice')
+argparser.add_argument('--state_file', type=str, default=None, help='File to save ports, workers and jobs to after every change')
+argparser.add_argument('--warm_restart', default=False, action='store_true', help='Adopt the configuration already on the switch if it matches the state file, instead of clearing and reprogramming it')
+argparser.add_argument('--telemetry_interval', type=float, default=0, help='Seconds between background counter samples; 0 starts sampling on demand')
+argparser.add_argument('--offline', default=False, action='store_true', help='Use in-memory BF-RT stand-in instead of a switch')
+argparser.add_argument('--offline_rpc_latency', type=float, default=0.0, help='Simulated latency of each BF-RT RPC in seconds when offline')
+
 args = argparser.parse_args()
 
+# use in-memory stand-in for BF-RT if requested
+if args.offline:
+    import OfflineBFRT
+    OfflineBFRT.install()
+
+# add BF Python to search path
+try:
+    # Import BFRT GRPC stuff
+    import bfrt_grpc.bfruntime_pb2 as bfruntime_pb2
+    import bfrt_grpc.client as gc
+    import grpc
+except:
+    sys.path.append(os.environ['SDE_INSTALL'] + "/lib/python2.7/site-packages/tofino")
+    import bfrt_grpc.bfruntime_pb2 as bfruntime_pb2
+    import bfrt_grpc.client as gc
+    import grpc
+
 # configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger('SwitchML')
@@ -53,7 +68,11 @@ logger.info("""\n
 
 # connect to GRPC server
 logger.info("Connecting to GRPC server {}:{} and binding to program {}...".format(args.grpc_server, args.grpc_port, args.program))
-c = gc.ClientInterface("{}:{}".format(args.grpc_server, args.grpc_port), 0, 0, is_master=False)
+if args.offline:
+    c = gc.ClientInterface("{}:{}".format(args.grpc_server, args.grpc_port), 0, 0, is_master=False,
+                           rpc_latency=args.offline_rpc_latency)
+else:
+    c = gc.ClientInterface("{}:{}".format(args.grpc_server, args.grpc_port), 0, 0, is_master=False)
 c.bind_pipeline_config(args.program)
 
 # get all tables for program
@@ -75,7 +94,13 @@ from Worker import Worker
 # setup job for model
 job = Job(gc, bfrt_info,
           args.switch_ip, args.switch_mac, args.switch_udp_port, args.switch_udp_mask,
-          ports_file=args.ports, job_file=args.job)
+          ports_file=args.ports, job_file=args.job,
+          register_clear_threads=args.register_clear_threads,
+          telemetry_interval=args.telemetry_interval,
+          port_map_cache=args.port_map_cache,
+          multi_job=args.multi_job,
+          state_file=args.state_file,
+          warm_restart=args.warm_restart)
 
 # # setup job for model
 # job = Job(gc, bfrt_info,
@@ -90,7 +115,7 @@ job = Job(gc, bfrt_info,
 
 # Done with configuration
 #logger.info("Switch configured! Hit Ctrl-\ to exit.")
-logger.info("Switch configured successfully!")
+logger.info("Switch configured successfully! Registers are cleared in the background; use startup_profile to check.")
 
 
 # start CLI
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+
+#
+# This code checks SwitchML debug logs for sequence violations and
+# summarizes retransmissions and slot completion, without needing to
+# open a spreadsheet.
+#
+# It accepts the same inputs as convert_log.py: a log saved with
+# log_save (.bin or .yaml), a capture record file (.rec), or a capture
+# directory from log_capture_start:
+#   $ python3 analyze_log.py debug_log.bin
+#   $ python3 analyze_log.py debug_log/ --json report.json --check
+#
+# With --check, the exit status is 1 if any packet ID gaps, duplicate
+# first passes, or packet type ordering anomalies are found, so it can
+# be used in CI.
+#
+
+import os
+import sys
+import json
+import argparse
+import numpy as np
+
+# share the log decoder and analyzer with the controller
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'py'))
+import log_decode
+import log_analyze
+
+
+def analyze_file(log_filename, max_examples=10, top=10):
+    records = list(log_decode.iter_records(log_filename))
+    if records:
+        records = np.concatenate(records)
+    else:
+        records = np.zeros(0, dtype=log_decode.log_entry_dtype)
+    return log_analyze.analyze(records, max_examples, top)
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description="Checks a packet log for sequence violations and retransmissions.")
+    argparser.add_argument('log', type=str, help='Log file saved with log_save (.bin or .yaml), capture record file (.rec), or capture directory')
+    argparser.add_argument('--json', type=str, default=None, help='Write report to this JSON file')
+    argparser.add_argument('--examples', type=int, default=10, help='Number of examples to show for each kind of violation')
+    argparser.add_argument('--top', type=int, default=10, help='Number of pool indices to show')
+    argparser.add_argument('--check', default=False, action='store_true', help='Exit with status 1 if any violations are found')
+    args = argparser.parse_args()
+
+    report = analyze_file(args.log, args.examples, args.top)
+    print(log_analyze.format_report(report))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    if args.check and log_analyze.violations(report):
+        sys.exit(1)